@@ -0,0 +1,79 @@
+"""Binlog produce benchmark
+
+usage: bench_binlog.py [records] [producers] [window_ms] [fsync]
+
+With one producer it prints the mean append latency per window, which should
+stay flat as the log grows. With several producers it prints the overall
+throughput, which is where group commit pays off.
+"""
+
+import os
+import shutil
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+SRC = os.path.join(ROOT, "src")
+
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+from server.core.binlog import (  # noqa: E402
+    TransactionLog,
+    TransactionLogHeader,
+    append_bin,
+    close_writers,
+    configure_group_commit,
+    get_topic_path,
+)
+from server.util.config import GroupCommitConfig, Server  # noqa: E402
+
+TOTAL = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+PRODUCERS = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+WINDOW_MS = int(sys.argv[3]) if len(sys.argv) > 3 else 0
+FSYNC = len(sys.argv) > 4 and sys.argv[4] == "fsync"
+WINDOW = max(TOTAL // 10, 1)
+PAYLOAD = os.urandom(128)
+
+topic = f"bench_binlog_{time.time_ns()}"
+producer = Server("bench", "127.0.0.1", 0)
+configure_group_commit(GroupCommitConfig(window_ms=WINDOW_MS, fsync=FSYNC))
+
+
+def make(i: int) -> TransactionLog:
+    return TransactionLog(
+        TransactionLogHeader(int(time.time()), topic, f"m{i}", producer, len(PAYLOAD)),
+        PAYLOAD,
+    )
+
+
+def produce(count: int):
+    for i in range(count):
+        append_bin(topic, make(i))
+
+
+try:
+    if PRODUCERS == 1:
+        started = time.perf_counter()
+        for i in range(TOTAL):
+            append_bin(topic, make(i))
+            if (i + 1) % WINDOW == 0:
+                elapsed = time.perf_counter() - started
+                print(f"{i + 1:>10} records  {elapsed / WINDOW * 1e6:8.2f} us/append")
+                started = time.perf_counter()
+    else:
+        threads = [
+            threading.Thread(target=produce, args=(TOTAL // PRODUCERS,))
+            for _ in range(PRODUCERS)
+        ]
+        started = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.perf_counter() - started
+        print(f"{PRODUCERS} producers  {TOTAL / elapsed:10.0f} records/s")
+finally:
+    close_writers()
+    shutil.rmtree(os.path.dirname(get_topic_path(topic)), ignore_errors=True)
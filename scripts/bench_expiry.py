@@ -0,0 +1,56 @@
+"""Queue consume latency against the number of in-flight messages
+
+usage: bench_expiry.py [in_flight,...] [consumes]
+
+For each in-flight count the topic first hands out that many messages with a
+long ack timeout, then times consumes of the remaining ones. Ack log writes
+are async so the numbers show the expiry bookkeeping, not the disk.
+"""
+
+import os
+import shutil
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+SRC = os.path.join(ROOT, "src")
+
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+from server.core.acklog import (  # noqa: E402
+    close_acklog_writers,
+    configure_acklog,
+    get_acklog_path,
+)
+from server.core.binlog import TransactionLog, TransactionLogHeader  # noqa: E402
+from server.core.mode import Mode  # noqa: E402
+from server.core.topic import Topic  # noqa: E402
+from server.util.config import AckLogConfig, Server  # noqa: E402
+
+IN_FLIGHT = (
+    [int(n) for n in sys.argv[1].split(",")] if len(sys.argv) > 1 else [0, 1_000, 10_000, 50_000]
+)
+CONSUMES = int(sys.argv[2]) if len(sys.argv) > 2 else 5_000
+
+configure_acklog(AckLogConfig(durability="async", batch_size=4096, flush_interval_ms=50))
+producer = Server("bench", "127.0.0.1", 0)
+
+for in_flight in IN_FLIGHT:
+    name = f"bench_expiry_{time.time_ns()}"
+    topic = Topic(Mode.QUEUE, name)
+    try:
+        for i in range(in_flight + CONSUMES):
+            topic.add_queue(
+                TransactionLog(TransactionLogHeader(0, name, f"m{i}", producer, 1), b"x")
+            )
+        for _ in range(in_flight):
+            topic.consume_queue("holder", 3_600_000)
+        started = time.perf_counter()
+        for _ in range(CONSUMES):
+            topic.consume_queue("bench", 3_600_000)
+        elapsed = time.perf_counter() - started
+        print(f"{in_flight:>8} in flight  {elapsed / CONSUMES * 1e6:8.2f} us/consume")
+    finally:
+        close_acklog_writers()
+        shutil.rmtree(os.path.dirname(get_acklog_path(name)), ignore_errors=True)
@@ -0,0 +1,122 @@
+"""Queue recovery benchmark
+
+usage: bench_recovery.py [records] [live] [tail]
+
+Writes records messages to a queue topic and acks all but live of them
+through the ack log, checkpoints the queue, then produces and acks tail more
+messages. Prints the time to rebuild the queue from the full logs and from
+the checkpoint plus the log tail.
+"""
+
+import os
+import shutil
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(__file__))
+SRC = os.path.join(ROOT, "src")
+
+if SRC not in sys.path:
+    sys.path.insert(0, SRC)
+
+from server.core.acklog import (  # noqa: E402
+    AckLogEntry,
+    AckState,
+    get_acklog_path,
+    read_acklog,
+    serialize_entry,
+)
+from server.core.binlog import (  # noqa: E402
+    TransactionLog,
+    TransactionLogHeader,
+    append_bin,
+    close_writers,
+    configure_group_commit,
+    configure_topic,
+    get_topic_path,
+    get_writer,
+    iter_bin,
+    iter_live,
+    iter_messages,
+)
+from server.core.checkpoint import get_checkpoint_path, load_checkpoint  # noqa: E402
+from server.core.mode import Mode  # noqa: E402
+from server.core.topic import Topic  # noqa: E402
+from server.util.config import GroupCommitConfig, SegmentConfig, Server  # noqa: E402
+from server.util.file import ensure_parent  # noqa: E402
+
+TOTAL = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+LIVE = int(sys.argv[2]) if len(sys.argv) > 2 else 2_000
+TAIL = int(sys.argv[3]) if len(sys.argv) > 3 else 1_000
+PAYLOAD = os.urandom(100)
+
+topic_name = f"bench_recovery_{time.time_ns()}"
+producer = Server("bench", "127.0.0.1", 0)
+configure_group_commit(GroupCommitConfig(window_ms=0, fsync=False))
+configure_topic(topic_name, SegmentConfig(max_records=20_000))
+
+
+def make(i: int) -> TransactionLog:
+    return TransactionLog(
+        TransactionLogHeader(int(time.time()), topic_name, f"m{i}", producer, len(PAYLOAD)),
+        PAYLOAD,
+    )
+
+
+def produce_and_ack(first: int, count: int, live: int):
+    """Produce count messages and write assigned + acked entries for all but the last live"""
+    now_ms = int(time.time() * 1000)
+    ack_log = bytearray()
+    for i in range(first, first + count):
+        append_bin(topic_name, make(i))
+        if i >= first + count - live:
+            continue
+        for state in (AckState.ASSIGNED, AckState.ACKED):
+            ack_log += serialize_entry(
+                AckLogEntry(now_ms, f"m{i}", "bench", now_ms + 60000, state)
+            )
+    path = get_acklog_path(topic_name)
+    ensure_parent(path)
+    with open(path, "ab") as f:
+        f.write(ack_log)
+
+
+def recover_full() -> Topic:
+    topic = Topic(Mode.QUEUE, topic_name)
+    ack_entries = read_acklog(topic_name)
+    acked = {e.message_id for e in ack_entries if e.state == AckState.ACKED}
+    topic.initialize_queue_from_logs((t for _, t in iter_live(topic_name, acked)), ack_entries)
+    return topic
+
+
+def recover_checkpoint() -> Topic:
+    topic = Topic(Mode.QUEUE, topic_name)
+    checkpoint = load_checkpoint(topic_name)
+    topic.initialize_queue_from_checkpoint(
+        checkpoint,
+        (t for _, t in iter_messages(topic_name, checkpoint.message_ids())),
+        (t for _, t in iter_bin(topic_name, checkpoint.binlog_offset)),
+        read_acklog(topic_name, checkpoint.acklog_position),
+    )
+    return topic
+
+
+try:
+    produce_and_ack(0, TOTAL, LIVE)
+    topic = recover_full()
+    topic.set_next_offset(get_writer(topic_name).get_size())
+    topic.checkpoint()
+    produce_and_ack(TOTAL, TAIL, 0)
+
+    for label, recover in (("full logs", recover_full), ("checkpoint", recover_checkpoint)):
+        started = time.perf_counter()
+        size = len(recover()._q)  # pylint: disable=protected-access
+        print(f"{label:>12}  {time.perf_counter() - started:8.3f}s  {size} queued")
+finally:
+    close_writers()
+    for path in (
+        get_topic_path(topic_name),
+        get_acklog_path(topic_name),
+        get_checkpoint_path(topic_name, 0),
+    ):
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
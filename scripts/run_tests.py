@@ -10,14 +10,16 @@ SRC = os.path.join(ROOT, "src")
 if SRC not in sys.path:
     sys.path.insert(0, SRC)
 
-loader = unittest.TestLoader()
+if __name__ == "__main__":
+    # guarded, tests start worker processes which re-import this module
+    loader = unittest.TestLoader()
 
-suite = loader.discover(
-    start_dir=os.path.join(SRC, "server", "core", "tests"),
-    top_level_dir=SRC,
-)
+    suite = loader.discover(
+        start_dir=os.path.join(SRC, "server", "core", "tests"),
+        top_level_dir=SRC,
+    )
 
-runner = unittest.TextTestRunner(verbosity=2)
-result = runner.run(suite)
+    runner = unittest.TextTestRunner(verbosity=2)
+    result = runner.run(suite)
 
-sys.exit(0 if result.wasSuccessful() else 1)
+    sys.exit(0 if result.wasSuccessful() else 1)
@@ -1,6 +1,9 @@
 """Consumer module"""
 
-from exception import SocketIsNoneException
+import json
+from collections.abc import Iterator
+from exception import SocketIsNoneException, SubscriptionFailedException
+from server.core.socket import Socket
 from .sms_client import SMSClient
 
 
@@ -17,18 +20,73 @@ class SMSConsumer(SMSClient):
     # No, consumer can always send offset, server can just ignore it based on the mode set in the topic
     # Is this the right way?
     # It seems not to be the best, but it can reduce the complexity of implementation on the consumer side
-    def consume_broadcast(self, topic: str, offset: int = 0) -> dict:
+    def consume_broadcast(
+        self,
+        topic: str,
+        offset: int = 0,
+        max_messages: int | None = None,
+        from_timestamp: int | None = None,
+        partition: int | None = None,
+    ) -> dict:
         if self._socket_manager is None:
             raise SocketIsNoneException()
         payload = {"type": "consume", "topic": topic, "mode": "broadcast", "offset": offset}
+        if max_messages is not None:
+            payload["max_messages"] = max_messages
+        # from_timestamp (unix seconds) takes precedence over offset
+        if from_timestamp is not None:
+            payload["from_timestamp"] = from_timestamp
+        if partition is not None:
+            payload["partition"] = partition
         return self._send_request(payload)
 
+    def subscribe(
+        self,
+        topic: str,
+        offset: int = 0,
+        credits: int | None = None,
+        max_messages: int | None = None,
+        from_timestamp: int | None = None,
+        partition: int | None = None,
+    ) -> Iterator[dict]:
+        """Yield broadcast messages as the server pushes them, each with its offset
+
+        The subscription keeps its own connection open. A credit is returned
+        once the messages of a batch have been consumed, so the server never
+        sends more than credits batches ahead of the caller.
+        """
+        if self._socket_manager is None:
+            raise SocketIsNoneException()
+        payload = {"type": "subscribe", "topic": topic, "mode": "broadcast", "offset": offset}
+        if credits is not None:
+            payload["credits"] = credits
+        if max_messages is not None:
+            payload["max_messages"] = max_messages
+        if from_timestamp is not None:
+            payload["from_timestamp"] = from_timestamp
+        if partition is not None:
+            payload["partition"] = partition
+        sock = self._socket_manager.send(json.dumps(payload).encode("utf-8"))
+        try:
+            response = json.loads(Socket.recv_framed(sock).decode("utf-8"))
+            if response.get("status") != "ok":
+                raise SubscriptionFailedException(response.get("error"))
+            while (frame := Socket.recv_framed(sock)) is not None:
+                yield from json.loads(frame.decode("utf-8"))["messages"]
+                Socket.send_framed(sock, json.dumps({"credits": 1}).encode("utf-8"))
+        finally:
+            sock.close()
+
     def consume_queue(
         self,
         topic: str,
         consumer_id: str,
         ack_mode: str | None = None,
         ack_timeout_ms: int | None = None,
+        max_messages: int | None = None,
+        max_bytes: int | None = None,
+        wait_ms: int | None = None,
+        partition: int | None = None,
     ) -> dict:
         if self._socket_manager is None:
             raise SocketIsNoneException()
@@ -42,9 +100,38 @@ class SMSConsumer(SMSClient):
             payload["ack_mode"] = ack_mode
         if ack_timeout_ms is not None:
             payload["ack_timeout_ms"] = ack_timeout_ms
+        # with max_messages the response carries a messages list
+        if max_messages is not None:
+            payload["max_messages"] = max_messages
+        if max_bytes is not None:
+            payload["max_bytes"] = max_bytes
+        # block up to wait_ms on an empty queue instead of returning empty
+        if wait_ms is not None:
+            payload["wait_ms"] = wait_ms
+        # without a partition the first non-empty one is consumed
+        if partition is not None:
+            payload["partition"] = partition
+        return self._send_request(payload)
+
+    def get(self, topic: str, message_id: str, partition: int | None = None) -> dict:
+        if self._socket_manager is None:
+            raise SocketIsNoneException()
+        payload = {"type": "get", "topic": topic, "message_id": message_id}
+        if partition is not None:
+            payload["partition"] = partition
+        return self._send_request(payload)
+
+    def stats(self, topic: str, partition: int | None = None) -> dict:
+        if self._socket_manager is None:
+            raise SocketIsNoneException()
+        payload = {"type": "stats", "topic": topic}
+        if partition is not None:
+            payload["partition"] = partition
         return self._send_request(payload)
 
-    def ack(self, topic: str, consumer_id: str, message_id: str) -> dict:
+    def ack(
+        self, topic: str, consumer_id: str, message_id: str, partition: int | None = None
+    ) -> dict:
         if self._socket_manager is None:
             raise SocketIsNoneException()
         payload = {
@@ -54,9 +141,18 @@ class SMSConsumer(SMSClient):
             "consumer_id": consumer_id,
             "message_id": message_id,
         }
+        if partition is not None:
+            payload["partition"] = partition
         return self._send_request(payload)
 
-    def nack(self, topic: str, consumer_id: str, message_id: str) -> dict:
+    def nack(
+        self,
+        topic: str,
+        consumer_id: str,
+        message_id: str,
+        partition: int | None = None,
+        delay_ms: int | None = None,
+    ) -> dict:
         if self._socket_manager is None:
             raise SocketIsNoneException()
         payload = {
@@ -66,4 +162,48 @@ class SMSConsumer(SMSClient):
             "consumer_id": consumer_id,
             "message_id": message_id,
         }
+        if partition is not None:
+            payload["partition"] = partition
+        # redeliver once delay_ms has passed instead of right away
+        if delay_ms is not None:
+            payload["delay_ms"] = delay_ms
+        return self._send_request(payload)
+
+    def ack_many(
+        self, topic: str, consumer_id: str, message_ids: list[str], partition: int | None = None
+    ) -> dict:
+        if self._socket_manager is None:
+            raise SocketIsNoneException()
+        payload = {
+            "type": "ack",
+            "topic": topic,
+            "mode": "queue",
+            "consumer_id": consumer_id,
+            "message_ids": message_ids,
+        }
+        if partition is not None:
+            payload["partition"] = partition
+        return self._send_request(payload)
+
+    def nack_many(
+        self,
+        topic: str,
+        consumer_id: str,
+        message_ids: list[str],
+        partition: int | None = None,
+        delay_ms: int | None = None,
+    ) -> dict:
+        if self._socket_manager is None:
+            raise SocketIsNoneException()
+        payload = {
+            "type": "nack",
+            "topic": topic,
+            "mode": "queue",
+            "consumer_id": consumer_id,
+            "message_ids": message_ids,
+        }
+        if partition is not None:
+            payload["partition"] = partition
+        if delay_ms is not None:
+            payload["delay_ms"] = delay_ms
         return self._send_request(payload)
@@ -8,8 +8,23 @@ import base64
 class SMSProducer(SMSClient):
     """SMS Producer impl class which extends SMSClient"""
 
-    def produce(self, topic: str, message: bytes) -> dict:
-        """Produce message to the topic"""
+    def produce(
+        self,
+        topic: str,
+        message: bytes,
+        key: str | None = None,
+        partition: int | None = None,
+        priority: int | None = None,
+        delay_ms: int | None = None,
+        deliver_at_ms: int | None = None,
+    ) -> dict:
+        """Produce message to the topic
+
+        Messages with the same key go to the same partition, without a key or
+        partition the server picks one round-robin. Queue consumers get higher
+        priorities (0-15) first, and only once delay_ms has passed or at
+        deliver_at_ms (unix ms).
+        """
         if self._socket_manager is None:
             raise SocketIsNoneException()
 
@@ -19,6 +34,16 @@ class SMSProducer(SMSClient):
             "payload_b64": base64.b64encode(message).decode("utf-8"),
             "producer": {"host": self._host, "ip": self._ip, "port": self._port},
         }
+        if key is not None:
+            payload["key"] = key
+        if partition is not None:
+            payload["partition"] = partition
+        if priority is not None:
+            payload["priority"] = priority
+        if delay_ms is not None:
+            payload["delay_ms"] = delay_ms
+        if deliver_at_ms is not None:
+            payload["deliver_at_ms"] = deliver_at_ms
         return self._send_request(payload)
 
 
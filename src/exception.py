@@ -5,9 +5,37 @@ class SocketIsNoneException(Exception):
     """Conn object is None"""
 
 
+class SubscriptionFailedException(Exception):
+    """Server Refused The Subscribe Request"""
+
+
+class BinLogAppendException(Exception):
+    """Record Was Written But Its Group-Commit Batch Failed"""
+
+    def __init__(self, error: Exception, offset: int):
+        super().__init__(f"{error} (record written at offset {offset})")
+        self.offset = offset
+
+
+class UnpartitionedTopicLogException(Exception):
+    """Topic Has Several Partitions But Logs Of Its Plain Name Are Left"""
+
+
 class UnexpectedModeStringValue(Exception):
     """Undefined Mode String Value"""
 
 
+class UnexpectedCodecStringValue(Exception):
+    """Undefined Compression Codec String Value"""
+
+
+class UnexpectedCompressionLevelValue(Exception):
+    """Compression Level Out Of The Codec's Range"""
+
+
+class UnexpectedDurabilityStringValue(Exception):
+    """Undefined Ack Log Durability String Value"""
+
+
 class ClassNameDoesNotMatch(Exception):
     """Class Name Does Not Match"""
@@ -1,12 +1,17 @@
 """Ack log utility for queue mode persistence"""
 
 import os
+import threading
+import time
 import zlib
+from contextlib import nullcontext
 from dataclasses import dataclass
 from enum import Enum
 from pathlib import Path
 from collections import OrderedDict
-from server.util.file import read_bytes_or_create, append_bytes
+from server.util.config import AckLogConfig
+from server.util.file import read_bytes_or_create, ensure_parent
+from server.system_logger import SLOG
 
 
 class AckState(Enum):
@@ -14,6 +19,8 @@ class AckState(Enum):
     ACKED = 1
     NACKED = 2
     EXPIRED = 3
+    # deadline_ms is when the message is delivered
+    DELAYED = 4
 
 
 @dataclass
@@ -42,8 +49,14 @@ def serialize_entry(entry: AckLogEntry) -> bytes:
 
 
 def decode_entries(data: bytes) -> list[AckLogEntry]:
+    return scan_entries(data)[0]
+
+
+def scan_entries(data: bytes) -> tuple[list[AckLogEntry], int]:
+    """Decode entries, returns them with the end of the last complete entry"""
     entries: list[AckLogEntry] = []
     ptr = 0
+    end = 0
     total = len(data)
 
     def _read(n: int) -> bytes | None:
@@ -82,6 +95,7 @@ def decode_entries(data: bytes) -> list[AckLogEntry]:
         crc_bytes = _read(4)
         if crc_bytes is None:
             break
+        end = ptr
 
         crc_expected = int.from_bytes(crc_bytes, "big", signed=False)
         crc_actual = _crc32(data[start : ptr - 4])
@@ -103,21 +117,259 @@ def decode_entries(data: bytes) -> list[AckLogEntry]:
             )
         )
 
-    return entries
+    return entries, end
+
+
+def read_acklog(topic: str, position: int = 0) -> list[AckLogEntry]:
+    """Decode the ack log from the byte position onwards"""
+    if position <= 0:
+        return decode_entries(read_bytes_or_create(get_acklog_path(topic)))
+    with open(get_acklog_path(topic), "rb") as f:
+        f.seek(position)
+        return decode_entries(f.read())
+
+
+def get_acklog_size(topic: str) -> int:
+    """Byte size of the ack log, 0 when it does not exist yet"""
+    try:
+        return os.path.getsize(get_acklog_path(topic))
+    except FileNotFoundError:
+        return 0
+
+
+class AckLogWriter(threading.Thread):
+    """Persistent appender of a topic ack log
+
+    Entries are queued in memory in the order they are appended, which the
+    topic lock decides, and the thread writes them through one open handle
+    whenever batch_size entries are waiting, flush_interval_ms has passed or
+    a caller waits for them. With durability write a queue operation returns
+    once its entry reached the OS, with fsync once it is on disk, and with
+    async right away.
+
+    Positions handed to waiters only grow. They match byte positions in the
+    file until a compaction replaces it, from then on they are ahead by
+    _base, so a waiter holding a position from before the swap still gets
+    through.
+    """
+
+    def __init__(self, topic: str, config: AckLogConfig):
+        super().__init__(daemon=True)
+        self._topic = topic
+        self._config = config
+        self._path = get_acklog_path(topic)
+        ensure_parent(self._path)
+        self._file = open(self._path, "ab")  # pylint: disable=consider-using-with
+        self._cond = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._pending: list[bytes] = []
+        self._base = 0
+        self._position = self._file.tell()
+        self._written = self._position
+        self._synced = self._position
+        self._waiting = 0
+        self._error: Exception | None = None
+        self._stop_event = threading.Event()
+
+    def append(self, entry: AckLogEntry) -> int:
+        """Queue an entry, returns the log position right after it"""
+        data = serialize_entry(entry)
+        with self._cond:
+            if self._stop_event.is_set():
+                raise RuntimeError("ack log writer is closed")
+            self._pending.append(data)
+            self._position += len(data)
+            if len(self._pending) == 1 or len(self._pending) >= self._config.batch_size:
+                self._cond.notify_all()
+            return self._position
+
+    def extend(self, entries: list[AckLogEntry]) -> int:
+        """Queue entries as one batch, returns the log position right after them"""
+        data = b"".join(serialize_entry(entry) for entry in entries)
+        with self._cond:
+            if self._stop_event.is_set():
+                raise RuntimeError("ack log writer is closed")
+            self._pending.append(data)
+            self._position += len(data)
+            self._cond.notify_all()
+            return self._position
+
+    def wait(self, position: int):
+        """Block until the log up to position is as durable as configured"""
+        if self._config.durability == "async":
+            return
+        fsync = self._config.durability == "fsync"
+        while True:
+            with self._cond:
+                if (self._synced if fsync else self._written) >= position:
+                    return
+                if self._error is not None:
+                    raise self._error
+                if self._pending:
+                    self._waiting += 1
+                    self._cond.notify_all()
+                    self._cond.wait()
+                    self._waiting -= 1
+                    continue
+            # written by a plain flush but not synced yet, nothing left for the thread
+            self.flush(fsync)
+
+    def run(self):
+        interval_s = max(self._config.flush_interval_ms, 1) / 1000
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop_event.is_set():
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                # wait for more entries unless someone is blocked on these
+                deadline = time.monotonic() + interval_s
+                while (
+                    len(self._pending) < self._config.batch_size
+                    and not self._waiting
+                    and not self._stop_event.is_set()
+                ):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            try:
+                self.flush(self._config.durability == "fsync")
+            except Exception as e:  # pylint: disable=broad-except
+                SLOG.error(e)
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                self._stop_event.wait(interval_s)
+
+    def flush(self, fsync: bool = False):
+        """Write every queued entry now, optionally fsync"""
+        with self._write_lock:
+            with self._cond:
+                batch, self._pending = self._pending, []
+                end = self._position
+            if batch:
+                self._file.write(b"".join(batch))
+                self._file.flush()
+            if fsync and self._synced < end:
+                os.fsync(self._file.fileno())
+            with self._cond:
+                self._written = end
+                if fsync:
+                    self._synced = end
+                self._error = None
+                self._cond.notify_all()
+
+    def get_position(self) -> int:
+        """End of the log as a byte position in the file, counting entries not written yet"""
+        with self._cond:
+            return self._position - self._base
+
+    def reopen(self):
+        """Reopen the handle after the file was replaced, appends must be held off
+
+        The new file was written and fsynced with every entry written so far,
+        so those count as durable and their positions stay valid.
+        """
+        with self._write_lock:
+            self._file.close()
+            self._file = open(self._path, "ab")  # pylint: disable=consider-using-with
+            with self._cond:
+                pending = sum(len(data) for data in self._pending)
+                self._written = self._synced = self._position - pending
+                self._base = self._written - self._file.tell()
+                self._cond.notify_all()
+
+    def close(self):
+        """Write what is queued, then close the handle"""
+        with self._cond:
+            self._stop_event.set()
+            self._cond.notify_all()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+        self.flush(self._config.durability == "fsync")
+        self._file.close()
+
+
+_acklog_config = AckLogConfig()
+_acklog_writers: dict[str, AckLogWriter] = {}
+_acklog_writers_lock = threading.Lock()
+
+
+def configure_acklog(config: AckLogConfig):
+    """Set the buffering and durability policy used by ack log writers opened afterwards"""
+    global _acklog_config  # pylint: disable=global-statement
+    with _acklog_writers_lock:
+        _acklog_config = config
+
+
+def get_acklog_writer(topic: str) -> AckLogWriter:
+    """Return the shared ack log writer of the topic, opening it on first use"""
+    with _acklog_writers_lock:
+        writer = _acklog_writers.get(topic)
+        if writer is None:
+            writer = AckLogWriter(topic, _acklog_config)
+            writer.start()
+            _acklog_writers[topic] = writer
+        return writer
+
+
+def close_acklog_writers():
+    """Close every open ack log writer"""
+    with _acklog_writers_lock:
+        writers = list(_acklog_writers.values())
+        _acklog_writers.clear()
+    for writer in writers:
+        writer.close()
+
+
+def append_acklog(topic: str, entry: AckLogEntry) -> int:
+    """Queue the entry on the topic writer, returns the log position after it
+
+    Call wait_acklog with the position once the topic lock is released.
+    """
+    return get_acklog_writer(topic).append(entry)
+
+
+def append_acklog_batch(topic: str, entries: list[AckLogEntry]) -> int:
+    """Queue the entries on the topic writer in one go, see append_acklog"""
+    return get_acklog_writer(topic).extend(entries)
+
+
+def wait_acklog(topic: str, position: int) -> None:
+    """Block until the ack log up to position is as durable as configured"""
+    if position:
+        get_acklog_writer(topic).wait(position)
+
 
+def sync_acklog(topic: str) -> int:
+    """Write out everything queued, returns the log position it covers"""
+    writer = get_acklog_writer(topic)
+    writer.flush(_acklog_config.durability == "fsync")
+    return writer.get_position()
 
-def read_acklog(topic: str) -> list[AckLogEntry]:
-    return decode_entries(read_bytes_or_create(get_acklog_path(topic)))
 
+def get_acklog_position(topic: str) -> int:
+    """End of the ack log, counting entries queued but not written yet"""
+    return get_acklog_writer(topic).get_position()
 
-def append_acklog(topic: str, entry: AckLogEntry) -> None:
-    append_bytes(get_acklog_path(topic), serialize_entry(entry))
 
+def compact_acklog(topic: str, lock=None) -> int:
+    """Rewrite ack log keeping only the latest state per message_id
 
-def compact_acklog(topic: str) -> None:
-    """Rewrite ack log keeping only the latest state per message_id"""
+    With the lock appends are serialized on, the rewrite runs without it:
+    the lock is taken briefly to find the end of the log, and again to copy
+    the entries appended meanwhile behind the compacted ones and swap the
+    file in. Returns the size of the new log.
+    """
+    lock = lock or nullcontext()
     path = get_acklog_path(topic)
-    entries = decode_entries(read_bytes_or_create(path))
+    writer = get_acklog_writer(topic)
+    with lock:
+        writer.flush()
+        end = get_acklog_size(topic)
+    with open(path, "rb") as f:
+        entries = decode_entries(f.read(end))
     latest: OrderedDict[str, AckLogEntry] = OrderedDict()
     for entry in entries:
         if entry.message_id in latest:
@@ -129,9 +381,18 @@ def compact_acklog(topic: str) -> None:
     Path(tmp_path).parent.mkdir(parents=True, exist_ok=True)
     with open(tmp_path, "wb") as f:
         f.write(data)
-        f.flush()
-        os.fsync(f.fileno())
-    os.replace(tmp_path, path)
+        with lock:
+            # catch up on the entries appended during the rewrite
+            writer.flush()
+            with open(path, "rb") as current:
+                current.seek(end)
+                appended = current.read()
+            f.write(appended)
+            f.flush()
+            os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+            writer.reopen()
+    return len(data) + len(appended)
 
 
 def get_acklog_path(topic: str, extension: str = "aql") -> str:
@@ -1,15 +1,34 @@
 """Bin Log utility"""
 
 import os
+import bisect
+import hashlib
+import lzma
+import mmap
+import struct
+import threading
+import time
 import zlib
+from collections import deque, OrderedDict
+from functools import partial
+from itertools import islice
 from typing import Self
 from pathlib import Path
 from dataclasses import dataclass
-from server.util.file import read_bytes_or_create, write_bytes
-from server.util.config import Server
+from exception import BinLogAppendException
+from server.util.file import ensure_parent
+from server.util.config import (
+    Server,
+    SegmentConfig,
+    GroupCommitConfig,
+    CompressionConfig,
+    TailConfig,
+)
+from server.system_logger import SLOG
 
 """
-Add os.fsync(f.fileno()) after writes for durability
+Durability: appends go through a per-topic group commit, one write and one
+os.fsync per batch (binlog_settings in sms_config.yaml)
 
 Consider transaction_to_bytes() as @staticmethod
 
@@ -19,6 +38,54 @@ Use append_bin_reserialize_all() only for rare cases like compaction
 """
 
 
+# index file entry: byte position (uint64) of the record in the segment
+INDEX_ENTRY_SIZE = 8
+
+# v2 segment header: magic, then payload_size (uint32)
+SEGMENT_MAGIC_V2 = b"SMB2"
+
+# v2 record header: kind, flags, topic ref, producer ref, sequence, timestamp,
+# message_id as uuid bytes, message_id length, payload size
+RECORD_V2 = struct.Struct(">BBHHQQ16sHI")
+KIND_MESSAGE = 0
+KIND_BLOCK = 1
+FLAG_UUID_MESSAGE_ID = 0x01
+# the high nibble of flags is the queue priority, 0 (lowest) to MAX_PRIORITY
+PRIORITY_SHIFT = 4
+MAX_PRIORITY = 0x0F
+
+# v2 compressed block header: kind, codec, record count, first sequence,
+# uncompressed size, compressed size, then the compressed records and crc32
+BLOCK_V2 = struct.Struct(">BBHQII")
+MAX_BLOCK_RECORDS = 0xFFFF
+BLOCK_CACHE_SIZE = 16
+# shared segment maps kept at once, each one holds a file descriptor
+MAPPED_SEGMENTS = 32
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_LZMA = 2
+CODECS = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "lzma": CODEC_LZMA}
+
+# v2 dictionary entry: kind, ref, value length, then the value
+DICTIONARY_ENTRY = struct.Struct(">BHH")
+DICT_TOPIC = 1
+DICT_PRODUCER = 2
+MAX_DICTIONARY_REFS = 0xFFFF
+
+# sparse timestamp index entry: running max timestamp, local offset
+TIMESTAMP_ENTRY = struct.Struct(">QQ")
+TIMESTAMP_INDEX_INTERVAL = 128
+
+# message id index entry: message id hash, local offset, byte position
+MESSAGE_INDEX_ENTRY = struct.Struct(">QQQ")
+
+RETENTION_CHECK_INTERVAL_S = 1.0
+
+# read size of the streaming decoder
+CHUNK_SIZE = 64 * 1024
+
+
 @dataclass
 class TransactionLogHeader:
     """Transaction Log Header"""
@@ -28,6 +95,7 @@ class TransactionLogHeader:
     message_id: str
     producer: Server
     payload_size: int
+    priority: int = 0
 
 
 @dataclass
@@ -35,7 +103,7 @@ class TransactionLog:
     """Transaction Log Object"""
 
     header: TransactionLogHeader
-    data: bytes
+    data: bytes | memoryview
 
 
 class BinLog:
@@ -43,6 +111,7 @@ class BinLog:
 
     def __init__(self):
         self._payload_size: int = 0
+        self._offset: int = 0
         self._transactions: list[TransactionLog] = []
 
     def append(self, transaction: TransactionLog):
@@ -53,19 +122,7 @@ class BinLog:
     def append_atomic(self, transaction: TransactionLog):
         """Append transaction to the file immediately"""
         self.append(transaction)
-
-        with open(get_topic_path(transaction.header.topic), "r+b") as f:
-            f.seek(0)
-            payload_size = int.from_bytes(f.read(4), "big") + 1
-            f.seek(0)
-            f.write(payload_size.to_bytes(4, "big"))
-
-            f.seek(0, os.SEEK_END)
-            f.write(BinLog.transaction_to_bytes(transaction))
-
-    def optimize(self) -> None:
-        """Optimize function for the bin"""
-        raise NotImplementedError()
+        get_writer(transaction.header.topic).append(transaction)
 
     def serialize_all(self) -> bytes:
         """Convert payload_size+transactions into bytes"""
@@ -75,13 +132,21 @@ class BinLog:
             ret += BinLog.transaction_to_bytes(transaction)
         return ret
 
-    def append_index(self):
+    @staticmethod
+    def append_index(index_file, position: int):
         """Append index info to the index file"""
-        raise NotImplementedError()
+        index_file.write(position.to_bytes(INDEX_ENTRY_SIZE, "big", signed=False))
 
-    def index_all(self) -> list[int]:
-        """Reindexing all transactions"""
-        raise NotImplementedError()
+    @staticmethod
+    def index_all(data: bytes) -> list[int]:
+        """Reindexing all transactions, returns the byte position of every record"""
+        if data[0:4] == SEGMENT_MAGIC_V2:
+            payload_size = int.from_bytes(data[4:8], byteorder="big")
+            # positions only need the fixed headers, not the dictionary
+            decode = partial(_decode_v2_entry, dictionary=SegmentDictionary())
+            return [start for start, _, _, _ in _scan_entries(data, 8, payload_size, decode)]
+        payload_size = int.from_bytes(data[0:4], byteorder="big")
+        return [start for start, _, _, _ in _scan_records(data, 4, payload_size)]
 
     @staticmethod
     def transaction_to_bytes(transaction: TransactionLog) -> bytes:
@@ -139,98 +204,1557 @@ class BinLog:
         """Getter"""
         return self._transactions
 
+    def get_offset(self) -> int:
+        """Getter, offset of the first transaction"""
+        return self._offset
+
+    def set_offset(self, offset: int):
+        """Setter"""
+        self._offset = offset
+
     def cut(self, offset: int) -> Self:
         """Offset"""
         self._transactions = self._transactions[offset:]
         self._payload_size = len(self._transactions)
+        self._offset += offset
         return self
 
     @staticmethod
     def decode(data: bytes, offset: int = 0) -> Self:
         """Static helper method to decode the bytes"""
-        blog = BinLog()
-        ptr = 0  # file pointer
         # read bytes, header
-        payload_size = int.from_bytes(data[ptr : ptr + 4], byteorder="big")
+        payload_size = int.from_bytes(data[0:4], byteorder="big")
+        blog = BinLog.decode_records(data, 4, payload_size)
+
+        # cut offset
+        if offset == 0:
+            return blog
+
+        return blog.cut(offset)
 
-        ptr += 4
+    @staticmethod
+    def decode_records(data: bytes | memoryview, ptr: int, count: int) -> Self:
+        """Decode count records starting at byte position ptr"""
+        blog = BinLog()
+        for _, _, ok, transaction in _scan_records(data, ptr, count):
+            if not ok:
+                continue
+            blog.append(transaction)
+        # read payloads
+        assert blog.get_size() == count
+        return blog
+
+
+def _parse_record(data: bytes | memoryview, ptr: int, with_message_id: bool):
+    """Parse one record at ptr, returns (crc_ok, end_ptr, transaction)
+
+    When data is a memoryview the payload is a slice of it, not a copy.
+    """
+    start = ptr
+    _ptr = ptr
+    timestamp = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+    _ptr += 4
+
+    topic_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+    _ptr += 4
+
+    topic = str(data[_ptr : _ptr + topic_length], "utf-8")
+    _ptr += topic_length
+
+    if with_message_id:
+        message_id_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+        _ptr += 4
+        message_id = str(data[_ptr : _ptr + message_id_length], "utf-8")
+        _ptr += message_id_length
+    else:
+        message_id = ""
+
+    producer_name_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+    _ptr += 4
+    producer_name = str(data[_ptr : _ptr + producer_name_length], "utf-8")
+    _ptr += producer_name_length
+    producer_host_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+    _ptr += 4
+    producer_host = str(data[_ptr : _ptr + producer_host_length], "utf-8")
+    _ptr += producer_host_length
+    producer_port = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+    _ptr += 4
+    transaction_payload_size = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+    _ptr += 4
+
+    transaction_data = data[_ptr : _ptr + transaction_payload_size]
+    _ptr += transaction_payload_size
+
+    crc = crc32(data[start:_ptr])
+    stored_crc = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
+    _ptr += 4
+    return (
+        crc == stored_crc,
+        _ptr,
+        TransactionLog(
+            TransactionLogHeader(
+                timestamp,
+                topic,
+                message_id,
+                Server(producer_name, producer_host, producer_port),
+                transaction_payload_size,
+            ),
+            transaction_data,
+        ),
+    )
 
-        for _ in range(payload_size):
-            start = ptr
 
-            def _parse(with_message_id: bool):
-                nonlocal ptr
-                _ptr = ptr
-                timestamp = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
-                _ptr += 4
+def _parse_record_v2(data: bytes | memoryview, ptr: int, dictionary: "SegmentDictionary"):
+    """Parse one v2 record at ptr, returns (crc_ok, end_ptr, transaction)
+
+    end_ptr is exact as soon as the fixed header is readable, even when the
+    dictionary cannot resolve the record.
+    """
+    if ptr + RECORD_V2.size > len(data):
+        return False, ptr + RECORD_V2.size + 4, None
+    (
+        _,
+        flags,
+        topic_ref,
+        producer_ref,
+        _,
+        timestamp,
+        raw_message_id,
+        message_id_length,
+        payload_size,
+    ) = RECORD_V2.unpack_from(data, ptr)
+    _ptr = ptr + RECORD_V2.size
+    end = _ptr + message_id_length + payload_size + 4
+    if end > len(data):
+        return False, end, None
+
+    if flags & FLAG_UUID_MESSAGE_ID:
+        message_id = _uuid_to_str(raw_message_id)
+    else:
+        message_id = str(data[_ptr : _ptr + message_id_length], "utf-8")
+    _ptr += message_id_length
+    transaction_data = data[_ptr : _ptr + payload_size]
+    _ptr += payload_size
+
+    crc = crc32(data[ptr:_ptr])
+    stored_crc = int.from_bytes(data[_ptr:end], byteorder="big")
+    try:
+        topic = dictionary.topics[topic_ref]
+        producer = dictionary.producers[producer_ref]
+    except IndexError:
+        return False, end, None
+    return (
+        crc == stored_crc,
+        end,
+        TransactionLog(
+            TransactionLogHeader(
+                timestamp, topic, message_id, producer, payload_size, flags >> PRIORITY_SHIFT
+            ),
+            transaction_data,
+        ),
+    )
 
-                topic_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
-                _ptr += 4
 
-                topic = data[_ptr : _ptr + topic_length].decode("utf-8")
-                _ptr += topic_length
+def _decode_v1_entry(data: bytes | memoryview, ptr: int, complete: bool = True):
+    """Decode the v1 record at ptr, returns (end_ptr, [(crc_ok, transaction)])
+
+    The record is tried with message_id first, then in the legacy layout
+    without it. When data may still grow (complete is False) and either
+    attempt ran past it, the larger end is returned so the caller reads more.
+    """
+    ok, end, transaction = _parse_record(data, ptr, True)
+    if ok:
+        return end, [(ok, transaction)]
+    # fallback to legacy format (no message_id)
+    ok, legacy_end, transaction = _parse_record(data, ptr, False)
+    if ok or complete or max(end, legacy_end) <= len(data):
+        return legacy_end, [(ok, transaction)]
+    return max(end, legacy_end), [(False, None)]
+
+
+def _decode_v2_entry(
+    data: bytes | memoryview, ptr: int, dictionary: "SegmentDictionary", complete: bool = True
+):
+    """Decode the v2 record or compressed block at ptr, returns (end_ptr, [(crc_ok, transaction)])
+
+    A block is decompressed once and yields every record in it.
+    """
+    if ptr >= len(data) or data[ptr] != KIND_BLOCK:
+        ok, end, transaction = _parse_record_v2(data, ptr, dictionary)
+        return end, [(ok, transaction)]
+
+    if ptr + BLOCK_V2.size > len(data):
+        return ptr + BLOCK_V2.size + 4, [(False, None)]
+    _, codec, count, _, raw_size, compressed_size = BLOCK_V2.unpack_from(data, ptr)
+    end = ptr + BLOCK_V2.size + compressed_size + 4
+    if end > len(data):
+        return end, [(False, None)] * count
+    if crc32(data[ptr : end - 4]) != int.from_bytes(data[end - 4 : end], "big"):
+        return end, [(False, None)] * count
+    raw = _decompress(codec, data[ptr + BLOCK_V2.size : end - 4])
+    if len(raw) != raw_size:
+        return end, [(False, None)] * count
+    decode = partial(_decode_v2_entry, dictionary=dictionary)
+    return end, [(ok, t) for _, _, ok, t in _scan_entries(raw, 0, count, decode)]
+
+
+def _scan_entries(data: bytes | memoryview, ptr: int, count: int, decode, skip: int = 0):
+    """Yield (start, end, crc_ok, transaction) for count records from ptr
+
+    decode turns the entry at ptr (a record, or a block of records) into
+    (end_ptr, items). Records of a block share the block start and end.
+    skip drops records at the start of the first entry.
+    """
+    remaining = count
+    while remaining > 0:
+        start = ptr
+        ptr, items = decode(data, start)
+        for ok, transaction in items[skip : skip + remaining]:
+            yield start, ptr, ok, transaction
+            remaining -= 1
+        skip = 0
+
+
+def _scan_records(data: bytes | memoryview, ptr: int, count: int):
+    """Yield (start, end, crc_ok, transaction) for count v1 records from ptr"""
+    return _scan_entries(data, ptr, count, _decode_v1_entry)
+
+
+def message_key(message_id: str) -> int:
+    """64-bit hash of a message id, the key of the message id index"""
+    return int.from_bytes(
+        hashlib.blake2b(message_id.encode("utf-8"), digest_size=8).digest(), "big"
+    )
 
-                if with_message_id:
-                    message_id_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
-                    _ptr += 4
-                    message_id = data[_ptr : _ptr + message_id_length].decode("utf-8")
-                    _ptr += message_id_length
-                else:
-                    message_id = ""
-
-                producer_name_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
-                _ptr += 4
-                producer_name = data[_ptr : _ptr + producer_name_length].decode("utf-8")
-                _ptr += producer_name_length
-                producer_host_length = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
-                _ptr += 4
-                producer_host = data[_ptr : _ptr + producer_host_length].decode("utf-8")
-                _ptr += producer_host_length
-                producer_port = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
-                _ptr += 4
-                transaction_payload_size = int.from_bytes(
-                    data[_ptr : _ptr + 4], byteorder="big"
+
+def _compress(codec: int, data: bytes, level: int) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.compress(data, level)
+    if codec == CODEC_LZMA:
+        return lzma.compress(data, preset=level)
+    return data
+
+
+def _decompress(codec: int, data: bytes | memoryview) -> bytes:
+    if codec == CODEC_ZLIB:
+        return zlib.decompress(data)
+    if codec == CODEC_LZMA:
+        return lzma.decompress(bytes(data))
+    return bytes(data)
+
+
+def _message_id_to_bytes(message_id: str) -> tuple[int, bytes, bytes]:
+    """Flags, fixed uuid field and variable field for a message_id
+
+    Canonical (lowercase, hyphenated) uuid strings, which the server issues,
+    take the 16-byte field, anything else is stored verbatim.
+    """
+    if (
+        len(message_id) == 36
+        and message_id[8] == message_id[13] == message_id[18] == message_id[23] == "-"
+        and message_id == message_id.lower()
+    ):
+        try:
+            raw = bytes.fromhex(message_id.replace("-", ""))
+        except ValueError:
+            raw = b""
+        if len(raw) == 16:
+            return FLAG_UUID_MESSAGE_ID, raw, b""
+    return 0, bytes(16), message_id.encode("utf-8")
+
+
+def _uuid_to_str(raw: bytes) -> str:
+    """Canonical uuid string of 16 raw bytes"""
+    h = raw.hex()
+    return f"{h[0:8]}-{h[8:12]}-{h[12:16]}-{h[16:20]}-{h[20:32]}"
+
+
+class SegmentDictionary:
+    """Topic and producer identities interned per v2 segment
+
+    Records carry 16-bit references, the strings are stored once per segment
+    in the .dict file next to it.
+    """
+
+    def __init__(self):
+        self.topics: list[str] = []
+        self.producers: list[Server] = []
+        self._topic_refs: dict[str, int] = {}
+        self._producer_refs: dict[tuple[str, str, int], int] = {}
+
+    def load(self, data: bytes) -> int:
+        """Load persisted entries, returns the length of the valid prefix"""
+        ptr = 0
+        while ptr + DICTIONARY_ENTRY.size <= len(data):
+            kind, ref, length = DICTIONARY_ENTRY.unpack_from(data, ptr)
+            value = data[ptr + DICTIONARY_ENTRY.size : ptr + DICTIONARY_ENTRY.size + length]
+            if len(value) < length:
+                break
+            ptr += DICTIONARY_ENTRY.size + length
+            self._add(kind, ref, value)
+        return ptr
+
+    def _add(self, kind: int, ref: int, value: bytes):
+        if kind == DICT_TOPIC and ref == len(self.topics):
+            topic = value.decode("utf-8")
+            self._topic_refs[topic] = ref
+            self.topics.append(topic)
+        elif kind == DICT_PRODUCER and ref == len(self.producers):
+            host, ip, port = value.decode("utf-8").split("\0")
+            producer = Server(host, ip, int(port))
+            self._producer_refs[(producer.host, producer.ip, producer.port)] = ref
+            self.producers.append(producer)
+
+    def intern(self, header: "TransactionLogHeader") -> tuple[int, int, bytes]:
+        """References of the header identities, plus new entries to persist first"""
+        topic_ref, topic_entry = self._intern_topic(header.topic)
+        producer_ref, producer_entry = self._intern_producer(header.producer)
+        return topic_ref, producer_ref, topic_entry + producer_entry
+
+    def _intern_topic(self, topic: str) -> tuple[int, bytes]:
+        ref = self._topic_refs.get(topic)
+        if ref is not None:
+            return ref, b""
+        ref = len(self.topics)
+        value = topic.encode("utf-8")
+        self._add(DICT_TOPIC, ref, value)
+        return ref, DICTIONARY_ENTRY.pack(DICT_TOPIC, ref, len(value)) + value
+
+    def _intern_producer(self, producer: Server) -> tuple[int, bytes]:
+        ref = self._producer_refs.get((producer.host, producer.ip, producer.port))
+        if ref is not None:
+            return ref, b""
+        ref = len(self.producers)
+        value = f"{producer.host}\0{producer.ip}\0{producer.port}".encode("utf-8")
+        self._add(DICT_PRODUCER, ref, value)
+        return ref, DICTIONARY_ENTRY.pack(DICT_PRODUCER, ref, len(value)) + value
+
+    def extend(self, other: "SegmentDictionary") -> bytes:
+        """Intern every entry of other in order, returns the entries to persist"""
+        entries = b"".join(self._intern_topic(topic)[1] for topic in other.topics)
+        return entries + b"".join(self._intern_producer(p)[1] for p in other.producers)
+
+    def is_full(self) -> bool:
+        """Whether another identity may no longer fit a 16-bit reference"""
+        return max(len(self.topics), len(self.producers)) >= MAX_DICTIONARY_REFS
+
+
+class BinLogSegment:
+    """One segment file of a topic binlog, its offset index and its dictionary
+
+    A segment is named after the offset of its first record. New segments are
+    written in the v2 format (magic, payload_size header, fixed struct records
+    referencing the per-segment dictionary); v1 segments written before stay
+    readable. Files are opened lazily so sealed segments cost nothing until
+    they are read, and a sealed segment is only loaded: what reading it needs
+    stays in memory and its handles are closed again.
+    """
+
+    def __init__(self, path: str, base_offset: int):
+        self._path = path
+        self._base_offset = base_offset
+        self._file = None
+        self._index = None
+        self._dictionary_file = None
+        self._loaded = False
+        self._dictionary = SegmentDictionary()
+        self._version = 2
+        self._header_size = 8
+        self._payload_size = 0
+        self._end = 8
+        self._reader = None
+        self._reader_lock = threading.Lock()
+        self._blocks: OrderedDict[int, tuple] = OrderedDict()
+        self._blocks_lock = threading.Lock()
+        self._timestamp_index = None
+        self._timestamps: list[tuple[int, int]] = []
+        self._max_timestamp = None
+        self._message_index = None
+        self._message_ids: dict[int, list[tuple[int, int]]] | None = None
+        self._message_lock = threading.Lock()
+        # record offsets of a compacted segment, None while they are contiguous
+        self._sequences: list[int] | None = None
+        self._replaced = False
+
+    def open(self) -> Self:
+        """Open the segment, its index and its dictionary, creating them when missing"""
+        if self._file is not None:
+            return self
+        ensure_parent(self._path)
+        if not os.path.exists(self._path):
+            open(self._path, "wb").close()
+        self._file = open(self._path, "r+b")
+        header = self._file.read(8)
+        if len(header) < 4:
+            header = SEGMENT_MAGIC_V2 + (0).to_bytes(4, "big")
+            self._file.seek(0)
+            self._file.write(header)
+            self._file.flush()
+        if header[0:4] == SEGMENT_MAGIC_V2:
+            self._version, self._header_size = 2, 8
+        else:
+            self._version, self._header_size = 1, 4
+        self._payload_size = int.from_bytes(header[self._header_size - 4 : self._header_size], "big")
+
+        if self._version == 2:
+            dictionary_path = self.get_dictionary_path()
+            if not os.path.exists(dictionary_path):
+                open(dictionary_path, "wb").close()
+            self._dictionary_file = open(dictionary_path, "r+b")
+            # drop a torn dictionary entry
+            self._dictionary_file.truncate(self._dictionary.load(self._dictionary_file.read()))
+            self._dictionary_file.seek(0, os.SEEK_END)
+
+        index_path = self.get_index_path()
+        if not os.path.exists(index_path):
+            open(index_path, "wb").close()
+        self._index = open(index_path, "r+b")
+        self._end = self._load_index()
+
+        # drop a torn tail left behind by a crash between record and header write
+        self._file.truncate(self._end)
+        self._load_sequences()
+        self._load_timestamps()
+        return self
+
+    def load(self) -> Self:
+        """Load the header, dictionary and timestamp index, holding no handle
+
+        For sealed segments, which take no more appends. An open segment is
+        left open.
+        """
+        if self._file is None and not self._loaded:
+            self.open()
+            self.close()
+        return self
+
+    def _decode_entry(self, data: bytes | memoryview, ptr: int, complete: bool = True):
+        if self._version == 1:
+            return _decode_v1_entry(data, ptr, complete)
+        return _decode_v2_entry(data, ptr, self._dictionary, complete)
+
+    def _decode_entry_cached(self, data: bytes | memoryview, ptr: int):
+        """_decode_entry over the whole segment map, keeping recent blocks decoded"""
+        if self._version == 1 or data[ptr] != KIND_BLOCK:
+            return self._decode_entry(data, ptr)
+        with self._blocks_lock:
+            entry = self._blocks.get(ptr)
+            if entry is not None:
+                self._blocks.move_to_end(ptr)
+                return entry
+        entry = self._decode_entry(data, ptr)
+        if entry[0] <= len(data):
+            with self._blocks_lock:
+                self._blocks[ptr] = entry
+                if len(self._blocks) > BLOCK_CACHE_SIZE:
+                    self._blocks.popitem(last=False)
+        return entry
+
+    def _skip_into(self, data: bytes | memoryview, ptr: int, local_offset: int) -> int:
+        """Records of the block at ptr that precede local_offset"""
+        if self._version == 1 or ptr + BLOCK_V2.size > len(data) or data[ptr] != KIND_BLOCK:
+            return 0
+        first = BLOCK_V2.unpack_from(data, ptr)[3]
+        return max(self.offset_of(local_offset) - first, 0)
+
+    def _load_sequences(self):
+        """Read the record sequences when compaction left gaps in the segment
+
+        Records keep their sequence through compaction, so the first and last
+        one tell whether the offsets are still contiguous. Only then are all
+        of them read, from the entry headers.
+        """
+        self._sequences = None
+        if self._version == 1 or not self._payload_size:
+            return
+        first = self._entry_sequences(self.position_of(0))[0]
+        last = self._entry_sequences(self.position_of(self._payload_size - 1))[-1]
+        if first == self._base_offset and last == self._base_offset + self._payload_size - 1:
+            return
+        index = os.pread(self._index.fileno(), self._payload_size * INDEX_ENTRY_SIZE, 0)
+        positions = [
+            int.from_bytes(index[i : i + INDEX_ENTRY_SIZE], "big", signed=False)
+            for i in range(0, len(index), INDEX_ENTRY_SIZE)
+        ]
+        sequences = []
+        # records of a block share its position
+        for position in dict.fromkeys(positions):
+            sequences.extend(self._entry_sequences(position))
+        self._sequences = sequences
+
+    def _entry_sequences(self, position: int) -> list[int]:
+        """Sequences of the record, or of every record of the block, at position"""
+        head = os.pread(self._file.fileno(), RECORD_V2.size, position)
+        if head[:1] == bytes([KIND_BLOCK]):
+            _, _, count, first, _, _ = BLOCK_V2.unpack_from(head)
+            return list(range(first, first + count))
+        return [RECORD_V2.unpack_from(head)[4]]
+
+    def offset_of(self, local_offset: int) -> int:
+        """Log offset of the record at local_offset"""
+        if self._sequences is None:
+            return self._base_offset + local_offset
+        return self._sequences[local_offset]
+
+    def local_of(self, offset: int) -> int:
+        """Local offset of the first record at or after offset, may be negative"""
+        if self._sequences is None:
+            return offset - self._base_offset
+        return bisect.bisect_left(self._sequences, offset)
+
+    def _load_index(self) -> int:
+        """Validate the index file, rebuild it when stale, and return the log end"""
+        expected = self._payload_size * INDEX_ENTRY_SIZE
+        index_size = os.fstat(self._index.fileno()).st_size
+        if index_size >= expected:
+            if index_size > expected:
+                self._index.truncate(expected)
+            if self._payload_size == 0:
+                return self._header_size
+            last = self.position_of(self._payload_size - 1)
+            self._file.seek(last)
+            tail = self._file.read()
+            _, end, ok, _ = next(_scan_entries(tail, 0, 1, self._decode_entry))
+            if ok and end <= len(tail):
+                return last + end
+
+        # missing or stale, rebuild from the log
+        self._file.seek(0)
+        data = self._file.read()
+        self._index.seek(0)
+        self._index.truncate()
+        end = self._header_size
+        for start, end, _, _ in _scan_entries(
+            data, self._header_size, self._payload_size, self._decode_entry
+        ):
+            BinLog.append_index(self._index, start)
+        self._index.flush()
+        return end
+
+    def _load_timestamps(self):
+        """Load the sparse timestamp index, rebuilding it when missing"""
+        path = self.get_timestamp_index_path()
+        if not os.path.exists(path):
+            open(path, "wb").close()
+        self._timestamp_index = open(path, "r+b")
+        data = self._timestamp_index.read()
+        self._timestamps = []
+        for i in range(0, len(data) - TIMESTAMP_ENTRY.size + 1, TIMESTAMP_ENTRY.size):
+            entry = TIMESTAMP_ENTRY.unpack_from(data, i)
+            # entries past the header belong to a batch torn by a crash
+            if entry[1] >= self._payload_size:
+                break
+            self._timestamps.append(entry)
+        self._timestamp_index.truncate(len(self._timestamps) * TIMESTAMP_ENTRY.size)
+        self._timestamp_index.seek(0, os.SEEK_END)
+
+        if not self._timestamps and self._payload_size:
+            self._max_timestamp = 0
+            timestamps = [
+                transaction.header.timestamp if ok else 0
+                for ok, transaction in self.iter_chunked(
+                    0, self._payload_size, self._end, CHUNK_SIZE
                 )
-                _ptr += 4
-
-                transaction_data = data[_ptr : _ptr + transaction_payload_size]
-                _ptr += transaction_payload_size
-
-                crc = crc32(data[start:_ptr])
-                stored_crc = int.from_bytes(data[_ptr : _ptr + 4], byteorder="big")
-                _ptr += 4
-                return (
-                    crc == stored_crc,
-                    _ptr,
-                    TransactionLog(
-                        TransactionLogHeader(
-                            timestamp,
-                            topic,
-                            message_id,
-                            Server(producer_name, producer_host, producer_port),
-                            transaction_payload_size,
-                        ),
-                        transaction_data,
-                    ),
+            ]
+            self._timestamp_index.write(self._index_timestamps(0, timestamps))
+            self._timestamp_index.flush()
+
+    def _index_timestamps(self, local_offset: int, timestamps: list[int]) -> bytes:
+        """Track timestamps of records appended at local_offset, returns new index entries
+
+        An entry is kept every TIMESTAMP_INDEX_INTERVAL records with the largest
+        timestamp seen up to and including its record, so entries stay sorted
+        even if producers' clocks are not.
+        """
+        if self._max_timestamp is None:
+            self._max_timestamp = self._tail_max_timestamp()
+        entries = bytearray()
+        for timestamp in timestamps:
+            self._max_timestamp = max(self._max_timestamp, timestamp)
+            if (
+                not self._timestamps
+                or local_offset - self._timestamps[-1][1] >= TIMESTAMP_INDEX_INTERVAL
+            ):
+                self._timestamps.append((self._max_timestamp, local_offset))
+                entries += TIMESTAMP_ENTRY.pack(self._max_timestamp, local_offset)
+            local_offset += 1
+        return bytes(entries)
+
+    def _tail_max_timestamp(self) -> int:
+        """Largest timestamp from the last index entry to the end of the segment"""
+        if not self._timestamps:
+            return 0
+        timestamp, local_offset = self._timestamps[-1]
+        for ok, transaction in self.iter_chunked(
+            local_offset, self._payload_size, self._end, CHUNK_SIZE
+        ):
+            if ok:
+                timestamp = max(timestamp, transaction.header.timestamp)
+        return timestamp
+
+    def seek_timestamp(self, timestamp: int) -> int:
+        """Local offset to scan from for the first record at or after timestamp
+
+        Every record before the returned offset is older than timestamp.
+        """
+        i = bisect.bisect_left(self._timestamps, (timestamp,))
+        return self._timestamps[i - 1][1] if i > 0 else 0
+
+    def get_first_timestamp(self) -> int | None:
+        """Timestamp of the first record, None while the segment is empty"""
+        return self._timestamps[0][0] if self._timestamps else None
+
+    def load_message_ids(self):
+        """Load the append-order message id index of the active segment
+
+        Entries past the header are dropped, and the index is rebuilt from
+        the segment when it does not reach the last record.
+        """
+        path = self.get_message_index_path()
+        data = b""
+        entries = []
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            size = len(data) - len(data) % MESSAGE_INDEX_ENTRY.size
+            entries = list(MESSAGE_INDEX_ENTRY.iter_unpack(data[:size]))
+            while entries and entries[-1][1] >= self._payload_size:
+                entries.pop()
+        if self._payload_size and (not entries or entries[-1][1] != self._payload_size - 1):
+            entries = self._scan_message_ids()
+        if len(data) != len(entries) * MESSAGE_INDEX_ENTRY.size:
+            with open(path, "wb") as f:
+                f.write(b"".join(MESSAGE_INDEX_ENTRY.pack(*entry) for entry in entries))
+        self._message_index = open(path, "ab")
+        message_ids: dict[int, list[tuple[int, int]]] = {}
+        for key, local_offset, position in entries:
+            message_ids.setdefault(key, []).append((local_offset, position))
+        self._message_ids = message_ids
+
+    def _scan_message_ids(self) -> list[tuple[int, int, int]]:
+        """(key, local offset, position) of every readable record, read from the segment"""
+        self._file.seek(0)
+        data = self._file.read()
+        records = _scan_entries(data, self._header_size, self._payload_size, self._decode_entry)
+        return [
+            (message_key(transaction.header.message_id), local_offset, start)
+            for local_offset, (start, _, ok, transaction) in enumerate(records)
+            if ok
+        ]
+
+    def _index_message_ids(
+        self, records: list[bytes], counts: list[int], transactions: list[TransactionLog]
+    ) -> bytes:
+        """Track message ids of records appended at the log end, returns new index entries"""
+        entries = bytearray()
+        local_offset = self._payload_size
+        position = self._end
+        pending = iter(transactions)
+        for record, count in zip(records, counts):
+            for transaction in islice(pending, count):
+                key = message_key(transaction.header.message_id)
+                self._message_ids.setdefault(key, []).append((local_offset, position))
+                entries += MESSAGE_INDEX_ENTRY.pack(key, local_offset, position)
+                local_offset += 1
+            position += len(record)
+        return bytes(entries)
+
+    def seal(self):
+        """Write the message id index sorted by key once the segment takes no more appends
+
+        Lookups on sealed segments binary-search the sorted file instead of
+        keeping a map in memory.
+        """
+        with self._message_lock:
+            if os.path.exists(self.get_sorted_message_index_path()):
+                return
+            opened = self._file is None
+            self.open()
+            if self._message_ids is None:
+                self.load_message_ids()
+            entries = sorted(
+                (key, local_offset, position)
+                for key, items in self._message_ids.items()
+                for local_offset, position in items
+            )
+            tmp_path = f"{self.get_sorted_message_index_path()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(b"".join(MESSAGE_INDEX_ENTRY.pack(*entry) for entry in entries))
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.get_sorted_message_index_path())
+            self._message_index.close()
+            self._message_index = None
+            self._message_ids = None
+            Path(self.get_message_index_path()).unlink(missing_ok=True)
+            if opened:
+                self.close()
+
+    def find_message(self, key: int) -> list[tuple[int, int]]:
+        """(local offset, position) of the records whose message id hashes to key"""
+        message_ids = self._message_ids
+        if message_ids is not None:
+            return list(message_ids.get(key, ()))
+        if not os.path.exists(self.get_sorted_message_index_path()):
+            self.seal()
+        size = MESSAGE_INDEX_ENTRY.size
+        with open(self.get_sorted_message_index_path(), "rb") as f:
+            fd = f.fileno()
+            count = os.fstat(fd).st_size // size
+            lo, hi = 0, count
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if int.from_bytes(os.pread(fd, 8, mid * size), "big") < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+            found = []
+            while lo < count:
+                entry_key, local_offset, position = MESSAGE_INDEX_ENTRY.unpack(
+                    os.pread(fd, size, lo * size)
                 )
+                if entry_key != key:
+                    break
+                found.append((local_offset, position))
+                lo += 1
+            return found
+
+    def message_entries(self) -> list[tuple[int, int, int]]:
+        """Every (key, local offset, position) of the segment, in no particular order"""
+        message_ids = self._message_ids
+        if message_ids is not None:
+            return [
+                (key, local_offset, position)
+                for key, items in list(message_ids.items())
+                for local_offset, position in items
+            ]
+        if not os.path.exists(self.get_sorted_message_index_path()):
+            self.seal()
+        with open(self.get_sorted_message_index_path(), "rb") as f:
+            data = f.read()
+        data = data[: len(data) - len(data) % MESSAGE_INDEX_ENTRY.size]
+        return list(MESSAGE_INDEX_ENTRY.iter_unpack(data))
+
+    def read_record(self, local_offset: int, position: int, end: int):
+        """Decode the record at local_offset from the shared map, returns (crc_ok, transaction)"""
+        view = self.get_reader().view(end)
+        skip = self._skip_into(view, position, local_offset)
+        _, _, ok, transaction = next(
+            _scan_entries(view, position, 1, self._decode_entry_cached, skip)
+        )
+        return ok, transaction
+
+    def encode(self, transaction: TransactionLog, sequence: int) -> tuple[bytes, bytes]:
+        """Encode a v2 record, returns (new dictionary entries, record)"""
+        header = transaction.header
+        topic_ref, producer_ref, entries = self._dictionary.intern(header)
+        flags, raw_message_id, message_id = _message_id_to_bytes(header.message_id)
+        flags |= (header.priority & MAX_PRIORITY) << PRIORITY_SHIFT
+        head = RECORD_V2.pack(
+            KIND_MESSAGE,
+            flags,
+            topic_ref,
+            producer_ref,
+            sequence,
+            header.timestamp,
+            raw_message_id,
+            len(message_id),
+            len(transaction.data),
+        )
+        crc = zlib.crc32(transaction.data, zlib.crc32(message_id, zlib.crc32(head)))
+        return entries, b"".join((head, message_id, transaction.data, crc.to_bytes(4, "big")))
+
+    def compress(
+        self, records: list[bytes], first_sequence: int, config: CompressionConfig
+    ) -> tuple[list[bytes], list[int]]:
+        """Pack encoded records into compressed blocks, returns (entries, records per entry)
+
+        Records are written plain when the codec is none or compression does
+        not make the block smaller.
+        """
+        codec = CODECS[config.codec]
+        if codec == CODEC_NONE:
+            return records, [1] * len(records)
+        entries, counts = [], []
+        for i in range(0, len(records), MAX_BLOCK_RECORDS):
+            chunk = records[i : i + MAX_BLOCK_RECORDS]
+            raw = b"".join(chunk)
+            compressed = _compress(codec, raw, config.level)
+            if len(compressed) + BLOCK_V2.size + 4 >= len(raw):
+                entries.extend(chunk)
+                counts.extend([1] * len(chunk))
+                continue
+            head = BLOCK_V2.pack(
+                KIND_BLOCK, codec, len(chunk), first_sequence + i, len(raw), len(compressed)
+            )
+            crc = zlib.crc32(compressed, zlib.crc32(head))
+            entries.append(b"".join((head, compressed, crc.to_bytes(4, "big"))))
+            counts.append(len(chunk))
+        return entries, counts
+
+    def append(
+        self,
+        records: list[bytes],
+        dictionary_entries: bytes = b"",
+        fsync: bool = False,
+        counts: list[int] | None = None,
+        transactions: list[TransactionLog] | None = None,
+    ):
+        """Append encoded records or blocks with one data write and one index write
+
+        counts gives the number of records in each entry, every record of a
+        block is indexed at the block position. transactions, one per record,
+        feed the timestamp and message id indexes.
+        """
+        if counts is None:
+            counts = [1] * len(records)
+        if transactions and self._message_ids is None:
+            self.load_message_ids()
+        if dictionary_entries:
+            # dictionary first, records reference it
+            self._dictionary_file.write(dictionary_entries)
+            self._dictionary_file.flush()
+            if fsync:
+                os.fsync(self._dictionary_file.fileno())
+        # records and index next, header last: a torn write leaves the
+        # header pointing at the last fully written record
+        positions = bytearray()
+        position = self._end
+        for record, count in zip(records, counts):
+            positions += position.to_bytes(INDEX_ENTRY_SIZE, "big", signed=False) * count
+            position += len(record)
+        self._file.seek(self._end)
+        self._file.write(b"".join(records))
+        self._index.seek(self._payload_size * INDEX_ENTRY_SIZE)
+        self._index.write(positions)
+        self._index.flush()
+        if transactions:
+            timestamps = [transaction.header.timestamp for transaction in transactions]
+            self._timestamp_index.write(self._index_timestamps(self._payload_size, timestamps))
+            self._timestamp_index.flush()
+            self._message_index.write(self._index_message_ids(records, counts, transactions))
+            self._message_index.flush()
+        self._end = position
+        self._payload_size += sum(counts)
+        self._file.seek(self._header_size - 4)
+        self._file.write(self._payload_size.to_bytes(4, "big"))
+        self._file.flush()
+        if fsync:
+            os.fsync(self._file.fileno())
+
+    def position_of(self, local_offset: int) -> int:
+        """Byte position of the record at local_offset, read from the index file"""
+        entry = os.pread(
+            self._index.fileno(), INDEX_ENTRY_SIZE, local_offset * INDEX_ENTRY_SIZE
+        )
+        return int.from_bytes(entry, "big", signed=False)
+
+    def read_position(self, local_offset: int) -> int:
+        """Byte position of the record at local_offset, through a private handle
+
+        Readers use their own handles so a concurrent retention delete cannot
+        pull the descriptor out from under them.
+        """
+        with open(self.get_index_path(), "rb") as index:
+            index.seek(local_offset * INDEX_ENTRY_SIZE)
+            return int.from_bytes(index.read(INDEX_ENTRY_SIZE), "big", signed=False)
+
+    def iter_mapped(self, local_offset: int, payload_size: int, end: int):
+        """Yield records from the shared memory map
+
+        Plain payloads are memoryview slices of the map. Records of compressed
+        blocks come from a small per-segment cache of decoded blocks, so each
+        block is decompressed once for all consumers.
+        """
+        position = self.read_position(local_offset)
+        view = self.get_reader().view(end)
+        skip = self._skip_into(view, position, local_offset)
+        for _, _, ok, transaction in _scan_entries(
+            view, position, payload_size - local_offset, self._decode_entry_cached, skip
+        ):
+            yield ok, transaction
+
+    def iter_chunked(
+        self, local_offset: int, payload_size: int, end: int, chunk_size: int
+    ):
+        """Yield records reading the file chunk_size bytes at a time
+
+        Only the current chunk (or one record or block, if larger) is held in
+        memory and payloads are owned bytes.
+        """
+        position = self.read_position(local_offset)
+        with open(self._path, "rb") as f:
+            f.seek(position)
+            buf = f.read(min(chunk_size, end - position))
+            available = position + len(buf)
+            ptr = 0
+            skip = self._skip_into(buf, ptr, local_offset)
+            remaining = payload_size - local_offset
+            while remaining > 0:
+                while True:
+                    entry_end, items = self._decode_entry(buf, ptr, available >= end)
+                    if entry_end <= len(buf) or available >= end:
+                        break
+                    # entry crosses the chunk boundary, refill
+                    more = f.read(min(max(chunk_size, entry_end - len(buf)), end - available))
+                    if not more:
+                        raise EOFError(f"{self._path} ends before {end}")
+                    available += len(more)
+                    buf = buf[ptr:] + more
+                    ptr = 0
+                ptr = entry_end
+                for ok, transaction in items[skip : skip + remaining]:
+                    yield ok, transaction
+                    remaining -= 1
+                skip = 0
+
+    def get_reader(self) -> "SegmentReader":
+        """Shared memory-mapped reader of the segment"""
+        with self._reader_lock:
+            if self._reader is None:
+                self._reader = SegmentReader(self._path)
+            return self._reader
+
+    def get_base_offset(self) -> int:
+        """Getter"""
+        return self._base_offset
 
-            ok, new_ptr, transaction = _parse(True)
-            if not ok:
-                # fallback to legacy format (no message_id)
-                ok, new_ptr, transaction = _parse(False)
+    def get_size(self) -> int:
+        """Getter"""
+        return self._payload_size
 
-            ptr = new_ptr
-            if not ok:
+    def get_end(self) -> int:
+        """Getter"""
+        return self._end
+
+    def get_path(self) -> str:
+        """Getter"""
+        return self._path
+
+    def get_index_path(self) -> str:
+        """Index file path next to the segment"""
+        return f"{os.path.splitext(self._path)[0]}.idx"
+
+    def get_dictionary_path(self) -> str:
+        """Dictionary file path next to the segment"""
+        return f"{os.path.splitext(self._path)[0]}.dict"
+
+    def get_timestamp_index_path(self) -> str:
+        """Sparse timestamp index file path next to the segment"""
+        return f"{os.path.splitext(self._path)[0]}.tix"
+
+    def get_index_paths(self) -> list[str]:
+        """Every file derived from the segment data, rebuilt when missing"""
+        return [
+            self.get_index_path(),
+            self.get_timestamp_index_path(),
+            self.get_message_index_path(),
+            self.get_sorted_message_index_path(),
+        ]
+
+    def get_message_index_path(self) -> str:
+        """Append-order message id index of the active segment"""
+        return f"{os.path.splitext(self._path)[0]}.mid"
+
+    def get_sorted_message_index_path(self) -> str:
+        """Message id index of a sealed segment, sorted by key"""
+        return f"{os.path.splitext(self._path)[0]}.mis"
+
+    def get_dictionary(self) -> SegmentDictionary:
+        """Getter"""
+        return self._dictionary
+
+    def get_version(self) -> int:
+        """Getter"""
+        return self._version
+
+    def close(self):
+        """Close the underlying file handles, what was loaded stays in memory"""
+        if self._file is not None:
+            self._file.close()
+            self._index.close()
+            if self._dictionary_file is not None:
+                self._dictionary_file.close()
+            if self._timestamp_index is not None:
+                self._timestamp_index.close()
+            if self._message_index is not None:
+                self._message_index.close()
+            self._file = None
+            self._index = None
+            self._dictionary_file = None
+            self._timestamp_index = None
+            self._message_index = None
+            self._message_ids = None
+            self._loaded = True
+
+    def retire(self, tmp: "BinLogSegment"):
+        """Swap the files built in tmp in, this segment is not read any more
+
+        Readers still holding it can mix old and new files, so they check
+        is_replaced after every read and retry with the new segment.
+        """
+        self._replaced = True
+        swap_segment(self, tmp)
+        if self._reader is not None:
+            self._reader.release()
+        self._reader = None
+
+    def is_replaced(self) -> bool:
+        """Whether compaction swapped new files in since the segment was listed"""
+        return self._replaced
+
+    def delete(self):
+        """Close and remove the segment and its index"""
+        self.close()
+        # live memoryviews keep their mapping valid after the unlink
+        if self._reader is not None:
+            self._reader.release()
+        self._reader = None
+        Path(self._path).unlink(missing_ok=True)
+        Path(self.get_dictionary_path()).unlink(missing_ok=True)
+        for path in self.get_index_paths():
+            Path(path).unlink(missing_ok=True)
+
+
+class SegmentReader:
+    """Read-only memory map of a segment, shared by every consumer of it
+
+    The map only grows: when a reader asks for bytes past the mapped size the
+    file is mapped again. Older maps stay alive for as long as memoryviews
+    handed out from them do, so they are never closed explicitly. Only the
+    MAPPED_SEGMENTS most recently read segments keep their map, the others
+    map their file again on their next read.
+    """
+
+    _mapped: OrderedDict["SegmentReader", None] = OrderedDict()
+    _mapped_lock = threading.Lock()
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._view = memoryview(b"")
+
+    def view(self, end: int) -> memoryview:
+        """Zero-copy view of the first end bytes of the segment"""
+        with self._lock:
+            if end > len(self._view):
+                with open(self._path, "rb") as f:
+                    self._view = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            view = self._view[:end]
+        with SegmentReader._mapped_lock:
+            SegmentReader._mapped[self] = None
+            SegmentReader._mapped.move_to_end(self)
+            evicted = []
+            while len(SegmentReader._mapped) > MAPPED_SEGMENTS:
+                evicted.append(SegmentReader._mapped.popitem(last=False)[0])
+        for reader in evicted:
+            reader.release()
+        return view
+
+    def release(self):
+        """Drop the map, it is unmapped once no memoryview of it is left"""
+        with self._lock:
+            self._view = memoryview(b"")
+        with SegmentReader._mapped_lock:
+            SegmentReader._mapped.pop(self, None)
+
+
+class TailBuffer:
+    """Ring buffer of the most recent records of a topic
+
+    The writer fills it with every committed batch, so caught-up broadcast
+    consumers are served from memory. It holds at most max_records records
+    and max_bytes payload bytes, oldest records are evicted first.
+    """
+
+    def __init__(self, config: TailConfig):
+        self._config = config
+        self._lock = threading.Lock()
+        self._records: deque[TransactionLog] = deque()
+        self._first = 0
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+
+    def is_enabled(self) -> bool:
+        """Whether any limit is set"""
+        return bool(self._config.max_records or self._config.max_bytes)
+
+    def extend(self, first: int, transactions: list[TransactionLog]):
+        """Add committed records starting at offset first"""
+        if not self.is_enabled():
+            return
+        with self._lock:
+            if self._records and first != self._first + len(self._records):
+                # a failed batch left a gap, start over
+                self._records.clear()
+                self._bytes = 0
+            if not self._records:
+                self._first = first
+            for transaction in transactions:
+                self._records.append(transaction)
+                self._bytes += len(transaction.data)
+            max_records, max_bytes = self._config.max_records, self._config.max_bytes
+            while self._records and (
+                (max_records and len(self._records) > max_records)
+                or (max_bytes and self._bytes > max_bytes)
+            ):
+                self._bytes -= len(self._records.popleft().data)
+                self._first += 1
+
+    def read(self, offset: int) -> list[tuple[int, TransactionLog]] | None:
+        """(offset, transaction) from offset to the newest record, None when offset is older"""
+        with self._lock:
+            if not self._records or offset < self._first:
+                self._misses += 1
+                return None
+            self._hits += 1
+            start = offset - self._first
+            return [
+                (self._first + start + i, transaction)
+                for i, transaction in enumerate(islice(self._records, start, None))
+            ]
+
+    def get_stats(self) -> dict:
+        """Hit and miss counters with the current fill"""
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "records": len(self._records),
+                "bytes": self._bytes,
+                "first_offset": self._first,
+            }
+
+
+class BinLogWriter:
+    """Persistent appender for a single topic binlog
+
+    The topic log is split into rolling segments. The writer keeps the active
+    segment open with its record count in memory, so an append writes only
+    the new record and patches the payload_size header in place. Sealed
+    segments are tracked in a small in-memory table ordered by base offset,
+    and whole segments are dropped by the retention policy.
+    """
+
+    def __init__(
+        self,
+        topic: str,
+        config: SegmentConfig,
+        group_commit: GroupCommitConfig,
+        compression: CompressionConfig,
+        tail: TailConfig | None = None,
+    ):
+        self._topic = topic
+        self._config = config
+        self._compression = compression
+        self._tail = TailBuffer(tail or TailConfig())
+        self._lock = threading.Lock()
+        self._next_retention_check = 0.0
+
+        directory = os.path.dirname(get_topic_path(topic))
+        Path(directory).mkdir(parents=True, exist_ok=True)
+        _migrate_single_file_log(topic)
+
+        bases = sorted(
+            int(name[: -len(".blog")])
+            for name in os.listdir(directory)
+            if name.endswith(".blog") and name[: -len(".blog")].isdigit()
+        )
+        self._segments = [
+            BinLogSegment(get_segment_path(topic, base), base) for base in bases or [0]
+        ]
+        self._bases = [segment.get_base_offset() for segment in self._segments]
+        self._active = self._segments[-1].open()
+        with self._lock:
+            if self._active.get_version() == 1:
+                # v1 segments are sealed, new records always go to a v2 segment
+                self._roll()
+            else:
+                self._active.load_message_ids()
+            self._enforce_retention()
+        # next offset of the committed log, what streaming readers wait on
+        self._committed = threading.Condition()
+        self._committed_size = self._active.get_base_offset() + self._active.get_size()
+
+        self._committer = GroupCommitter(self, group_commit)
+        self._committer.start()
+
+    def append(self, transaction: TransactionLog) -> int:
+        """Append one transaction and return its offset once it is committed"""
+        return self._committer.submit(transaction)
+
+    def write_batch(self, transactions: list[TransactionLog], fsync: bool) -> int:
+        """Encode and write a batch of transactions, rolling segments as needed
+
+        Returns the offset of the first record. Each segment touched gets one
+        data write, one index write and at most one fsync.
+        """
+        with self._lock:
+            first = self._active.get_base_offset() + self._active.get_size()
+            run: list[bytes] = []
+            run_entries = b""
+            run_bytes = 0
+            run_transactions: list[TransactionLog] = []
+            for transaction in transactions:
+                sequence = self._active.get_base_offset() + self._active.get_size() + len(run)
+                entries, record = self._active.encode(transaction, sequence)
+                if self._should_roll(run, run_bytes + len(record)):
+                    if run:
+                        self._append_run(run, run_entries, fsync, run_transactions)
+                    run, run_entries, run_bytes, run_transactions = [], b"", 0, []
+                    self._roll()
+                    entries, record = self._active.encode(transaction, sequence)
+                run.append(record)
+                run_entries += entries
+                run_bytes += len(record)
+                run_transactions.append(transaction)
+            if run:
+                self._append_run(run, run_entries, fsync, run_transactions)
+            self._tail.extend(first, transactions)
+            with self._committed:
+                self._committed_size = first + len(transactions)
+                self._committed.notify_all()
+            if time.monotonic() >= self._next_retention_check:
+                self._enforce_retention()
+            return first
+
+    def _append_run(
+        self,
+        run: list[bytes],
+        dictionary_entries: bytes,
+        fsync: bool,
+        transactions: list[TransactionLog],
+    ):
+        """Write records to the active segment, compressed when configured"""
+        first = self._active.get_base_offset() + self._active.get_size()
+        entries, counts = self._active.compress(run, first, self._compression)
+        self._active.append(entries, dictionary_entries, fsync, counts, transactions)
+
+    def _should_roll(self, run: list[bytes], run_bytes: int) -> bool:
+        """Whether the active segment is full, counting the records not yet written"""
+        size = self._active.get_size() + len(run)
+        if size == 0:
+            return False
+        if self._active.get_dictionary().is_full():
+            return True
+        if self._config.max_records and size >= self._config.max_records:
+            return True
+        if self._config.max_bytes and self._active.get_end() + run_bytes > self._config.max_bytes:
+            return True
+        return False
+
+    def _roll(self):
+        """Seal the active segment and start a new one at the next offset"""
+        base = self._active.get_base_offset() + self._active.get_size()
+        segment = BinLogSegment(get_segment_path(self._topic, base), base).open()
+        segment.load_message_ids()
+        self._active.seal()
+        self._active.close()
+        self._segments.append(segment)
+        self._bases.append(base)
+        self._active = segment
+        self._enforce_retention()
+
+    def _enforce_retention(self):
+        """Delete the oldest sealed segments beyond the age or size limit"""
+        self._next_retention_check = time.monotonic() + RETENTION_CHECK_INTERVAL_S
+        if not self._config.retention_ms and not self._config.retention_bytes:
+            return
+        now = time.time()
+        sizes = [os.path.getsize(segment.get_path()) for segment in self._segments]
+        total = sum(sizes)
+        while len(self._segments) > 1:
+            oldest = self._segments[0]
+            age_ms = (now - os.path.getmtime(oldest.get_path())) * 1000
+            expired = self._config.retention_ms and age_ms > self._config.retention_ms
+            oversize = self._config.retention_bytes and total > self._config.retention_bytes
+            if not (expired or oversize):
+                break
+            total -= sizes.pop(0)
+            oldest.delete()
+            self._segments.pop(0)
+            self._bases.pop(0)
+
+    def segments_from(self, offset: int) -> list[tuple[BinLogSegment, int, int, int]]:
+        """Committed (segment, local_offset, payload_size, end) covering offset onwards"""
+        with self._lock:
+            i = max(bisect.bisect_right(self._bases, offset) - 1, 0)
+            ret = []
+            for segment in self._segments[i:]:
+                segment.load()
+                local = max(segment.local_of(offset), 0)
+                if local < segment.get_size():
+                    ret.append((segment, local, segment.get_size(), segment.get_end()))
+            return ret
+
+    def compact(
+        self, acked: set[str], min_dead_ratio: float, before: int | None = None
+    ) -> int:
+        """Drop acked messages from sealed segments, one segment at a time
+
+        A segment is rewritten when at least min_dead_ratio of its records are
+        acked. The copy is built without the writer lock and only the file swap
+        takes it, so producers appending to the active segment barely wait.
+        With before, only segments ending at or below that offset are touched,
+        so the tail a queue checkpoint replays keeps its offsets. Returns the
+        number of records dropped.
+        """
+        acked_keys = {message_key(message_id) for message_id in acked}
+        dropped = 0
+        with self._lock:
+            sealed = list(zip(self._segments[:-1], self._bases[1:]))
+        for segment, end_offset in sealed:
+            if before is not None and end_offset > before:
+                break
+            try:
+                dropped += self._compact_segment(segment, acked, acked_keys, min_dead_ratio)
+            except FileNotFoundError:
+                # removed by retention meanwhile
                 continue
-            blog.append(transaction)
-        # read payloads
-        assert blog.get_size() == payload_size
+        return dropped
+
+    def _compact_segment(
+        self,
+        segment: BinLogSegment,
+        acked: set[str],
+        acked_keys: set[int],
+        min_dead_ratio: float,
+    ) -> int:
+        with self._lock:
+            size = segment.load().get_size()
+        dead = sum(1 for key, _, _ in segment.message_entries() if key in acked_keys)
+        if not dead or dead < size * min_dead_ratio:
+            return 0
+
+        kept, sequences = [], []
+        base = segment.get_base_offset()
+        records = segment.iter_chunked(0, size, segment.get_end(), CHUNK_SIZE)
+        for local_offset, (ok, transaction) in enumerate(records):
+            if ok and transaction.header.message_id not in acked:
+                kept.append(transaction)
+                sequences.append(segment.offset_of(local_offset))
+        tmp = build_segment(self._topic, segment, kept, sequences, sealed=True) if kept else None
+
+        with self._lock:
+            if segment not in self._segments or segment is self._active:
+                if tmp is not None:
+                    discard_segment(tmp)
+                return 0
+            i = self._segments.index(segment)
+            segment.close()
+            if tmp is None:
+                # nothing left, the offsets of the range are simply skipped
+                del self._segments[i]
+                del self._bases[i]
+                segment.delete()
+            else:
+                segment.retire(tmp)
+                self._segments[i] = BinLogSegment(segment.get_path(), base)
+        return size - len(kept)
+
+    def seek_timestamp(self, timestamp: int) -> int:
+        """Offset to scan from for the first record at or after timestamp
+
+        Picks the newest segment whose first record is older than timestamp
+        and binary-searches its sparse timestamp index.
+        """
+        with self._lock:
+            for segment in reversed(self._segments):
+                first = segment.load().get_first_timestamp()
+                if first is not None and first < timestamp:
+                    return segment.offset_of(segment.seek_timestamp(timestamp))
+            return self._bases[0]
+
+    def get_base_offset(self) -> int:
+        """First offset still retained"""
+        with self._lock:
+            return self._bases[0]
 
-        # cut offset
-        if offset == 0:
-            return blog
+    def get_size(self) -> int:
+        """Next offset to be written"""
+        with self._lock:
+            return self._active.get_base_offset() + self._active.get_size()
 
-        return blog.cut(offset)
+    def get_tail(self) -> TailBuffer:
+        """Getter"""
+        return self._tail
+
+    def wait_committed(self, offset: int, timeout: float) -> bool:
+        """Block until the record at offset is committed, False once timeout passes"""
+        with self._committed:
+            return self._committed.wait_for(lambda: self._committed_size > offset, timeout)
+
+    def get_segments(self) -> list[BinLogSegment]:
+        """Segment table snapshot"""
+        with self._lock:
+            return list(self._segments)
+
+    def close(self):
+        """Commit what is pending, then close the underlying file handles"""
+        self._committer.stop()
+        with self._lock:
+            for segment in self._segments:
+                segment.close()
+
+
+class PendingAppend:
+    """A transaction waiting in the group-commit queue"""
+
+    def __init__(self, transaction: TransactionLog):
+        self.transaction = transaction
+        self.offset = -1
+        self.error: Exception | None = None
+        self.done = threading.Event()
+
+
+class GroupCommitter(threading.Thread):
+    """Group-commit stage of a topic writer
+
+    Producers queue their records and block. The thread collects whatever
+    arrives within the batch window, up to the maximum batch size, writes it
+    with one write and one fsync, and then releases every waiting producer.
+    """
+
+    def __init__(self, writer: BinLogWriter, config: GroupCommitConfig):
+        super().__init__(daemon=True)
+        self._writer = writer
+        self._config = config
+        self._cond = threading.Condition()
+        self._pending: deque[PendingAppend] = deque()
+        self._stop_event = threading.Event()
+
+    def submit(self, transaction: TransactionLog) -> int:
+        """Queue a transaction and wait until it is committed, returns its offset"""
+        item = PendingAppend(transaction)
+        with self._cond:
+            if self._stop_event.is_set():
+                raise RuntimeError("binlog writer is closed")
+            self._pending.append(item)
+            self._cond.notify()
+        item.done.wait()
+        if item.error is not None:
+            raise item.error
+        return item.offset
+
+    def run(self):
+        window_s = self._config.window_ms / 1000
+        max_batch = max(self._config.max_batch, 1)
+        while True:
+            with self._cond:
+                while not self._pending and not self._stop_event.is_set():
+                    self._cond.wait()
+                if not self._pending:
+                    return
+                deadline = time.monotonic() + window_s
+                while len(self._pending) < max_batch and not self._stop_event.is_set():
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+                batch = [self._pending.popleft() for _ in range(min(max_batch, len(self._pending)))]
+            self._commit(batch)
+
+    def _commit(self, batch: list[PendingAppend]):
+        first = self._writer.get_size()
+        try:
+            first = self._writer.write_batch(
+                [item.transaction for item in batch], self._config.fsync
+            )
+        except Exception as e:  # pylint: disable=broad-except
+            SLOG.error(e)
+            # records written before the failure keep their offsets, the
+            # producers are told which, so queue topics can move past them
+            written = self._writer.get_size() - first
+            for i, item in enumerate(batch):
+                item.error = BinLogAppendException(e, first + i) if i < written else e
+                item.done.set()
+            return
+        for i, item in enumerate(batch):
+            item.offset = first + i
+            item.done.set()
+
+    def stop(self):
+        """Drain the queue and stop the thread"""
+        with self._cond:
+            self._stop_event.set()
+            self._cond.notify()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+
+_configs: dict[str, SegmentConfig] = {}
+_compressions: dict[str, CompressionConfig] = {}
+_tails: dict[str, TailConfig] = {}
+_group_commit = GroupCommitConfig()
+_writers: dict[str, BinLogWriter] = {}
+_writers_lock = threading.Lock()
+
+
+def configure_topic(
+    topic: str,
+    config: SegmentConfig,
+    compression: CompressionConfig | None = None,
+    tail: TailConfig | None = None,
+):
+    """Set the segment, compression and tail buffer policy used when the topic writer is opened"""
+    with _writers_lock:
+        _configs[topic] = config
+        _compressions[topic] = compression or CompressionConfig()
+        _tails[topic] = tail or TailConfig()
+
+
+def configure_group_commit(config: GroupCommitConfig):
+    """Set the group-commit policy used by writers opened afterwards"""
+    global _group_commit  # pylint: disable=global-statement
+    with _writers_lock:
+        _group_commit = config
+
+
+def get_writer(topic: str) -> BinLogWriter:
+    """Return the shared writer of the topic, opening it on first use"""
+    with _writers_lock:
+        writer = _writers.get(topic)
+        if writer is None:
+            writer = BinLogWriter(
+                topic,
+                _configs.get(topic, SegmentConfig()),
+                _group_commit,
+                _compressions.get(topic, CompressionConfig()),
+                _tails.get(topic, TailConfig()),
+            )
+            _writers[topic] = writer
+        return writer
+
+
+def _drop_writer(topic: str):
+    """Close and forget the writer of the topic"""
+    with _writers_lock:
+        writer = _writers.pop(topic, None)
+    if writer is not None:
+        writer.close()
+
+
+def close_writers():
+    """Close every open writer"""
+    with _writers_lock:
+        for writer in _writers.values():
+            writer.close()
+        _writers.clear()
+
+
+def _migrate_single_file_log(topic: str):
+    """Turn a pre-segment <topic>.blog into the first segment"""
+    legacy = get_topic_path(topic)
+    if not os.path.exists(legacy):
+        return
+    first = get_segment_path(topic, 0)
+    if os.path.exists(first):
+        return
+    os.replace(legacy, first)
+    legacy_index = get_topic_path(topic, "idx")
+    if os.path.exists(legacy_index):
+        os.replace(legacy_index, get_segment_path(topic, 0, "idx"))
 
 
 def crc32(data: bytes) -> int:
@@ -238,22 +1762,289 @@ def crc32(data: bytes) -> int:
     return zlib.crc32(data) & 0xFFFFFFFF
 
 
+def iter_bin(
+    topic: str, start_offset: int = 0, zero_copy: bool = False, chunk_size: int = CHUNK_SIZE
+):
+    """Yield (offset, transaction) from start_offset to the committed end of the log
+
+    Records are decoded one at a time with the same CRC checks and legacy
+    fallback as BinLog.decode, and records failing both are skipped. By
+    default segments are read chunk_size bytes at a time so memory stays
+    bounded; with zero_copy the shared segment maps are walked instead and
+    payloads are memoryview slices of them. Offsets dropped by retention
+    start at the oldest segment. A segment compacted while it is read is
+    read again from the new files, from the next offset on.
+    """
+    offset = max(start_offset, 0)
+    replaced = True
+    while replaced:
+        replaced = False
+        for segment, local, payload_size, end in get_writer(topic).segments_from(offset):
+            try:
+                if zero_copy:
+                    records = segment.iter_mapped(local, payload_size, end)
+                else:
+                    records = segment.iter_chunked(local, payload_size, end, chunk_size)
+                for local_offset, (ok, transaction) in enumerate(records, local):
+                    if segment.is_replaced():
+                        break
+                    offset = segment.offset_of(local_offset) + 1
+                    if ok:
+                        yield offset - 1, transaction
+            except FileNotFoundError:
+                # removed by retention while reading
+                continue
+            except Exception:  # pylint: disable=broad-except
+                # what was read mixes the files from before and after a swap
+                if not segment.is_replaced():
+                    raise
+            if segment.is_replaced():
+                replaced = True
+                break
+
+
+def iter_tail(topic: str, start_offset: int = 0, zero_copy: bool = False):
+    """Like iter_bin, served from the topic's tail buffer when start_offset is inside it
+
+    Records committed after the buffer is read are left for the next call.
+    """
+    records = get_writer(topic).get_tail().read(max(start_offset, 0))
+    if records is None:
+        yield from iter_bin(topic, start_offset, zero_copy)
+        return
+    yield from records
+
+
+def read_tail(
+    topic: str, offset: int, max_messages: int = 0, zero_copy: bool = False
+) -> tuple[list[tuple[int, TransactionLog]], int]:
+    """Up to max_messages records from offset, read like iter_tail, and the offset to read next
+
+    The next offset steps over records failing their CRC check, so a reader
+    polling from it never stalls on them. 0 max_messages reads to the end.
+    """
+    end = get_writer(topic).get_size()
+    records = iter_tail(topic, offset, zero_copy)
+    if max_messages > 0:
+        records = islice(records, max_messages)
+    records = list(records)
+    if records:
+        return records, records[-1][0] + 1
+    return records, max(offset, end)
+
+
+def wait_bin(topic: str, offset: int, timeout: float) -> bool:
+    """Block until the topic has a record at offset, False once timeout passes"""
+    return get_writer(topic).wait_committed(offset, timeout)
+
+
+def get_tail_stats(topic: str) -> dict:
+    """Tail buffer hit and miss counters of the topic"""
+    return get_writer(topic).get_tail().get_stats()
+
+
+def find_offset(topic: str, timestamp: int) -> int:
+    """Offset of the first record with a timestamp at or after timestamp
+
+    The sparse timestamp index narrows the search down to about
+    TIMESTAMP_INDEX_INTERVAL records, which are then scanned. Returns the
+    next offset to be written when every record is older.
+    """
+    offset = get_writer(topic).seek_timestamp(timestamp)
+    for record_offset, transaction in iter_bin(topic, offset, zero_copy=True):
+        if transaction.header.timestamp >= timestamp:
+            return record_offset
+        offset = record_offset + 1
+    return offset
+
+
+def get_message(topic: str, message_id: str) -> tuple[int, TransactionLog] | None:
+    """Look a message up by message_id, returns (offset, transaction) or None
+
+    Segments are searched newest first through their message id index, so
+    only matching records are read. The lookup starts over when a segment is
+    compacted while it is searched.
+    """
+    key = message_key(message_id)
+    replaced = True
+    while replaced:
+        replaced = False
+        for segment, _, payload_size, end in reversed(get_writer(topic).segments_from(0)):
+            try:
+                found = None
+                for local_offset, position in segment.find_message(key):
+                    if local_offset >= payload_size:
+                        continue
+                    ok, transaction = segment.read_record(local_offset, position, end)
+                    if ok and transaction.header.message_id == message_id:
+                        found = segment.offset_of(local_offset), transaction
+                        break
+            except FileNotFoundError:
+                # removed by retention while reading
+                continue
+            except Exception:  # pylint: disable=broad-except
+                # what was read mixes the files from before and after a swap
+                if not segment.is_replaced():
+                    raise
+            if segment.is_replaced():
+                replaced = True
+                break
+            if found is not None:
+                return found
+    return None
+
+
+def iter_live(topic: str, acked: set[str]):
+    """Yield (offset, transaction) of every message whose id is not in acked
+
+    Recovery walks the message id indexes instead of the log and reads only
+    the remaining records, in offset order. Payloads are owned bytes.
+    """
+    acked_keys = {message_key(message_id) for message_id in acked}
+    yield from _iter_indexed(topic, lambda key: key not in acked_keys)
+
+
+def iter_messages(topic: str, message_ids: set[str]):
+    """Yield (offset, transaction) of the messages whose id is in message_ids
+
+    Like iter_live, only the matching records are read, in offset order.
+    Messages dropped by retention are simply missing.
+    """
+    keys = {message_key(message_id) for message_id in message_ids}
+    for offset, transaction in _iter_indexed(topic, keys.__contains__):
+        if transaction.header.message_id in message_ids:
+            yield offset, transaction
+
+
+def _iter_indexed(topic: str, wanted):
+    """Read the records whose message id key passes wanted, through the message id indexes
+
+    Like iter_bin, a segment compacted while it is read is read again from
+    the next offset on.
+    """
+    offset = 0
+    replaced = True
+    while replaced:
+        replaced = False
+        for segment, local, payload_size, end in get_writer(topic).segments_from(offset):
+            try:
+                records = sorted(
+                    (local_offset, position)
+                    for key, local_offset, position in segment.message_entries()
+                    if wanted(key) and local <= local_offset < payload_size
+                )
+                for local_offset, position in records:
+                    ok, transaction = segment.read_record(local_offset, position, end)
+                    if segment.is_replaced():
+                        break
+                    offset = segment.offset_of(local_offset) + 1
+                    if ok:
+                        transaction = TransactionLog(transaction.header, bytes(transaction.data))
+                        yield offset - 1, transaction
+            except FileNotFoundError:
+                # removed by retention while reading
+                continue
+            except Exception:  # pylint: disable=broad-except
+                # what was read mixes the files from before and after a swap
+                if not segment.is_replaced():
+                    raise
+            if segment.is_replaced():
+                replaced = True
+                break
+
+
 def read_bin(topic: str, offset: int = 0) -> BinLog:
-    """Read bytes from the log file and convert it to DTO"""
-    return BinLog.decode(read_bytes_or_create(get_topic_path(topic)), offset)
+    """Read the log from offset and convert it to DTO
 
+    The segment table and the segment index give the byte position of the
+    offset, so only the records from offset to the end of the log are
+    decoded. Payloads are zero-copy memoryviews over the shared segment maps.
+    """
+    blog = BinLog()
+    blog.set_offset(max(offset, 0))
+    for record_offset, transaction in iter_bin(topic, offset, zero_copy=True):
+        if blog.get_size() == 0:
+            blog.set_offset(record_offset)
+        blog.append(transaction)
+    return blog
 
-def append_bin(topic: str, data: TransactionLog):
-    """Append transaction data and write"""
-    binlog = read_bin(topic)
-    binlog.append_atomic(data)
+
+def append_bin(topic: str, data: TransactionLog) -> int:
+    """Append transaction data and write, returns the offset of the record"""
+    return get_writer(topic).append(data)
 
 
 def append_bin_reserialize_all(topic: str, data: TransactionLog):
-    """Append transaction data and write"""
-    binlog = read_bin(topic)
-    binlog.append(data)
-    write_bytes(get_topic_path(topic), binlog.serialize_all())
+    """Append transaction data and rewrite the active segment"""
+    writer = get_writer(topic)
+    segment = writer.get_segments()[-1]
+    transactions = [t for _, t in iter_bin(topic, segment.get_base_offset())]
+    transactions.append(data)
+    _drop_writer(topic)
+    rewrite_segment(topic, segment, transactions)
+
+
+def rewrite_segment(
+    topic: str,
+    segment: BinLogSegment,
+    transactions: list[TransactionLog],
+    sequences: list[int] | None = None,
+):
+    """Rewrite a closed segment in the v2 format and swap it in"""
+    swap_segment(segment, build_segment(topic, segment, transactions, sequences))
+
+
+def build_segment(
+    topic: str,
+    segment: BinLogSegment,
+    transactions: list[TransactionLog],
+    sequences: list[int] | None = None,
+    sealed: bool = False,
+) -> BinLogSegment:
+    """Write transactions to a temporary v2 segment that can replace segment
+
+    The new dictionary starts as a copy of the old one so references stay
+    valid whichever files a crash leaves swapped. Records keep the given
+    sequences, so compacted segments still tell their original offsets.
+    """
+    base = segment.get_base_offset()
+    if sequences is None:
+        sequences = list(range(base, base + len(transactions)))
+    tmp = BinLogSegment(get_segment_path(topic, base, "tmp.blog"), base)
+    for path in (tmp.get_path(), tmp.get_dictionary_path(), *tmp.get_index_paths()):
+        Path(path).unlink(missing_ok=True)
+    tmp.open()
+    entries = tmp.get_dictionary().extend(segment.load().get_dictionary())
+    records = []
+    for transaction, sequence in zip(transactions, sequences):
+        new_entries, record = tmp.encode(transaction, sequence)
+        entries += new_entries
+        records.append(record)
+    tmp.append(records, entries, fsync=True, transactions=transactions)
+    if sealed:
+        tmp.seal()
+    tmp.close()
+    return tmp
+
+
+def swap_segment(segment: BinLogSegment, tmp: BinLogSegment):
+    """Atomically replace the files of segment with the ones built in tmp
+
+    The stale indexes are removed before the data file is replaced and are
+    rebuilt if the swap is torn.
+    """
+    os.replace(tmp.get_dictionary_path(), segment.get_dictionary_path())
+    for path in segment.get_index_paths():
+        Path(path).unlink(missing_ok=True)
+    os.replace(tmp.get_path(), segment.get_path())
+    for source, target in zip(tmp.get_index_paths(), segment.get_index_paths()):
+        if os.path.exists(source):
+            os.replace(source, target)
+
+
+def discard_segment(tmp: BinLogSegment):
+    """Remove the files of a segment built but not swapped in"""
+    tmp.delete()
 
 
 def get_topic_path(topic: str, extension="blog"):
@@ -264,6 +2055,14 @@ def get_topic_path(topic: str, extension="blog"):
     )
 
 
+def get_segment_path(topic: str, base_offset: int, extension="blog"):
+    """Helper function to get a segment file, named after its base offset"""
+
+    return os.path.join(
+        os.path.dirname(get_topic_path(topic)), f"{base_offset:020d}.{extension}"
+    )
+
+
 if __name__ == "__main__":
 
     append_bin(
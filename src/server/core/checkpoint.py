@@ -0,0 +1,239 @@
+"""Queue-state checkpoints for fast restart
+
+A checkpoint holds the pending queue order and the unacked map of a queue
+topic together with the binlog offset and ack log byte position it covers.
+Recovery loads the newest valid checkpoint and replays only the log tail
+after those positions.
+"""
+
+import os
+import struct
+import zlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from server.system_logger import SLOG
+from .acklog import get_acklog_path, get_acklog_size
+
+# checkpoint header: magic, version, created_ms, binlog offset, ack log
+# position, crc32 of the ack log bytes just before that position, then the
+# pending, unacked, covered and delayed entry counts
+CHECKPOINT_MAGIC = b"SMQC"
+CHECKPOINT_VERSION = 2
+CHECKPOINT_HEADER = struct.Struct(">4sBQQQIIIII")
+# version 1 has no delayed entries
+CHECKPOINT_HEADER_V1 = struct.Struct(">4sBQQQIIII")
+
+# bytes of ack log before the covered position fingerprinted by a checkpoint,
+# a rewrite by compact_acklog changes them and invalidates the checkpoint
+ACKLOG_FINGERPRINT_SIZE = 64
+
+
+@dataclass
+class UnackedEntry:
+    message_id: str
+    consumer_id: str
+    deadline_ms: int
+
+
+@dataclass
+class DelayedEntry:
+    message_id: str
+    deliver_at_ms: int
+
+
+@dataclass
+class QueueCheckpoint:
+    """Queue state covering the binlog below binlog_offset and the ack log below acklog_position
+
+    covered lists the messages at or above binlog_offset whose state is
+    already in the checkpoint, produces that overtook an older one still in
+    flight. Replaying the tail skips them.
+    """
+
+    created_ms: int
+    binlog_offset: int
+    acklog_position: int
+    acklog_crc: int
+    pending: list[str] = field(default_factory=list)
+    unacked: list[UnackedEntry] = field(default_factory=list)
+    covered: list[str] = field(default_factory=list)
+    delayed: list[DelayedEntry] = field(default_factory=list)
+
+    def message_ids(self) -> set[str]:
+        """Every message id whose state the checkpoint holds"""
+        ids = set(self.pending)
+        ids.update(entry.message_id for entry in self.unacked)
+        ids.update(self.covered)
+        ids.update(entry.message_id for entry in self.delayed)
+        return ids
+
+
+def _pack_str(value: str) -> bytes:
+    raw = value.encode("utf-8")
+    return len(raw).to_bytes(4, "big", signed=False) + raw
+
+
+def _unpack_str(data: bytes, ptr: int) -> tuple[str, int]:
+    size = int.from_bytes(data[ptr : ptr + 4], "big", signed=False)
+    ptr += 4
+    if ptr + size > len(data):
+        raise ValueError("truncated checkpoint")
+    return data[ptr : ptr + size].decode("utf-8"), ptr + size
+
+
+def serialize_checkpoint(checkpoint: QueueCheckpoint) -> bytes:
+    parts = [
+        CHECKPOINT_HEADER.pack(
+            CHECKPOINT_MAGIC,
+            CHECKPOINT_VERSION,
+            checkpoint.created_ms,
+            checkpoint.binlog_offset,
+            checkpoint.acklog_position,
+            checkpoint.acklog_crc,
+            len(checkpoint.pending),
+            len(checkpoint.unacked),
+            len(checkpoint.covered),
+            len(checkpoint.delayed),
+        )
+    ]
+    parts.extend(_pack_str(message_id) for message_id in checkpoint.pending)
+    for entry in checkpoint.unacked:
+        parts.append(_pack_str(entry.message_id))
+        parts.append(_pack_str(entry.consumer_id))
+        parts.append(entry.deadline_ms.to_bytes(8, "big", signed=False))
+    parts.extend(_pack_str(message_id) for message_id in checkpoint.covered)
+    for entry in checkpoint.delayed:
+        parts.append(_pack_str(entry.message_id))
+        parts.append(entry.deliver_at_ms.to_bytes(8, "big", signed=False))
+    data = b"".join(parts)
+    return data + crc32(data).to_bytes(4, "big", signed=False)
+
+
+def decode_checkpoint(data: bytes) -> QueueCheckpoint | None:
+    """Decode a checkpoint file, None when it is torn, corrupt or of another version"""
+    if len(data) < CHECKPOINT_HEADER_V1.size + 4:
+        return None
+    body, crc = data[:-4], int.from_bytes(data[-4:], "big", signed=False)
+    if crc32(body) != crc:
+        return None
+    magic, version = body[:4], body[4]
+    if magic != CHECKPOINT_MAGIC or version not in (1, CHECKPOINT_VERSION):
+        return None
+    header = CHECKPOINT_HEADER_V1 if version == 1 else CHECKPOINT_HEADER
+    if len(body) < header.size:
+        return None
+    (
+        _,
+        _,
+        created_ms,
+        binlog_offset,
+        acklog_position,
+        acklog_crc,
+        pending_count,
+        unacked_count,
+        covered_count,
+        *rest,
+    ) = header.unpack_from(body)
+    delayed_count = rest[0] if rest else 0
+    checkpoint = QueueCheckpoint(created_ms, binlog_offset, acklog_position, acklog_crc)
+    ptr = header.size
+    try:
+        for _ in range(pending_count):
+            message_id, ptr = _unpack_str(body, ptr)
+            checkpoint.pending.append(message_id)
+        for _ in range(unacked_count):
+            message_id, ptr = _unpack_str(body, ptr)
+            consumer_id, ptr = _unpack_str(body, ptr)
+            deadline_ms = int.from_bytes(body[ptr : ptr + 8], "big", signed=False)
+            ptr += 8
+            checkpoint.unacked.append(UnackedEntry(message_id, consumer_id, deadline_ms))
+        for _ in range(covered_count):
+            message_id, ptr = _unpack_str(body, ptr)
+            checkpoint.covered.append(message_id)
+        for _ in range(delayed_count):
+            message_id, ptr = _unpack_str(body, ptr)
+            deliver_at_ms = int.from_bytes(body[ptr : ptr + 8], "big", signed=False)
+            ptr += 8
+            checkpoint.delayed.append(DelayedEntry(message_id, deliver_at_ms))
+    except (ValueError, UnicodeDecodeError):
+        return None
+    return checkpoint
+
+
+def acklog_fingerprint(topic: str, position: int) -> int:
+    """crc32 of the ack log bytes just before position"""
+    start = max(position - ACKLOG_FINGERPRINT_SIZE, 0)
+    try:
+        with open(get_acklog_path(topic), "rb") as f:
+            f.seek(start)
+            return crc32(f.read(position - start))
+    except FileNotFoundError:
+        return crc32(b"")
+
+
+def write_checkpoint(topic: str, checkpoint: QueueCheckpoint, keep: int = 2) -> str:
+    """Write the checkpoint atomically and remove all but the newest keep files"""
+    path = get_checkpoint_path(topic, checkpoint.created_ms)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(serialize_checkpoint(checkpoint))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    for old in list_checkpoint_paths(topic)[: -max(keep, 1)]:
+        Path(old).unlink(missing_ok=True)
+    return path
+
+
+def list_checkpoint_paths(topic: str) -> list[str]:
+    """Checkpoint files of the topic, oldest first"""
+    directory = os.path.dirname(get_checkpoint_path(topic, 0))
+    if not os.path.isdir(directory):
+        return []
+    return [
+        os.path.join(directory, name)
+        for name in sorted(os.listdir(directory))
+        if name.endswith(".qcp") and name[: -len(".qcp")].isdigit()
+    ]
+
+
+def read_checkpoints(topic: str) -> list[QueueCheckpoint]:
+    """Every checkpoint of the topic that decodes and still matches its ack log, newest first"""
+    size = get_acklog_size(topic)
+    checkpoints = []
+    for path in reversed(list_checkpoint_paths(topic)):
+        try:
+            checkpoint = decode_checkpoint(Path(path).read_bytes())
+        except FileNotFoundError:
+            continue
+        if checkpoint is None:
+            SLOG.info(f"skipping corrupt checkpoint {path}")
+            continue
+        if checkpoint.acklog_position > size or checkpoint.acklog_crc != acklog_fingerprint(
+            topic, checkpoint.acklog_position
+        ):
+            # the ack log was rewritten since
+            continue
+        checkpoints.append(checkpoint)
+    return checkpoints
+
+
+def load_checkpoint(topic: str) -> QueueCheckpoint | None:
+    """Newest valid checkpoint of the topic, None when there is none"""
+    checkpoints = read_checkpoints(topic)
+    return checkpoints[0] if checkpoints else None
+
+
+def crc32(data: bytes) -> int:
+    return zlib.crc32(data) & 0xFFFFFFFF
+
+
+def get_checkpoint_path(topic: str, created_ms: int, extension: str = "qcp") -> str:
+    """Helper function to get a checkpoint file, named after its creation time"""
+    return os.path.join(
+        Path(__file__).resolve().parents[1],
+        "checkpoints",
+        topic,
+        f"{created_ms:020d}.{extension}",
+    )
@@ -0,0 +1,143 @@
+"""Background binlog and ack log compaction for queue topics"""
+
+import threading
+import time
+from dataclasses import dataclass, field
+from server.util.config import AckCompactionConfig, CompactionConfig
+from server.system_logger import SLOG
+from .acklog import AckState, get_acklog_path, read_acklog, scan_entries
+from .binlog import get_writer
+from .checkpoint import read_checkpoints
+from .topic import Topic
+
+
+class BinLogCompactor(threading.Thread):
+    """Periodically drops acked messages from the sealed segments of queue topics
+
+    Acked is final, so the ack log read at the start of a pass is enough:
+    messages acked later are kept until the next pass. Segments reaching
+    past the oldest queue checkpoint are left alone, its tail is replayed by
+    offset on restart.
+    """
+
+    def __init__(self, topics: list[str], config: CompactionConfig):
+        super().__init__(daemon=True)
+        self._topics = topics
+        self._config = config
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if self._config.interval_ms <= 0:
+            return
+        while not self._stop_event.wait(self._config.interval_ms / 1000):
+            for topic in self._topics:
+                try:
+                    self.compact(topic)
+                except Exception as e:
+                    SLOG.error(e)
+
+    def compact(self, topic: str) -> int:
+        """Run one compaction pass over the topic, returns the records dropped"""
+        acked = {
+            entry.message_id
+            for entry in read_acklog(topic)
+            if entry.state == AckState.ACKED
+        }
+        checkpoints = read_checkpoints(topic)
+        before = min(c.binlog_offset for c in checkpoints) if checkpoints else None
+        dropped = get_writer(topic).compact(acked, self._config.min_dead_ratio, before)
+        if dropped:
+            SLOG.info(f"binlog compaction dropped {dropped} acked messages from {topic}")
+        return dropped
+
+    def stop(self):
+        self._stop_event.set()
+
+
+@dataclass
+class AckLogStats:
+    """Entries of an ack log seen so far, kept up to date incrementally"""
+
+    position: int = 0
+    entries: int = 0
+    message_ids: set[str] = field(default_factory=set)
+    compacted_size: int = 0
+    compacted_at: float = field(default_factory=time.monotonic)
+
+    def get_dead(self) -> int:
+        """Entries superseded by a later one of the same message"""
+        return self.entries - len(self.message_ids)
+
+
+class AckLogCompactor(threading.Thread):
+    """Compacts queue topic ack logs once a trigger of the policy fires
+
+    Each check decodes only what was appended since the previous one, so
+    the dead ratio is exact without rereading the log.
+    """
+
+    def __init__(self, topics: dict[str, Topic], config: AckCompactionConfig):
+        super().__init__(daemon=True)
+        self._topics = topics
+        self._config = config
+        self._stats: dict[str, AckLogStats] = {name: AckLogStats() for name in topics}
+        self._stop_event = threading.Event()
+
+    def run(self):
+        if self._config.check_interval_ms <= 0:
+            return
+        while not self._stop_event.wait(self._config.check_interval_ms / 1000):
+            for name in self._topics:
+                try:
+                    self.check(name)
+                except Exception as e:
+                    SLOG.error(e)
+
+    def scan(self, name: str) -> AckLogStats:
+        """Account for the entries appended since the last scan"""
+        stats = self._stats[name]
+        try:
+            with open(get_acklog_path(name), "rb") as f:
+                f.seek(stats.position)
+                data = f.read()
+        except FileNotFoundError:
+            return stats
+        entries, end = scan_entries(data)
+        stats.position += end
+        stats.entries += len(entries)
+        stats.message_ids.update(entry.message_id for entry in entries)
+        return stats
+
+    def should_compact(self, stats: AckLogStats) -> bool:
+        """Whether any trigger fires, nothing is done while no entry is dead"""
+        dead = stats.get_dead()
+        if not dead:
+            return False
+        if self._config.min_dead_ratio and dead >= stats.entries * self._config.min_dead_ratio:
+            return True
+        if (
+            self._config.max_bytes
+            and stats.position >= self._config.max_bytes
+            and stats.position >= 2 * stats.compacted_size
+        ):
+            return True
+        if (
+            self._config.interval_ms
+            and (time.monotonic() - stats.compacted_at) * 1000 >= self._config.interval_ms
+        ):
+            return True
+        return False
+
+    def check(self, name: str) -> bool:
+        """Compact the ack log of the topic when due, returns whether it was"""
+        if not self.should_compact(self.scan(name)):
+            return False
+        before = self._stats[name].position
+        size = self._topics[name].compact_acklog()
+        # entries appended during the rewrite are rescanned with the new log
+        self._stats[name] = AckLogStats(compacted_size=size)
+        SLOG.info(f"ack log compaction of {name}: {before} -> {size} bytes")
+        return True
+
+    def stop(self):
+        self._stop_event.set()
@@ -0,0 +1,200 @@
+"""Partitioned topics
+
+A topic configured with N partitions is N independent topics, each with its
+own binlog, ack log, checkpoints, queue state and lock. Partitions are named
+<topic>-p<i>, a topic with a single partition keeps its plain name.
+"""
+
+import itertools
+import os
+import threading
+import time
+import zlib
+from dataclasses import replace
+from exception import UnpartitionedTopicLogException
+from server.util.config import CheckpointConfig, TopicConfig
+from .acklog import get_acklog_path
+from .binlog import TransactionLog, get_topic_path
+from .checkpoint import list_checkpoint_paths
+from .mode import Mode
+from .topic import Arrivals, Topic
+
+
+def partition_name(topic: str, partition: int, partitions: int) -> str:
+    """Name the partition's logs and state are stored under"""
+    if partitions <= 1:
+        return topic
+    return f"{topic}-p{partition}"
+
+
+def partition_configs(config: TopicConfig) -> list[TopicConfig]:
+    """One single-partition config per partition of the topic"""
+    return [
+        replace(config, name=partition_name(config.name, i, config.partitions), partitions=1)
+        for i in range(max(config.partitions, 1))
+    ]
+
+
+def unpartitioned_paths(config: TopicConfig) -> list[str]:
+    """Logs and checkpoints of the plain topic name left behind by a topic with partitions
+
+    A topic moved from one partition to several would not read them, none
+    of its partitions is stored under the plain name.
+    """
+    if config.partitions <= 1:
+        return []
+    paths = []
+    directory = os.path.dirname(get_topic_path(config.name))
+    if os.path.isdir(directory):
+        paths.extend(
+            os.path.join(directory, name)
+            for name in sorted(os.listdir(directory))
+            if name.endswith(".blog")
+        )
+    if os.path.exists(get_acklog_path(config.name)):
+        paths.append(get_acklog_path(config.name))
+    return paths + list_checkpoint_paths(config.name)
+
+
+def partition_for_key(key: str, partitions: int) -> int:
+    """Partition of a message key, stable across restarts"""
+    return zlib.crc32(key.encode("utf-8")) % partitions
+
+
+class PartitionedTopic:
+    """The partitions of one topic, with produce routing and any-partition consume
+
+    Raises UnpartitionedTopicLogException when the topic has several
+    partitions and logs of its plain name are left, since serving it would
+    silently drop their messages.
+    """
+
+    def __init__(
+        self,
+        config: TopicConfig,
+        checkpoint: CheckpointConfig | None = None,
+        starvation_limit: int = 0,
+    ):
+        left = unpartitioned_paths(config)
+        if left:
+            raise UnpartitionedTopicLogException(
+                f"{config.name} has {config.partitions} partitions but {left[0]} is "
+                "still stored under its plain name"
+            )
+        self._name = config.name
+        self._mode = config.mode
+        self._arrivals = Arrivals()
+        self._partitions = [
+            Topic(config.mode, partition.name, checkpoint, self._arrivals, starvation_limit)
+            for partition in partition_configs(config)
+        ]
+        self._lock = threading.Lock()
+        self._next_produce = itertools.count()
+        self._next_consume = itertools.count()
+
+    def get_mode(self) -> Mode:
+        """getter of mode"""
+        return self._mode
+
+    def get_name(self) -> str:
+        """getter of name"""
+        return self._name
+
+    def get_partitions(self) -> list[Topic]:
+        """Partition topics in partition order"""
+        return self._partitions
+
+    def get_partition(self, partition: int) -> Topic:
+        """Getter"""
+        return self._partitions[partition]
+
+    def read_partition(self, partition: int | None) -> int | None:
+        """Partition a broadcast read uses, None when the request has to name one
+
+        Keyless produces rotate over every partition, so defaulting to one of
+        several would silently skip the records of the others.
+        """
+        if partition is not None:
+            return partition
+        return 0 if len(self._partitions) == 1 else None
+
+    def route(self, key: str | None = None) -> int:
+        """Partition of a produced message, by key hash or round-robin without one"""
+        if key is not None:
+            return partition_for_key(key, len(self._partitions))
+        with self._lock:
+            return next(self._next_produce) % len(self._partitions)
+
+    def _rotation(self) -> list[int]:
+        """Partition order of an any-partition consume, starting one further each call"""
+        with self._lock:
+            start = next(self._next_consume) % len(self._partitions)
+        return [(start + i) % len(self._partitions) for i in range(len(self._partitions))]
+
+    def consume_queue_batch(
+        self,
+        consumer_id: str,
+        ack_timeout_ms: int,
+        max_messages: int,
+        max_bytes: int = 0,
+        wait_ms: int = 0,
+        partition: int | None = None,
+    ) -> tuple[int | None, list[TransactionLog]]:
+        """Consume from one partition, or from the first non-empty one
+
+        Returns the partition the messages came from, None when there are
+        none. Consumers of any partition wait on the topic's Arrivals, which
+        every partition notifies.
+        """
+        if partition is not None or len(self._partitions) == 1:
+            partition = partition or 0
+            messages = self._partitions[partition].consume_queue_batch(
+                consumer_id, ack_timeout_ms, max_messages, max_bytes, wait_ms
+            )
+            return (partition, messages) if messages else (None, messages)
+
+        until = time.monotonic() + wait_ms / 1000
+        while True:
+            count = self._arrivals.get_count()
+            for i in self._rotation():
+                messages = self._partitions[i].consume_queue_batch(
+                    consumer_id, ack_timeout_ms, max_messages, max_bytes
+                )
+                if messages:
+                    return i, messages
+            remaining = until - time.monotonic()
+            if remaining <= 0 or not self._arrivals.wait(count, remaining):
+                return None, []
+
+    def ack_queue_batch(
+        self, message_ids: list[str], consumer_id: str, partition: int | None = None
+    ) -> list[bool]:
+        """Ack messages of one partition, or of whichever partition holds them"""
+        return self._settle(Topic.ack_queue_batch, message_ids, consumer_id, partition)
+
+    def nack_queue_batch(
+        self,
+        message_ids: list[str],
+        consumer_id: str,
+        partition: int | None = None,
+        delay_ms: int = 0,
+    ) -> list[bool]:
+        """Nack messages of one partition, or of whichever partition holds them"""
+
+        def nack(topic: Topic, ids: list[str], consumer: str) -> list[bool]:
+            return topic.nack_queue_batch(ids, consumer, delay_ms)
+
+        return self._settle(nack, message_ids, consumer_id, partition)
+
+    def _settle(self, settle, message_ids, consumer_id, partition) -> list[bool]:
+        if partition is not None:
+            return settle(self._partitions[partition], message_ids, consumer_id)
+        results = [False] * len(message_ids)
+        for topic in self._partitions:
+            pending = [i for i, ok in enumerate(results) if not ok]
+            if not pending:
+                break
+            settled = settle(topic, [message_ids[i] for i in pending], consumer_id)
+            for i, ok in zip(pending, settled):
+                results[i] = ok
+        return results
@@ -0,0 +1,87 @@
+"""Priority ordered queue of messages
+
+Queue mode keeps one deque per priority level. A bitmask of the non-empty
+levels gives the highest one with int.bit_length, so picking the next
+message does not depend on the number of levels or messages.
+"""
+
+from collections import deque
+from collections.abc import Iterable, Iterator
+from .binlog import MAX_PRIORITY, TransactionLog
+
+
+class PriorityDeque:
+    """Deque-like queue that serves higher priorities first, FIFO within a level
+
+    With a starvation_limit, once that many messages in a row were served
+    from above the lowest non-empty level, the next one comes from the lowest
+    non-empty level. 0 disables the guard.
+    """
+
+    def __init__(self, messages: Iterable[TransactionLog] = (), starvation_limit: int = 0):
+        self._levels: list[deque[TransactionLog]] = [deque() for _ in range(MAX_PRIORITY + 1)]
+        self._mask = 0
+        self._size = 0
+        self._starvation_limit = starvation_limit
+        self._streak = 0
+        for message in messages:
+            self.append(message)
+
+    @staticmethod
+    def _level_of(message: TransactionLog) -> int:
+        return min(max(message.header.priority, 0), MAX_PRIORITY)
+
+    def _lowest(self) -> int:
+        return (self._mask & -self._mask).bit_length() - 1
+
+    def _select(self) -> int:
+        """Level the next message is served from"""
+        if 0 < self._starvation_limit <= self._streak:
+            return self._lowest()
+        return self._mask.bit_length() - 1
+
+    def append(self, message: TransactionLog):
+        """Add a message at the back of its level"""
+        level = self._level_of(message)
+        self._levels[level].append(message)
+        self._mask |= 1 << level
+        self._size += 1
+
+    def appendleft(self, message: TransactionLog):
+        """Add a message at the front of its level"""
+        level = self._level_of(message)
+        self._levels[level].appendleft(message)
+        self._mask |= 1 << level
+        self._size += 1
+
+    def extendleft(self, messages: Iterable[TransactionLog]):
+        """appendleft each message in turn, like deque.extendleft"""
+        for message in messages:
+            self.appendleft(message)
+
+    def peek(self) -> TransactionLog:
+        """Message popleft would return"""
+        if not self._size:
+            raise IndexError("peek from an empty queue")
+        return self._levels[self._select()][0]
+
+    def popleft(self) -> TransactionLog:
+        """Remove and return the next message"""
+        if not self._size:
+            raise IndexError("pop from an empty queue")
+        level = self._select()
+        self._streak = 0 if level == self._lowest() else self._streak + 1
+        queue = self._levels[level]
+        message = queue.popleft()
+        if not queue:
+            self._mask &= ~(1 << level)
+        self._size -= 1
+        return message
+
+    def __len__(self) -> int:
+        return self._size
+
+    def __iter__(self) -> Iterator[TransactionLog]:
+        """Highest level first, each level front to back"""
+        for queue in reversed(self._levels):
+            yield from queue
@@ -0,0 +1,149 @@
+"""Queue topic recovery at server startup
+
+Each queue topic is rebuilt in a worker process, where the binlog decode,
+the CRC checks and the ack log replay do not contend for the server's GIL.
+The resulting queue state is pickled back and installed in the server's
+Topic, which then starts serving.
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+from collections.abc import Callable
+from concurrent.futures import Future, ProcessPoolExecutor
+from server.util.config import TopicConfig
+from server.system_logger import SLOG
+from .acklog import AckState, read_acklog
+from .binlog import (
+    TransactionLog,
+    close_writers,
+    configure_topic,
+    get_writer,
+    iter_bin,
+    iter_live,
+    iter_messages,
+)
+from .checkpoint import load_checkpoint
+from .mode import Mode
+from .topic import QueueState, Topic
+
+
+def recover_queue(name: str, topic: Topic) -> bool:
+    """Rebuild the queue state from the latest checkpoint, or from the full logs
+
+    Returns whether a checkpoint was used.
+    """
+    checkpoint = load_checkpoint(name)
+    if checkpoint is None:
+        ack_entries = read_acklog(name)
+        # acked messages are skipped through the message id index
+        acked = {e.message_id for e in ack_entries if e.state == AckState.ACKED}
+        topic.initialize_queue_from_logs(
+            (transaction for _, transaction in iter_live(name, acked)), ack_entries
+        )
+    else:
+        # checkpointed messages are read through the message id index,
+        # only the tail after the checkpoint is scanned
+        topic.initialize_queue_from_checkpoint(
+            checkpoint,
+            (transaction for _, transaction in iter_messages(name, checkpoint.message_ids())),
+            (
+                TransactionLog(transaction.header, bytes(transaction.data))
+                for _, transaction in iter_bin(name, checkpoint.binlog_offset)
+            ),
+            read_acklog(name, checkpoint.acklog_position),
+        )
+    topic.set_next_offset(get_writer(name).get_size())
+    return checkpoint is not None
+
+
+def recover_queue_state(config: TopicConfig) -> QueueState:
+    """Worker process entry, recovers one queue topic and returns its state"""
+    configure_topic(config.name, config.segment, config.compression)
+    topic = Topic(Mode.QUEUE, config.name)
+    try:
+        started = time.perf_counter()
+        from_checkpoint = recover_queue(config.name, topic)
+        SLOG.info(
+            f"recovered {config.name} {'from checkpoint' if from_checkpoint else 'from logs'}"
+            f" in {time.perf_counter() - started:.3f}s"
+        )
+        return topic.get_queue_state()
+    finally:
+        close_writers()
+
+
+class QueueRecovery:
+    """Recovers queue topics concurrently and tracks the ones still loading
+
+    A topic leaves the recovering set, and its Topic thread is started, as
+    soon as its own state is installed. If a worker fails, the topic is
+    recovered in the server process instead.
+    """
+
+    def __init__(self, workers: int = 0):
+        self._workers = workers
+        self._lock = threading.Lock()
+        self._recovering: set[str] = set()
+        self._done = threading.Event()
+        self._done.set()
+        self._on_done: Callable[[], None] | None = None
+        self._executor: ProcessPoolExecutor | None = None
+
+    def start(
+        self,
+        topics: list[tuple[TopicConfig, Topic]],
+        on_done: Callable[[], None] | None = None,
+    ):
+        """Submit every topic and return at once, on_done runs after the last one is ready"""
+        self._on_done = on_done
+        if not topics:
+            self._finish()
+            return
+        with self._lock:
+            self._recovering.update(config.name for config, _ in topics)
+            self._done.clear()
+        workers = self._workers or os.cpu_count() or 1
+        # spawn, a forked child would inherit the server's writer locks and threads
+        self._executor = ProcessPoolExecutor(
+            max_workers=min(workers, len(topics)),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        for config, topic in topics:
+            future = self._executor.submit(recover_queue_state, config)
+            future.add_done_callback(
+                lambda f, config=config, topic=topic: self._install(config, topic, f)
+            )
+
+    def _install(self, config: TopicConfig, topic: Topic, future: Future):
+        try:
+            topic.set_queue_state(future.result())
+        except Exception as e:  # pylint: disable=broad-except
+            SLOG.error(f"recovery worker failed for {config.name}: {e}")
+            try:
+                recover_queue(config.name, topic)
+            except Exception as err:  # pylint: disable=broad-except
+                SLOG.error(err)
+        topic.start()
+        with self._lock:
+            self._recovering.discard(config.name)
+            last = not self._recovering
+        if last:
+            self._finish()
+
+    def _finish(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._on_done is not None:
+            self._on_done()
+        self._done.set()
+
+    def is_recovering(self, name: str) -> bool:
+        """Whether the topic is still loading"""
+        with self._lock:
+            return name in self._recovering
+
+    def wait(self, timeout: float | None = None) -> bool:
+        """Block until every topic is recovered"""
+        return self._done.wait(timeout)
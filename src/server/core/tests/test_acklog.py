@@ -1,5 +1,8 @@
 """Ack log persistence tests"""
 
+import os
+import shutil
+import threading
 import time
 import unittest
 from server.core.acklog import (
@@ -8,11 +11,16 @@ from server.core.acklog import (
     append_acklog,
     read_acklog,
     compact_acklog,
+    close_acklog_writers,
+    configure_acklog,
+    sync_acklog,
     get_acklog_path,
+    wait_acklog,
 )
+from server.core.compactor import AckLogCompactor
 from server.core.topic import Topic
 from server.core.binlog import TransactionLog, TransactionLogHeader
-from server.util.config import Server
+from server.util.config import AckCompactionConfig, AckLogConfig, Server
 from server.core.mode import Mode
 
 
@@ -20,6 +28,17 @@ class TestAckLog(unittest.TestCase):
     def setUp(self):
         self.topic = f"test_acklog_{int(time.time() * 1000)}"
 
+    def tearDown(self):
+        close_acklog_writers()
+        shutil.rmtree(os.path.dirname(get_acklog_path(self.topic)), ignore_errors=True)
+
+    def append(self, message_id: str, state: AckState):
+        now_ms = int(time.time() * 1000)
+        position = append_acklog(
+            self.topic, AckLogEntry(now_ms, message_id, "c1", now_ms + 1000, state)
+        )
+        wait_acklog(self.topic, position)
+
     def test_compact_acklog_keeps_latest_state(self):
         now_ms = int(time.time() * 1000)
         append_acklog(
@@ -126,3 +145,262 @@ class TestAckLog(unittest.TestCase):
         self.assertIsNotNone(consumed)
         self.assertEqual(consumed.header.message_id, "m2")
 
+
+    def test_compaction_catches_up_on_appends(self):
+        self.append("m1", AckState.ASSIGNED)
+        self.append("m1", AckState.ACKED)
+        test = self
+
+        class AppendingLock:
+            """Appends an entry right before the catch-up takes the lock"""
+
+            def __init__(self):
+                self.enters = 0
+
+            def __enter__(self):
+                self.enters += 1
+                if self.enters == 2:
+                    test.append("m2", AckState.ASSIGNED)
+
+            def __exit__(self, *args):
+                return False
+
+        lock = AppendingLock()
+        size = compact_acklog(self.topic, lock)
+        self.assertEqual(lock.enters, 2)
+        self.assertEqual(size, os.path.getsize(get_acklog_path(self.topic)))
+        entries = read_acklog(self.topic)
+        self.assertEqual(
+            [(e.message_id, e.state) for e in entries],
+            [("m1", AckState.ACKED), ("m2", AckState.ASSIGNED)],
+        )
+
+    def test_wait_after_compaction_returns(self):
+        now_ms = int(time.time() * 1000)
+        for i in range(4):
+            self.append("m1", AckState.ASSIGNED if i % 2 == 0 else AckState.NACKED)
+        position = append_acklog(
+            self.topic, AckLogEntry(now_ms, "m1", "c1", now_ms + 1000, AckState.ACKED)
+        )
+        # the compacted log is shorter than the position handed out before it
+        size = compact_acklog(self.topic)
+        self.assertLess(size, position)
+        waiter = threading.Thread(target=wait_acklog, args=(self.topic, position), daemon=True)
+        waiter.start()
+        waiter.join(2)
+        self.assertFalse(waiter.is_alive())
+
+        # later positions keep growing and still match the file once written
+        self.append("m2", AckState.ASSIGNED)
+        self.assertEqual(sync_acklog(self.topic), os.path.getsize(get_acklog_path(self.topic)))
+        self.assertEqual([e.message_id for e in read_acklog(self.topic)], ["m1", "m2"])
+
+    def test_scheduler_compacts_past_dead_ratio(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        compactor = AckLogCompactor(
+            {self.topic: topic}, AckCompactionConfig(min_dead_ratio=0.5, max_bytes=0)
+        )
+        self.append("m1", AckState.ASSIGNED)
+        self.append("m2", AckState.ASSIGNED)
+        self.append("m1", AckState.ACKED)
+        # 1 dead of 3
+        self.assertFalse(compactor.check(self.topic))
+        self.append("m2", AckState.ACKED)
+        self.assertTrue(compactor.check(self.topic))
+        self.assertEqual(len(read_acklog(self.topic)), 2)
+        # rescanned from the new log, nothing dead
+        self.assertFalse(compactor.check(self.topic))
+        self.assertEqual(compactor.scan(self.topic).entries, 2)
+
+    def test_writer_buffers_until_waited(self):
+        configure_acklog(AckLogConfig(durability="async", batch_size=100, flush_interval_ms=60000))
+        try:
+            now_ms = int(time.time() * 1000)
+            positions = [
+                append_acklog(
+                    self.topic,
+                    AckLogEntry(now_ms, f"m{i}", "c1", now_ms + 1000, AckState.ASSIGNED),
+                )
+                for i in range(3)
+            ]
+            self.assertEqual(read_acklog(self.topic), [])
+            self.assertEqual(sync_acklog(self.topic), positions[-1])
+            self.assertEqual([e.message_id for e in read_acklog(self.topic)], ["m0", "m1", "m2"])
+            self.assertEqual(os.path.getsize(get_acklog_path(self.topic)), positions[-1])
+        finally:
+            close_acklog_writers()
+            configure_acklog(AckLogConfig())
+
+    def test_expiry_skips_stale_deadlines(self):
+        topic = Topic(Mode.QUEUE)
+        for i in range(3):
+            topic.add_queue(
+                TransactionLog(
+                    TransactionLogHeader(0, self.topic, f"m{i}", Server("p", "127.0.0.1", 1), 1),
+                    b"x",
+                )
+            )
+        topic.consume_queue("c1", 50)
+        topic.consume_queue("c1", 50)
+        # m0 acked and m1 reassigned with a long deadline before they expire
+        self.assertTrue(topic.ack_queue("m0", "c1"))
+        self.assertTrue(topic.nack_queue("m1", "c1"))
+        self.assertEqual(topic.consume_queue("c2", 60000).header.message_id, "m1")
+        time.sleep(0.06)
+
+        self.assertEqual(topic.consume_queue("c3", 60000).header.message_id, "m2")
+        self.assertIsNone(topic.consume_queue("c3", 60000))
+        self.assertTrue(topic.ack_queue("m1", "c2"))
+
+    def test_topic_thread_expires_without_consumers(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        for i in range(3):
+            topic.add_queue(
+                TransactionLog(
+                    TransactionLogHeader(0, self.topic, f"m{i}", Server("p", "127.0.0.1", 1), 1),
+                    b"x",
+                )
+            )
+        topic.start()
+        try:
+            topic.consume_queue("c1", 60000)
+            # the thread sleeps until m0's deadline, m1 and m2 expire earlier
+            topic.consume_queue("c1", 50)
+            topic.consume_queue("c1", 50)
+            started = time.monotonic()
+            while len(topic.get_queue_state().queue) < 2 and time.monotonic() - started < 5:
+                time.sleep(0.01)
+
+            state = topic.get_queue_state()
+            self.assertEqual(sorted(tx.header.message_id for tx in state.queue), ["m1", "m2"])
+            self.assertEqual(list(state.unacked), ["m0"])
+            sync_acklog(self.topic)
+            expired = [e.message_id for e in read_acklog(self.topic) if e.state == AckState.EXPIRED]
+            self.assertEqual(sorted(expired), ["m1", "m2"])
+        finally:
+            topic.stop()
+            topic.join(1)
+        self.assertFalse(topic.is_alive())
+
+    def test_batch_consume_assigns_in_one_batch(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        for i in range(6):
+            topic.add_queue(
+                TransactionLog(
+                    TransactionLogHeader(0, self.topic, f"m{i}", Server("p", "127.0.0.1", 1), 10),
+                    b"x" * 10,
+                )
+            )
+        batch = topic.consume_queue_batch("c1", 60000, 3)
+        self.assertEqual([tx.header.message_id for tx in batch], ["m0", "m1", "m2"])
+        # 25 bytes fit two 10 byte payloads, a too small cap still returns one
+        batch = topic.consume_queue_batch("c2", 60000, 10, max_bytes=25)
+        self.assertEqual([tx.header.message_id for tx in batch], ["m3", "m4"])
+        batch = topic.consume_queue_batch("c2", 60000, 10, max_bytes=5)
+        self.assertEqual([tx.header.message_id for tx in batch], ["m5"])
+        self.assertEqual(topic.consume_queue_batch("c2", 60000, 10), [])
+
+        sync_acklog(self.topic)
+        entries = read_acklog(self.topic)
+        self.assertEqual([e.message_id for e in entries], [f"m{i}" for i in range(6)])
+        self.assertTrue(all(e.state == AckState.ASSIGNED for e in entries))
+        self.assertEqual(len({e.deadline_ms for e in entries[:3]}), 1)
+        self.assertTrue(topic.ack_queue("m1", "c1"))
+
+    def test_batch_ack_and_nack(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        for i in range(5):
+            topic.add_queue(
+                TransactionLog(
+                    TransactionLogHeader(0, self.topic, f"m{i}", Server("p", "127.0.0.1", 1), 1),
+                    b"x",
+                )
+            )
+        topic.consume_queue_batch("c1", 60000, 4)
+        self.assertEqual(
+            topic.ack_queue_batch(["m0", "m9", "m1"], "c1"), [True, False, True]
+        )
+        self.assertEqual(topic.ack_queue_batch(["m2"], "c2"), [False])
+        self.assertEqual(topic.nack_queue_batch(["m2", "m3", "m0"], "c1"), [True, True, False])
+        # nacked messages are back at the front in the given order
+        self.assertEqual(
+            [tx.header.message_id for tx in topic.consume_queue_batch("c2", 60000, 5)],
+            ["m2", "m3", "m4"],
+        )
+
+        sync_acklog(self.topic)
+        states = [(e.message_id, e.state) for e in read_acklog(self.topic)][4:7]
+        self.assertEqual(
+            states,
+            [
+                ("m0", AckState.ACKED),
+                ("m1", AckState.ACKED),
+                ("m2", AckState.NACKED),
+            ],
+        )
+
+    def test_consume_waits_for_a_message(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        started = time.monotonic()
+        self.assertEqual(topic.consume_queue_batch("c1", 60000, 1, wait_ms=50), [])
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+        # each produce wakes one of the two waiters
+        results = []
+
+        def consume():
+            results.append(topic.consume_queue_batch("c1", 60000, 1, wait_ms=5000))
+
+        waiters = [threading.Thread(target=consume) for _ in range(2)]
+        for waiter in waiters:
+            waiter.start()
+        time.sleep(0.05)
+        started = time.monotonic()
+        for i in range(2):
+            topic.add_queue(
+                TransactionLog(
+                    TransactionLogHeader(0, self.topic, f"m{i}", Server("p", "127.0.0.1", 1), 1),
+                    b"x",
+                )
+            )
+        for waiter in waiters:
+            waiter.join(5)
+        self.assertLess(time.monotonic() - started, 1)
+        ids = sorted(tx.header.message_id for batch in results for tx in batch)
+        self.assertEqual(ids, ["m0", "m1"])
+
+    def test_topic_thread_releases_delayed_messages(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        messages = [
+            TransactionLog(
+                TransactionLogHeader(0, self.topic, f"m{i}", Server("p", "127.0.0.1", 1), 1),
+                b"x",
+            )
+            for i in range(2)
+        ]
+        topic.start()
+        try:
+            deliver_at_ms = int(time.time() * 1000) + 100
+            topic.log_delay("m0", deliver_at_ms)
+            topic.add_queue(messages[0], deliver_at_ms=deliver_at_ms)
+            topic.add_queue(messages[1])
+            self.assertEqual(
+                [tx.header.message_id for tx in topic.consume_queue_batch("c1", 60000, 5)], ["m1"]
+            )
+            delivered = topic.consume_queue_batch("c1", 60000, 5, wait_ms=5000)
+            self.assertEqual([tx.header.message_id for tx in delivered], ["m0"])
+            self.assertGreaterEqual(int(time.time() * 1000), deliver_at_ms)
+
+            # a delayed nack is redelivered once the delay has passed
+            self.assertTrue(topic.nack_queue("m1", "c1", delay_ms=50))
+            self.assertEqual(topic.consume_queue_batch("c1", 60000, 5), [])
+            delivered = topic.consume_queue_batch("c1", 60000, 5, wait_ms=5000)
+            self.assertEqual([tx.header.message_id for tx in delivered], ["m1"])
+
+            sync_acklog(self.topic)
+            states = [(e.message_id, e.state) for e in read_acklog(self.topic)]
+            self.assertEqual(states[0], ("m0", AckState.DELAYED))
+            self.assertIn(("m1", AckState.DELAYED), states)
+        finally:
+            topic.stop()
+            topic.join(1)
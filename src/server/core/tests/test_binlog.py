@@ -0,0 +1,538 @@
+"""Bin log tests"""
+
+import os
+import shutil
+import threading
+import time
+import unittest
+from uuid import uuid4
+from exception import BinLogAppendException
+from server.core.binlog import (
+    INDEX_ENTRY_SIZE,
+    SEGMENT_MAGIC_V2,
+    BLOCK_V2,
+    KIND_BLOCK,
+    MAPPED_SEGMENTS,
+    TIMESTAMP_ENTRY,
+    BinLog,
+    TransactionLog,
+    TransactionLogHeader,
+    append_bin,
+    append_bin_reserialize_all,
+    iter_bin,
+    find_offset,
+    get_message,
+    iter_live,
+    iter_tail,
+    read_tail,
+    get_tail_stats,
+    wait_bin,
+    read_bin,
+    crc32,
+    get_writer,
+    close_writers,
+    get_topic_path,
+    get_segment_path,
+    configure_topic,
+    configure_group_commit,
+)
+from server.util.config import (
+    Server,
+    SegmentConfig,
+    CompressionConfig,
+    GroupCommitConfig,
+    TailConfig,
+)
+
+
+def make_transaction(topic: str, message_id: str, data: bytes) -> TransactionLog:
+    return TransactionLog(
+        header=TransactionLogHeader(
+            timestamp=int(time.time()),
+            topic=topic,
+            message_id=message_id,
+            producer=Server("p", "127.0.0.1", 1),
+            payload_size=len(data),
+        ),
+        data=data,
+    )
+
+
+class TestBinLog(unittest.TestCase):
+    def setUp(self):
+        self.topic = f"test_binlog_{time.time_ns()}"
+
+    def tearDown(self):
+        close_writers()
+        shutil.rmtree(os.path.dirname(get_topic_path(self.topic)), ignore_errors=True)
+
+    def test_append_bin_keeps_header_in_sync(self):
+        for i in range(5):
+            offset = append_bin(self.topic, make_transaction(self.topic, f"m{i}", b"x" * i))
+            self.assertEqual(offset, i)
+
+        self.assertEqual(get_writer(self.topic).get_size(), 5)
+        binlog = read_bin(self.topic)
+        self.assertEqual(binlog.get_size(), 5)
+        self.assertEqual(
+            [t.header.message_id for t in binlog.get_transactions()],
+            ["m0", "m1", "m2", "m3", "m4"],
+        )
+
+    def test_writer_reopens_existing_log(self):
+        append_bin(self.topic, make_transaction(self.topic, "m0", b"zero"))
+        close_writers()
+        append_bin(self.topic, make_transaction(self.topic, "m1", b"one"))
+
+        binlog = read_bin(self.topic, offset=1)
+        self.assertEqual(binlog.get_size(), 1)
+        self.assertEqual(binlog.get_transactions()[0].data, b"one")
+
+    def test_read_bin_seeks_with_index(self):
+        for i in range(10):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"payload-{i}".encode()))
+
+        binlog = read_bin(self.topic, offset=7)
+        self.assertEqual(
+            [t.header.message_id for t in binlog.get_transactions()], ["m7", "m8", "m9"]
+        )
+        self.assertEqual(read_bin(self.topic, offset=10).get_size(), 0)
+
+    def test_index_rebuilt_when_missing_or_stale(self):
+        for i in range(4):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", b"data"))
+        close_writers()
+        index_path = get_segment_path(self.topic, 0, "idx")
+
+        os.remove(index_path)
+        self.assertEqual(read_bin(self.topic, offset=3).get_transactions()[0].header.message_id, "m3")
+        close_writers()
+
+        with open(index_path, "r+b") as f:
+            f.truncate(INDEX_ENTRY_SIZE)
+        self.assertEqual(read_bin(self.topic, offset=2).get_transactions()[0].header.message_id, "m2")
+        with open(get_segment_path(self.topic, 0), "rb") as f:
+            data = f.read()
+        with open(index_path, "rb") as f:
+            self.assertEqual(len(f.read()), 4 * INDEX_ENTRY_SIZE)
+        self.assertEqual(len(BinLog.index_all(data)), 4)
+
+    def test_segments_roll_by_record_count(self):
+        configure_topic(self.topic, SegmentConfig(max_records=3))
+        for i in range(8):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", b"data"))
+
+        bases = [s.get_base_offset() for s in get_writer(self.topic).get_segments()]
+        self.assertEqual(bases, [0, 3, 6])
+        self.assertTrue(os.path.exists(get_segment_path(self.topic, 3)))
+
+        binlog = read_bin(self.topic, offset=2)
+        self.assertEqual(binlog.get_offset(), 2)
+        self.assertEqual(
+            [t.header.message_id for t in binlog.get_transactions()],
+            ["m2", "m3", "m4", "m5", "m6", "m7"],
+        )
+
+    def test_sealed_segments_hold_no_descriptors(self):
+        configure_topic(self.topic, SegmentConfig(max_records=1))
+        for i in range(MAPPED_SEGMENTS + 20):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", b"data"))
+        close_writers()
+        fds = len(os.listdir("/proc/self/fd"))
+
+        self.assertEqual(len(list(iter_bin(self.topic))), MAPPED_SEGMENTS + 20)
+        self.assertEqual(find_offset(self.topic, 0), 0)
+        self.assertEqual(get_message(self.topic, "m0")[0], 0)
+        self.assertEqual(read_bin(self.topic, offset=10).get_size(), MAPPED_SEGMENTS + 10)
+        # the active segment's handles plus at most MAPPED_SEGMENTS maps
+        self.assertLess(len(os.listdir("/proc/self/fd")) - fds, MAPPED_SEGMENTS + 10)
+
+    def test_retention_drops_oldest_segments(self):
+        configure_topic(self.topic, SegmentConfig(max_records=2, retention_bytes=1))
+        for i in range(6):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", b"data"))
+
+        writer = get_writer(self.topic)
+        self.assertEqual(writer.get_base_offset(), 4)
+        self.assertFalse(os.path.exists(get_segment_path(self.topic, 0)))
+
+        binlog = read_bin(self.topic, offset=0)
+        self.assertEqual(binlog.get_offset(), 4)
+        self.assertEqual([t.header.message_id for t in binlog.get_transactions()], ["m4", "m5"])
+
+    def test_single_file_log_becomes_first_segment(self):
+        blog = BinLog()
+        blog.append(make_transaction(self.topic, "m0", b"legacy"))
+        os.makedirs(os.path.dirname(get_topic_path(self.topic)), exist_ok=True)
+        with open(get_topic_path(self.topic), "wb") as f:
+            f.write(blog.serialize_all())
+
+        append_bin(self.topic, make_transaction(self.topic, "m1", b"new"))
+        self.assertFalse(os.path.exists(get_topic_path(self.topic)))
+        self.assertEqual(
+            [t.header.message_id for t in read_bin(self.topic).get_transactions()], ["m0", "m1"]
+        )
+
+    def test_read_bin_payloads_are_shared_views(self):
+        for i in range(3):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"payload-{i}".encode()))
+
+        first = read_bin(self.topic).get_transactions()
+        second = read_bin(self.topic, offset=1).get_transactions()
+        self.assertIsInstance(first[1].data, memoryview)
+        self.assertEqual(bytes(first[1].data), b"payload-1")
+        self.assertIs(first[1].data.obj, second[0].data.obj)
+
+        append_bin(self.topic, make_transaction(self.topic, "m3", b"payload-3"))
+        self.assertEqual(bytes(read_bin(self.topic, offset=3).get_transactions()[0].data), b"payload-3")
+        self.assertEqual(bytes(first[0].data), b"payload-0")
+
+    def test_group_commit_assigns_contiguous_offsets(self):
+        configure_topic(self.topic, SegmentConfig(max_records=7))
+        offsets = []
+        lock = threading.Lock()
+
+        def produce(n: int):
+            for i in range(10):
+                offset = append_bin(self.topic, make_transaction(self.topic, f"p{n}-{i}", b"data"))
+                with lock:
+                    offsets.append(offset)
+
+        threads = [threading.Thread(target=produce, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(sorted(offsets), list(range(40)))
+        transactions = read_bin(self.topic).get_transactions()
+        self.assertEqual(len(transactions), 40)
+        self.assertEqual(len({t.header.message_id for t in transactions}), 40)
+
+    def test_failed_batch_reports_written_offsets(self):
+        configure_topic(self.topic, SegmentConfig(max_records=1))
+        configure_group_commit(GroupCommitConfig(window_ms=500, max_batch=3))
+        self.addCleanup(configure_group_commit, GroupCommitConfig())
+        get_writer(self.topic)
+        # m0 is written when m1 rolls the segment, the oversized id of m2 fails the batch
+        errors: dict[str, Exception] = {}
+
+        def produce(message_id: str):
+            try:
+                append_bin(self.topic, make_transaction(self.topic, message_id, b"data"))
+            except Exception as e:  # pylint: disable=broad-except
+                errors[message_id[:2]] = e
+
+        threads = []
+        for message_id in ("m0", "m1", "m2" * 40000):
+            threads.append(threading.Thread(target=produce, args=(message_id,)))
+            threads[-1].start()
+            time.sleep(0.05)
+        for thread in threads:
+            thread.join()
+
+        self.assertIsInstance(errors["m0"], BinLogAppendException)
+        self.assertEqual(errors["m0"].offset, 0)
+        self.assertNotIsInstance(errors["m1"], BinLogAppendException)
+        self.assertNotIsInstance(errors["m2"], BinLogAppendException)
+        self.assertEqual(get_writer(self.topic).get_size(), 1)
+
+    def test_iter_bin_streams_across_chunks_and_segments(self):
+        configure_topic(self.topic, SegmentConfig(max_records=4))
+        payloads = [os.urandom(100 + i * 37) for i in range(10)]
+        for i, payload in enumerate(payloads):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", payload))
+
+        records = list(iter_bin(self.topic, 3, chunk_size=64))
+        self.assertEqual([offset for offset, _ in records], list(range(3, 10)))
+        self.assertEqual([t.data for _, t in records], payloads[3:])
+        self.assertTrue(all(isinstance(t.data, bytes) for _, t in records))
+
+        mapped = list(iter_bin(self.topic, 3, zero_copy=True))
+        self.assertEqual([bytes(t.data) for _, t in mapped], payloads[3:])
+
+    def test_iter_bin_reads_legacy_records(self):
+        legacy = make_transaction(self.topic, "", b"legacy")
+        record = BinLog.transaction_to_bytes(legacy)
+        # drop the message_id length field and re-checksum, as older writers did
+        topic_end = 8 + len(self.topic)
+        record = record[:topic_end] + record[topic_end + 4 : -4]
+        record += crc32(record).to_bytes(4, "big")
+        os.makedirs(os.path.dirname(get_topic_path(self.topic)), exist_ok=True)
+        with open(get_segment_path(self.topic, 0), "wb") as f:
+            f.write((1).to_bytes(4, "big") + record)
+
+        records = list(iter_bin(self.topic, chunk_size=16))
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][1].data, b"legacy")
+        self.assertEqual(records[0][1].header.producer.ip, "127.0.0.1")
+
+    def test_v2_segment_interns_identities(self):
+        message_ids = [str(uuid4()), "custom-id"]
+        for message_id in message_ids:
+            append_bin(self.topic, make_transaction(self.topic, message_id, b"payload"))
+        close_writers()
+
+        with open(get_segment_path(self.topic, 0), "rb") as f:
+            data = f.read()
+        self.assertEqual(data[0:4], SEGMENT_MAGIC_V2)
+        self.assertEqual(data.count(self.topic.encode("utf-8")), 0)
+        v1_size = sum(
+            len(BinLog.transaction_to_bytes(make_transaction(self.topic, m, b"payload")))
+            for m in message_ids
+        )
+        self.assertLess(len(data) - 8, v1_size)
+
+        transactions = read_bin(self.topic).get_transactions()
+        self.assertEqual([t.header.message_id for t in transactions], message_ids)
+        self.assertEqual(transactions[0].header.topic, self.topic)
+        self.assertEqual(transactions[1].header.producer, Server("p", "127.0.0.1", 1))
+
+    def test_v1_active_segment_is_sealed_on_open(self):
+        blog = BinLog()
+        blog.append(make_transaction(self.topic, "m0", b"v1"))
+        os.makedirs(os.path.dirname(get_topic_path(self.topic)), exist_ok=True)
+        with open(get_segment_path(self.topic, 0), "wb") as f:
+            f.write(blog.serialize_all())
+
+        append_bin(self.topic, make_transaction(self.topic, "m1", b"v2"))
+        segments = get_writer(self.topic).get_segments()
+        self.assertEqual([s.get_version() for s in segments], [1, 2])
+        self.assertEqual([bytes(t.data) for t in read_bin(self.topic).get_transactions()], [b"v1", b"v2"])
+
+    def test_reserialize_rewrites_active_segment(self):
+        append_bin(self.topic, make_transaction(self.topic, "m0", b"zero"))
+        append_bin_reserialize_all(self.topic, make_transaction(self.topic, "m1", b"one"))
+        append_bin(self.topic, make_transaction(self.topic, "m2", b"two"))
+
+        self.assertEqual(
+            [t.header.message_id for t in read_bin(self.topic).get_transactions()],
+            ["m0", "m1", "m2"],
+        )
+
+    def test_compressed_batch_reads_from_any_offset(self):
+        configure_topic(self.topic, SegmentConfig(), CompressionConfig("zlib", 6))
+        writer = get_writer(self.topic)
+        batch = [make_transaction(self.topic, f"m{i}", b"payload " * 20) for i in range(50)]
+        writer.write_batch(batch, False)
+
+        segment = writer.get_segments()[-1]
+        with open(segment.get_path(), "rb") as f:
+            data = f.read()
+        self.assertEqual(data[8], KIND_BLOCK)
+        self.assertEqual(BLOCK_V2.unpack_from(data, 8)[2], 50)
+        self.assertLess(len(data), sum(len(t.data) for t in batch))
+
+        expected = [f"m{i}" for i in range(50)]
+        transactions = read_bin(self.topic, 17).get_transactions()
+        self.assertEqual([t.header.message_id for t in transactions], expected[17:])
+        chunked = [t.header.message_id for _, t in iter_bin(self.topic, 33, chunk_size=64)]
+        self.assertEqual(chunked, expected[33:])
+
+        # the rebuilt index points every record of the block at the block
+        close_writers()
+        os.remove(get_segment_path(self.topic, 0, "idx"))
+        self.assertEqual([o for o, _ in iter_bin(self.topic, 40)], list(range(40, 50)))
+        with open(get_segment_path(self.topic, 0, "idx"), "rb") as f:
+            index = f.read()
+        self.assertEqual(index, (8).to_bytes(INDEX_ENTRY_SIZE, "big") * 50)
+
+    def test_incompressible_batch_is_written_plain(self):
+        configure_topic(self.topic, SegmentConfig(), CompressionConfig("lzma", 1))
+        writer = get_writer(self.topic)
+        writer.write_batch([make_transaction(self.topic, "m0", os.urandom(64))], False)
+        append_bin(self.topic, make_transaction(self.topic, "m1", b"one"))
+
+        with open(writer.get_segments()[-1].get_path(), "rb") as f:
+            self.assertNotEqual(f.read()[8], KIND_BLOCK)
+        self.assertEqual([t.header.message_id for _, t in iter_bin(self.topic)], ["m0", "m1"])
+
+    def test_find_offset_by_timestamp(self):
+        configure_topic(self.topic, SegmentConfig(max_records=300))
+        writer = get_writer(self.topic)
+        batch = []
+        for i in range(1000):
+            transaction = make_transaction(self.topic, f"m{i}", b"x")
+            transaction.header.timestamp = 1_000 + i // 10
+            batch.append(transaction)
+        writer.write_batch(batch, False)
+        self.assertEqual(len(writer.get_segments()), 4)
+
+        self.assertEqual(find_offset(self.topic, 0), 0)
+        self.assertEqual(find_offset(self.topic, 1_000), 0)
+        self.assertEqual(find_offset(self.topic, 1_045), 450)
+        self.assertEqual(find_offset(self.topic, 1_099), 990)
+        self.assertEqual(find_offset(self.topic, 2_000), 1000)
+
+        # entries are sparse and rebuilt when the file is missing
+        tix = writer.get_segments()[1].get_timestamp_index_path()
+        self.assertEqual(os.path.getsize(tix), 3 * TIMESTAMP_ENTRY.size)
+        close_writers()
+        os.remove(tix)
+        self.assertEqual(find_offset(self.topic, 1_045), 450)
+        self.assertEqual(os.path.getsize(tix), 3 * TIMESTAMP_ENTRY.size)
+
+    def test_get_message_and_iter_live_use_message_index(self):
+        configure_topic(self.topic, SegmentConfig(max_records=4))
+        for i in range(10):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"p{i}".encode()))
+        segments = get_writer(self.topic).get_segments()
+        self.assertTrue(os.path.exists(segments[0].get_sorted_message_index_path()))
+        self.assertFalse(os.path.exists(segments[0].get_message_index_path()))
+
+        offset, transaction = get_message(self.topic, "m5")
+        self.assertEqual((offset, bytes(transaction.data)), (5, b"p5"))
+        self.assertEqual(get_message(self.topic, "m9")[0], 9)
+        self.assertIsNone(get_message(self.topic, "missing"))
+
+        live = [(o, t.header.message_id) for o, t in iter_live(self.topic, {"m0", "m2", "m6", "m9"})]
+        self.assertEqual(live, [(1, "m1"), (3, "m3"), (4, "m4"), (5, "m5"), (7, "m7"), (8, "m8")])
+
+        # indexes are rebuilt from the segments when missing
+        close_writers()
+        os.remove(segments[0].get_sorted_message_index_path())
+        os.remove(segments[-1].get_message_index_path())
+        self.assertEqual(get_message(self.topic, "m1")[0], 1)
+        self.assertEqual(get_message(self.topic, "m8")[0], 8)
+        append_bin(self.topic, make_transaction(self.topic, "m10", b"p10"))
+        self.assertEqual(get_message(self.topic, "m10")[0], 10)
+
+    def test_compact_drops_acked_messages_from_sealed_segments(self):
+        configure_topic(self.topic, SegmentConfig(max_records=4))
+        for i in range(10):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"p{i}".encode()))
+        writer = get_writer(self.topic)
+        first = writer.get_segments()[0]
+
+        acked = {"m0", "m1", "m2", "m3", "m4", "m5", "m8"}
+        self.assertEqual(writer.compact(acked, 0.5), 6)
+        self.assertFalse(os.path.exists(first.get_path()))
+        self.assertEqual(writer.get_base_offset(), 4)
+        self.assertEqual(
+            [t.header.message_id for _, t in iter_bin(self.topic)], ["m6", "m7", "m8", "m9"]
+        )
+        live = [t.header.message_id for _, t in iter_live(self.topic, acked)]
+        self.assertEqual(live, ["m6", "m7", "m9"])
+        self.assertEqual(bytes(get_message(self.topic, "m7")[1].data), b"p7")
+
+        # below the ratio nothing is rewritten, and the result survives a reopen
+        self.assertEqual(writer.compact(acked | {"m6"}, 0.75), 0)
+        close_writers()
+        self.assertEqual(
+            [t.header.message_id for _, t in iter_bin(self.topic)], ["m6", "m7", "m8", "m9"]
+        )
+        append_bin(self.topic, make_transaction(self.topic, "m10", b"p10"))
+        self.assertEqual(get_message(self.topic, "m10")[0], 10)
+
+    def test_compacted_segments_keep_their_offsets(self):
+        configure_topic(self.topic, SegmentConfig(max_records=4))
+        for i in range(10):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"p{i}".encode()))
+        writer = get_writer(self.topic)
+
+        self.assertEqual(writer.compact({"m0", "m1", "m2", "m5"}, 0.25), 4)
+        expected = [(3, "m3"), (4, "m4"), (6, "m6"), (7, "m7"), (8, "m8"), (9, "m9")]
+        self.assertEqual([(o, t.header.message_id) for o, t in iter_bin(self.topic)], expected)
+        self.assertEqual(get_message(self.topic, "m3")[0], 3)
+        self.assertEqual([o for o, _ in iter_bin(self.topic, 3)], [3, 4, 6, 7, 8, 9])
+        self.assertEqual([o for o, _ in iter_bin(self.topic, 5, zero_copy=True)], [6, 7, 8, 9])
+        self.assertEqual(read_bin(self.topic, 1).get_offset(), 3)
+
+        # compacting again and reopening keep the original offsets
+        self.assertEqual(writer.compact({"m3", "m6"}, 0.25), 2)
+        close_writers()
+        live = [(o, t.header.message_id) for o, t in iter_live(self.topic, set())]
+        self.assertEqual(live, [(4, "m4"), (7, "m7"), (8, "m8"), (9, "m9")])
+        self.assertEqual([o for o, _ in iter_bin(self.topic, 5)], [7, 8, 9])
+        self.assertEqual(find_offset(self.topic, 0), 4)
+
+    def test_readers_retry_a_segment_compacted_under_them(self):
+        configure_topic(self.topic, SegmentConfig(max_records=4))
+
+        def read_while_compacting(read, *args) -> list:
+            close_writers()
+            shutil.rmtree(os.path.dirname(get_topic_path(self.topic)), ignore_errors=True)
+            for i in range(10):
+                append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"p{i}".encode()))
+            writer = get_writer(self.topic)
+            listed = writer.segments_from
+            # the old file is already mapped
+            writer.get_segments()[0].get_reader().view(1)
+
+            def segments_from(offset):
+                # the segments are listed, then swapped before they are read
+                segments = listed(offset)
+                del writer.segments_from
+                writer.compact({"m0", "m1", "m2"}, 0.25)
+                return segments
+
+            writer.segments_from = segments_from
+            return list(read(self.topic, *args))
+
+        expected = [(3, "m3"), (4, "m4"), (5, "m5")]
+        for zero_copy in (False, True):
+            records = read_while_compacting(iter_bin, 0, zero_copy)
+            self.assertEqual([(o, t.header.message_id) for o, t in records[:3]], expected)
+        records = read_while_compacting(iter_live, {"m0"})
+        self.assertEqual([(o, t.header.message_id) for o, t in records[:3]], expected)
+        offset, transaction = read_while_compacting(get_message, "m3")
+        self.assertEqual((offset, bytes(transaction.data)), (3, b"p3"))
+
+    def test_tail_buffer_serves_recent_offsets(self):
+        configure_topic(self.topic, SegmentConfig(), tail=TailConfig(max_records=4, max_bytes=0))
+        for i in range(10):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"p{i}".encode()))
+
+        recent = list(iter_tail(self.topic, 7))
+        self.assertEqual([offset for offset, _ in recent], [7, 8, 9])
+        self.assertIsInstance(recent[0][1].data, bytes)
+        self.assertEqual(list(iter_tail(self.topic, 10)), [])
+        # older than the buffer, read from disk
+        old = list(iter_tail(self.topic, 2))
+        self.assertEqual([t.header.message_id for _, t in old], [f"m{i}" for i in range(2, 10)])
+        stats = get_tail_stats(self.topic)
+        self.assertEqual((stats["hits"], stats["misses"], stats["records"]), (2, 1, 4))
+
+        # the byte cap evicts too
+        configure_topic(self.topic, SegmentConfig(), tail=TailConfig(max_records=0, max_bytes=5))
+        close_writers()
+        for i in range(10, 13):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"p{i}".encode()))
+        self.assertEqual([offset for offset, _ in iter_tail(self.topic, 12)], [12])
+        stats = get_tail_stats(self.topic)
+        self.assertEqual((stats["records"], stats["bytes"], stats["first_offset"]), (1, 3, 12))
+
+    def test_read_tail_steps_over_unreadable_records(self):
+        for i in range(4):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", f"payload-{i}".encode()))
+        close_writers()
+        path = get_segment_path(self.topic, 0)
+        with open(path, "rb") as f:
+            data = bytearray(f.read())
+        for i in (1, 3):
+            data[data.index(f"payload-{i}".encode())] ^= 0xFF
+        with open(path, "wb") as f:
+            f.write(data)
+
+        records, next_offset = read_tail(self.topic, 0, 1)
+        self.assertEqual(([o for o, _ in records], next_offset), ([0], 1))
+        records, next_offset = read_tail(self.topic, 1, zero_copy=True)
+        self.assertEqual(([o for o, _ in records], next_offset), ([2], 3))
+        # only unreadable records left, the next offset still moves past them
+        self.assertEqual(read_tail(self.topic, 3), ([], 4))
+        self.assertEqual(read_tail(self.topic, 4), ([], 4))
+
+    def test_wait_bin_wakes_on_commit(self):
+        append_bin(self.topic, make_transaction(self.topic, "m0", b"p0"))
+        self.assertTrue(wait_bin(self.topic, 0, 0))
+        self.assertFalse(wait_bin(self.topic, 1, 0.05))
+
+        producer = threading.Timer(
+            0.05, lambda: append_bin(self.topic, make_transaction(self.topic, "m1", b"p1"))
+        )
+        producer.start()
+        started = time.monotonic()
+        self.assertTrue(wait_bin(self.topic, 1, 5))
+        self.assertLess(time.monotonic() - started, 1)
+        self.assertEqual([offset for offset, _ in iter_tail(self.topic, 1)], [1])
+        producer.join()
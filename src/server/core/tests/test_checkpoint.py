@@ -0,0 +1,231 @@
+"""Queue checkpoint tests"""
+
+import os
+import shutil
+import time
+import unittest
+from pathlib import Path
+from server.core.acklog import (
+    close_acklog_writers,
+    compact_acklog,
+    get_acklog_path,
+    read_acklog,
+)
+from server.core.binlog import (
+    TransactionLog,
+    TransactionLogHeader,
+    append_bin,
+    close_writers,
+    get_topic_path,
+    get_writer,
+    iter_bin,
+    iter_messages,
+)
+from server.core.checkpoint import (
+    QueueCheckpoint,
+    UnackedEntry,
+    decode_checkpoint,
+    get_checkpoint_path,
+    list_checkpoint_paths,
+    load_checkpoint,
+    serialize_checkpoint,
+)
+from server.core.mode import Mode
+from server.core.topic import Topic
+from server.util.config import CheckpointConfig, Server
+
+
+def make_transaction(topic: str, message_id: str) -> TransactionLog:
+    return TransactionLog(
+        header=TransactionLogHeader(
+            timestamp=int(time.time()),
+            topic=topic,
+            message_id=message_id,
+            producer=Server("p", "127.0.0.1", 1),
+            payload_size=len(message_id),
+        ),
+        data=message_id.encode(),
+    )
+
+
+def restore(topic_name: str) -> Topic:
+    """Recover the way SMSServer does, from the latest checkpoint"""
+    checkpoint = load_checkpoint(topic_name)
+    topic = Topic(Mode.QUEUE, topic_name)
+    topic.initialize_queue_from_checkpoint(
+        checkpoint,
+        (t for _, t in iter_messages(topic_name, checkpoint.message_ids())),
+        (t for _, t in iter_bin(topic_name, checkpoint.binlog_offset)),
+        read_acklog(topic_name, checkpoint.acklog_position),
+    )
+    topic.set_next_offset(get_writer(topic_name).get_size())
+    return topic
+
+
+def drain(topic: Topic) -> list[str]:
+    ids = []
+    while (message := topic.consume_queue("drain", 60000)) is not None:
+        ids.append(message.header.message_id)
+    return ids
+
+
+class TestCheckpoint(unittest.TestCase):
+    def setUp(self):
+        self.topic = f"test_checkpoint_{time.time_ns()}"
+
+    def tearDown(self):
+        close_writers()
+        close_acklog_writers()
+        for path in (
+            get_topic_path(self.topic),
+            get_acklog_path(self.topic),
+            get_checkpoint_path(self.topic, 0),
+        ):
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def produce(self, topic: Topic, message_id: str):
+        transaction = make_transaction(self.topic, message_id)
+        topic.add_queue(transaction, append_bin(self.topic, transaction))
+
+    def test_serialize_round_trip_and_corruption(self):
+        checkpoint = QueueCheckpoint(
+            created_ms=1,
+            binlog_offset=10,
+            acklog_position=200,
+            acklog_crc=7,
+            pending=["m1", "m2"],
+            unacked=[UnackedEntry("m3", "c1", 99)],
+            covered=["m11"],
+        )
+        data = serialize_checkpoint(checkpoint)
+        self.assertEqual(decode_checkpoint(data), checkpoint)
+        self.assertIsNone(decode_checkpoint(data[:-1]))
+        self.assertIsNone(decode_checkpoint(data[:8] + b"\xff" + data[9:]))
+
+    def test_restore_replays_only_the_tail(self):
+        topic = Topic(Mode.QUEUE, self.topic, CheckpointConfig(keep=2))
+        topic.set_next_offset(get_writer(self.topic).get_size())
+        for i in range(5):
+            self.produce(topic, f"m{i}")
+        first = topic.consume_queue("c1", 60000)
+        second = topic.consume_queue("c2", 60000)
+        topic.ack_queue(first.header.message_id, "c1")
+        self.assertTrue(topic.checkpoint())
+        self.assertFalse(topic.checkpoint())
+
+        # after the checkpoint: one more produce, one ack, one assignment
+        self.produce(topic, "m5")
+        topic.ack_queue(second.header.message_id, "c2")
+        self.assertEqual(topic.consume_queue("c3", 60000).header.message_id, "m2")
+
+        recovered = restore(self.topic)
+        self.assertEqual(drain(recovered), ["m3", "m4", "m5"])
+        self.assertTrue(recovered.ack_queue("m2", "c3"))
+
+    def test_covered_produces_are_not_replayed(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        topic.set_next_offset(0)
+        # offset 1 is queued while offset 0 is still in flight
+        in_flight = make_transaction(self.topic, "m0")
+        append_bin(self.topic, in_flight)
+        self.produce(topic, "m1")
+        topic.ack_queue(topic.consume_queue("c1", 60000).header.message_id, "c1")
+        topic.checkpoint()
+        checkpoint = load_checkpoint(self.topic)
+        self.assertEqual((checkpoint.binlog_offset, checkpoint.covered), (0, ["m1"]))
+
+        self.assertEqual(drain(restore(self.topic)), ["m0"])
+
+    def test_skipped_offset_moves_the_watermark(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        topic.set_next_offset(0)
+        self.produce(topic, "m0")
+        # m1 reached the binlog but its produce failed
+        append_bin(self.topic, make_transaction(self.topic, "m1"))
+        self.produce(topic, "m2")
+        self.assertEqual(topic.get_queue_state().next_offset, 1)
+        self.assertTrue(topic.checkpoint())
+
+        topic.skip_offset(1, "m1")
+        self.assertEqual(topic.get_queue_state().next_offset, 3)
+        # the checkpoint from before the skip and the logs alone drop it too
+        for recovered in (restore(self.topic), self.restore_from_logs()):
+            queue = recovered.get_queue_state().queue
+            self.assertEqual([tx.header.message_id for tx in queue], ["m0", "m2"])
+        topic.checkpoint()
+        checkpoint = load_checkpoint(self.topic)
+        self.assertEqual((checkpoint.binlog_offset, checkpoint.covered), (3, []))
+        self.assertEqual(drain(restore(self.topic)), ["m0", "m2"])
+
+    def test_acklog_rewrite_invalidates_checkpoint(self):
+        topic = Topic(Mode.QUEUE, self.topic, CheckpointConfig(keep=1))
+        for i in range(3):
+            self.produce(topic, f"m{i}")
+        topic.consume_queue("c1", 60000)
+        topic.consume_queue("c1", 60000)
+        topic.ack_queue("m0", "c1")
+        topic.checkpoint()
+        topic.ack_queue("m1", "c1")
+        topic.checkpoint()
+        self.assertEqual(len(list_checkpoint_paths(self.topic)), 1)
+        self.assertIsNotNone(load_checkpoint(self.topic))
+
+        compact_acklog(self.topic)
+        self.assertIsNone(load_checkpoint(self.topic))
+        Path(list_checkpoint_paths(self.topic)[0]).write_bytes(b"torn")
+        self.assertIsNone(load_checkpoint(self.topic))
+
+    def test_delays_survive_restart(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        topic.set_next_offset(get_writer(self.topic).get_size())
+        later_ms = int(time.time() * 1000) + 60000
+
+        def produce_delayed(message_id: str, deliver_at_ms: int):
+            topic.log_delay(message_id, deliver_at_ms)
+            transaction = make_transaction(self.topic, message_id)
+            topic.add_queue(transaction, append_bin(self.topic, transaction), deliver_at_ms)
+
+        produce_delayed("m0", later_ms)
+        self.produce(topic, "m1")
+        topic.nack_queue(topic.consume_queue("c1", 60000).header.message_id, "c1", 60000)
+        self.assertTrue(topic.checkpoint())
+        # after the checkpoint: one more delayed and one that is due by restart
+        produce_delayed("m2", later_ms)
+        produce_delayed("m3", int(time.time() * 1000) + 50)
+        self.produce(topic, "m4")
+        self.assertEqual(drain(topic), ["m4"])
+        time.sleep(0.06)
+
+        for recovered in (restore(self.topic), self.restore_from_logs()):
+            state = recovered.get_queue_state()
+            delayed = sorted(tx.header.message_id for _, tx in state.delayed)
+            self.assertEqual(delayed, ["m0", "m1", "m2"])
+            self.assertEqual(drain(recovered), ["m3"])
+
+    def test_checkpoint_between_delay_and_queue_keeps_the_delay(self):
+        topic = Topic(Mode.QUEUE, self.topic)
+        topic.set_next_offset(get_writer(self.topic).get_size())
+        deliver_at_ms = int(time.time() * 1000) + 60000
+        topic.log_delay("m0", deliver_at_ms)
+        transaction = make_transaction(self.topic, "m0")
+        offset = append_bin(self.topic, transaction)
+        # the produce has not reached add_queue yet
+        self.assertTrue(topic.checkpoint())
+        self.assertEqual([e.message_id for e in load_checkpoint(self.topic).delayed], ["m0"])
+
+        recovered = restore(self.topic)
+        self.assertEqual(recovered.get_queue_state().delayed, [(deliver_at_ms, transaction)])
+        self.assertEqual(drain(recovered), [])
+
+        # once queued it is listed once, a failed produce is forgotten
+        topic.add_queue(transaction, offset, deliver_at_ms)
+        topic.log_delay("m1", deliver_at_ms)
+        topic.cancel_delay("m1")
+        self.assertEqual([e.message_id for e in topic.snapshot_queue().delayed], ["m0"])
+
+    def restore_from_logs(self) -> Topic:
+        topic = Topic(Mode.QUEUE, self.topic)
+        topic.initialize_queue_from_logs(
+            (t for _, t in iter_bin(self.topic)), read_acklog(self.topic)
+        )
+        return topic
@@ -0,0 +1,129 @@
+"""Partitioned topic tests"""
+
+import os
+import shutil
+import threading
+import time
+import unittest
+from exception import UnpartitionedTopicLogException
+from server.core.acklog import close_acklog_writers, get_acklog_path
+from server.core.binlog import (
+    TransactionLog,
+    TransactionLogHeader,
+    append_bin,
+    close_writers,
+    get_segment_path,
+    get_topic_path,
+    read_tail,
+)
+from server.core.mode import Mode
+from server.core.partition import (
+    PartitionedTopic,
+    partition_configs,
+    partition_for_key,
+    partition_name,
+    unpartitioned_paths,
+)
+from server.util.config import Server, TopicConfig
+
+
+class TestPartition(unittest.TestCase):
+    def setUp(self):
+        self.config = TopicConfig(f"test_partition_{time.time_ns()}", Mode.QUEUE, partitions=3)
+        self.topic = PartitionedTopic(self.config)
+
+    def tearDown(self):
+        close_acklog_writers()
+        for config in partition_configs(self.config):
+            shutil.rmtree(os.path.dirname(get_acklog_path(config.name)), ignore_errors=True)
+
+    def produce(self, partition: int, message_id: str):
+        topic = self.topic.get_partition(partition)
+        producer = Server("p", "127.0.0.1", 1)
+        topic.add_queue(
+            TransactionLog(TransactionLogHeader(0, topic.get_name(), message_id, producer, 1), b"x")
+        )
+
+    def test_names_and_routing(self):
+        self.assertEqual(partition_name("orders", 0, 1), "orders")
+        self.assertEqual(
+            [config.name for config in partition_configs(self.config)],
+            [f"{self.config.name}-p{i}" for i in range(3)],
+        )
+        self.assertEqual(
+            [p.get_name() for p in self.topic.get_partitions()],
+            [f"{self.config.name}-p{i}" for i in range(3)],
+        )
+        # keys stick to one partition, keyless produces rotate
+        self.assertEqual(self.topic.route("user-42"), partition_for_key("user-42", 3))
+        self.assertEqual(self.topic.route("user-42"), self.topic.route("user-42"))
+        self.assertEqual(sorted(self.topic.route() for _ in range(3)), [0, 1, 2])
+
+    def test_consume_and_ack_across_partitions(self):
+        self.produce(1, "m1")
+        self.produce(2, "m2")
+        self.assertEqual(self.topic.consume_queue_batch("c1", 60000, 5, partition=0), (None, []))
+        taken = {}
+        for _ in range(2):
+            partition, messages = self.topic.consume_queue_batch("c1", 60000, 5)
+            taken[messages[0].header.message_id] = partition
+        self.assertEqual(taken, {"m1": 1, "m2": 2})
+        self.assertEqual(self.topic.consume_queue_batch("c1", 60000, 5), (None, []))
+
+        self.assertEqual(self.topic.ack_queue_batch(["m2", "m0", "m1"], "c1"), [True, False, True])
+        self.assertEqual(self.topic.nack_queue_batch(["m1"], "c1", partition=1), [False])
+
+    def test_any_partition_consumer_wakes_on_each(self):
+        results = []
+
+        def consume():
+            results.append(self.topic.consume_queue_batch("c1", 60000, 1, wait_ms=5000))
+
+        waiter = threading.Thread(target=consume)
+        waiter.start()
+        time.sleep(0.05)
+        started = time.monotonic()
+        self.produce(2, "m0")
+        waiter.join(5)
+        self.assertLess(time.monotonic() - started, 1)
+        partition, messages = results[0]
+        self.assertEqual((partition, messages[0].header.message_id), (2, "m0"))
+
+    def test_broadcast_reads_need_a_partition(self):
+        config = TopicConfig(f"test_partition_{time.time_ns()}", Mode.BROADCAST, partitions=2)
+        topic = PartitionedTopic(config)
+        self.addCleanup(close_writers)
+        for partition in partition_configs(config):
+            self.addCleanup(
+                shutil.rmtree, os.path.dirname(get_topic_path(partition.name)), ignore_errors=True
+            )
+        producer = Server("p", "127.0.0.1", 1)
+        for i in range(4):
+            name = topic.get_partition(topic.route()).get_name()
+            header = TransactionLogHeader(0, name, f"m{i}", producer, 1)
+            append_bin(name, TransactionLog(header, b"x"))
+
+        # keyless produces land on both partitions, so no default is safe
+        self.assertIsNone(topic.read_partition(None))
+        read = []
+        for partition in (topic.read_partition(0), topic.read_partition(1)):
+            records, _ = read_tail(topic.get_partition(partition).get_name(), 0)
+            read.extend(t.header.message_id for _, t in records)
+        self.assertEqual(sorted(read), ["m0", "m1", "m2", "m3"])
+        self.assertEqual(self.topic.read_partition(2), 2)
+        single = PartitionedTopic(TopicConfig(config.name, Mode.BROADCAST))
+        self.assertEqual(single.read_partition(None), 0)
+
+    def test_refuses_logs_left_under_the_plain_name(self):
+        name = f"test_partition_{time.time_ns()}"
+        self.addCleanup(close_writers)
+        self.addCleanup(shutil.rmtree, os.path.dirname(get_topic_path(name)), ignore_errors=True)
+        header = TransactionLogHeader(0, name, "m0", Server("p", "127.0.0.1", 1), 1)
+        append_bin(name, TransactionLog(header, b"x"))
+
+        # served with one partition before, its messages would be orphaned
+        config = TopicConfig(name, Mode.QUEUE, partitions=2)
+        self.assertEqual(unpartitioned_paths(config), [get_segment_path(name, 0)])
+        with self.assertRaises(UnpartitionedTopicLogException):
+            PartitionedTopic(config)
+        self.assertEqual(PartitionedTopic(TopicConfig(name, Mode.QUEUE)).get_name(), name)
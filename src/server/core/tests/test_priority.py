@@ -0,0 +1,86 @@
+"""Queue priority tests"""
+
+import os
+import shutil
+import time
+import unittest
+from server.core.acklog import close_acklog_writers, get_acklog_path
+from server.core.binlog import (
+    TransactionLog,
+    TransactionLogHeader,
+    append_bin,
+    close_writers,
+    get_topic_path,
+    iter_bin,
+)
+from server.core.mode import Mode
+from server.core.priority import PriorityDeque
+from server.core.topic import Topic
+from server.util.config import Server
+
+
+def make_transaction(topic: str, message_id: str, priority: int) -> TransactionLog:
+    return TransactionLog(
+        header=TransactionLogHeader(
+            timestamp=int(time.time()),
+            topic=topic,
+            message_id=message_id,
+            producer=Server("p", "127.0.0.1", 1),
+            payload_size=len(message_id),
+            priority=priority,
+        ),
+        data=message_id.encode(),
+    )
+
+
+def ids(messages) -> list[str]:
+    return [tx.header.message_id for tx in messages]
+
+
+class TestPriority(unittest.TestCase):
+    def setUp(self):
+        self.topic = f"test_priority_{time.time_ns()}"
+
+    def tearDown(self):
+        close_writers()
+        close_acklog_writers()
+        for path in (get_topic_path(self.topic), get_acklog_path(self.topic)):
+            shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def test_higher_levels_first_fifo_within(self):
+        priorities = [0, 5, 0, 9, 5]
+        queue = PriorityDeque(
+            make_transaction(self.topic, f"m{i}", priority) for i, priority in enumerate(priorities)
+        )
+        self.assertEqual(ids(queue), ["m3", "m1", "m4", "m0", "m2"])
+        queue.appendleft(make_transaction(self.topic, "r0", 0))
+        self.assertEqual(queue.peek().header.message_id, "m3")
+        served = [queue.popleft() for _ in range(len(queue))]
+        self.assertEqual(ids(served), ["m3", "m1", "m4", "r0", "m0", "m2"])
+        self.assertFalse(queue)
+        with self.assertRaises(IndexError):
+            queue.popleft()
+
+    def test_starvation_limit_serves_the_lowest_level(self):
+        queue = PriorityDeque(starvation_limit=2)
+        for i in range(4):
+            queue.append(make_transaction(self.topic, f"h{i}", 3))
+        queue.append(make_transaction(self.topic, "l0", 0))
+        queue.append(make_transaction(self.topic, "l1", 0))
+        self.assertEqual(queue.peek().header.message_id, "h0")
+        served = [queue.popleft().header.message_id for _ in range(6)]
+        self.assertEqual(served, ["h0", "h1", "l0", "h2", "h3", "l1"])
+
+    def test_priority_survives_restart(self):
+        for i, priority in enumerate([1, 0, 15, 1]):
+            append_bin(self.topic, make_transaction(self.topic, f"m{i}", priority))
+        self.assertEqual(
+            [tx.header.priority for _, tx in iter_bin(self.topic)], [1, 0, 15, 1]
+        )
+
+        topic = Topic(Mode.QUEUE, self.topic)
+        topic.initialize_queue_from_logs((tx for _, tx in iter_bin(self.topic)), [])
+        self.assertEqual(ids(topic.consume_queue_batch("c1", 60000, 2)), ["m2", "m0"])
+        # nacked back to the front of its own level
+        self.assertEqual(topic.nack_queue_batch(["m0"], "c1"), [True])
+        self.assertEqual(ids(topic.consume_queue_batch("c1", 60000, 5)), ["m0", "m3", "m1"])
@@ -0,0 +1,97 @@
+"""Startup recovery tests"""
+
+import os
+import shutil
+import threading
+import time
+import unittest
+from server.core.acklog import (
+    AckLogEntry,
+    AckState,
+    append_acklog,
+    close_acklog_writers,
+    get_acklog_path,
+)
+from server.core.binlog import (
+    TransactionLog,
+    TransactionLogHeader,
+    append_bin,
+    close_writers,
+    get_topic_path,
+)
+from server.core.checkpoint import get_checkpoint_path
+from server.core.mode import Mode
+from server.core.recovery import QueueRecovery
+from server.core.topic import Topic
+from server.util.config import Server, TopicConfig
+
+
+def make_transaction(topic: str, message_id: str) -> TransactionLog:
+    return TransactionLog(
+        header=TransactionLogHeader(
+            timestamp=int(time.time()),
+            topic=topic,
+            message_id=message_id,
+            producer=Server("p", "127.0.0.1", 1),
+            payload_size=len(message_id),
+        ),
+        data=message_id.encode(),
+    )
+
+
+class TestRecovery(unittest.TestCase):
+    def setUp(self):
+        self.topics = [f"test_recovery_{time.time_ns()}_{i}" for i in range(2)]
+
+    def tearDown(self):
+        close_writers()
+        close_acklog_writers()
+        for name in self.topics:
+            for path in (
+                get_topic_path(name),
+                get_acklog_path(name),
+                get_checkpoint_path(name, 0),
+            ):
+                shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+
+    def test_topics_recover_in_worker_processes(self):
+        now_ms = int(time.time() * 1000)
+        for name in self.topics:
+            for i in range(3):
+                append_bin(name, make_transaction(name, f"{name}_m{i}"))
+            append_acklog(
+                name,
+                AckLogEntry(now_ms, f"{name}_m0", "c1", now_ms + 60000, AckState.ACKED),
+            )
+            append_acklog(
+                name,
+                AckLogEntry(now_ms, f"{name}_m1", "c1", now_ms + 60000, AckState.ASSIGNED),
+            )
+        close_writers()
+
+        topics = [(TopicConfig(name, Mode.QUEUE), Topic(Mode.QUEUE, name)) for name in self.topics]
+        done = threading.Event()
+        recovery = QueueRecovery(workers=2)
+        recovery.start(topics, done.set)
+        self.assertTrue(all(recovery.is_recovering(name) for name in self.topics))
+        self.assertTrue(recovery.wait(60))
+        self.assertTrue(done.is_set())
+
+        for config, topic in topics:
+            self.assertFalse(recovery.is_recovering(config.name))
+            self.assertTrue(topic.is_alive())
+            state = topic.get_queue_state()
+            self.assertEqual(state.next_offset, 3)
+            self.assertEqual(list(state.unacked), [f"{config.name}_m1"])
+            self.assertEqual(
+                topic.consume_queue("c2", 1000).header.message_id, f"{config.name}_m2"
+            )
+            self.assertTrue(topic.ack_queue(f"{config.name}_m1", "c1"))
+            topic.stop()
+
+    def test_no_queue_topics_finishes_at_once(self):
+        done = threading.Event()
+        recovery = QueueRecovery()
+        recovery.start([], done.set)
+        self.assertTrue(done.is_set())
+        self.assertTrue(recovery.wait(0))
@@ -1,11 +1,32 @@
 """Topic manager which is in charge of certain topic"""
+import heapq
+import itertools
 import threading
 import time
-from collections import deque
-from dataclasses import dataclass
+from collections.abc import Iterable
+from dataclasses import dataclass, field
+from server.util.config import CheckpointConfig
+from server.system_logger import SLOG
 from .mode import Mode
 from .binlog import TransactionLog
-from .acklog import AckLogEntry, AckState, append_acklog
+from .priority import PriorityDeque
+from .acklog import (
+    AckLogEntry,
+    AckState,
+    append_acklog,
+    append_acklog_batch,
+    compact_acklog,
+    get_acklog_position,
+    sync_acklog,
+    wait_acklog,
+)
+from .checkpoint import (
+    DelayedEntry,
+    QueueCheckpoint,
+    UnackedEntry,
+    acklog_fingerprint,
+    write_checkpoint,
+)
 
 
 @dataclass
@@ -15,27 +36,107 @@ class UnackedMessage:
     deadline_ms: int
 
 
+@dataclass
+class QueueState:
+    """Queue mode state of a topic, what recovery hands over between processes"""
+
+    queue: list[TransactionLog]
+    unacked: dict[str, UnackedMessage]
+    next_offset: int
+    delayed: list[tuple[int, TransactionLog]] = field(default_factory=list)
+
+
+class Arrivals:
+    """Counts messages made available across the partitions of a topic
+
+    Consumers waiting on any partition wait here, the partitions notify it
+    under their own lock. Waiters read the count before checking the
+    partitions, so an arrival in between is never missed.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._count = 0
+
+    def notify(self, n: int = 1):
+        """Record n available messages and wake as many waiters"""
+        with self._cond:
+            self._count += n
+            self._cond.notify(n)
+
+    def get_count(self) -> int:
+        """Getter"""
+        with self._cond:
+            return self._count
+
+    def wait(self, count: int, timeout: float) -> bool:
+        """Block until something arrived since count was read, False once timeout passes"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._count != count, timeout)
+
+
 class Topic(threading.Thread):
     """Topic class, each topic will have one topic instance
     Topic class internally queues the message and batch logging
+
+    Once started, the thread requeues expired unacked messages at their
+    deadline, queues delayed messages once they are due and writes the
+    periodic checkpoints.
     """
 
-    def __init__(self, mode: Mode):
+    def __init__(
+        self,
+        mode: Mode,
+        name: str = "",
+        checkpoint: CheckpointConfig | None = None,
+        arrivals: Arrivals | None = None,
+        starvation_limit: int = 0,
+    ):
         super().__init__(daemon=True)
         self._mode = mode
+        self._name = name
+        self._arrivals = arrivals
+        self._starvation_limit = starvation_limit
+        self._checkpoint = checkpoint or CheckpointConfig(interval_ms=0)
         self._lock = threading.Lock()
+        # the expiry thread waits on _deadline_changed, consumers waiting for
+        # a message on _message_ready, both share the topic lock
+        self._deadline_changed = threading.Condition(self._lock)
+        self._message_ready = threading.Condition(self._lock)
         self._stop_event = threading.Event()
-        self._q: deque[TransactionLog] = deque()
+        self._q = PriorityDeque(starvation_limit=starvation_limit)
         self._unacked: dict[str, UnackedMessage] = {}
+        # min-heap of (deadline_ms, message_id), entries whose message was
+        # acked, nacked or reassigned since are skipped when they surface
+        self._deadlines: list[tuple[int, str]] = []
+        # min-heap of (deliver_at_ms, seq, message) of messages not due yet
+        self._delayed: list[tuple[int, int, TransactionLog]] = []
+        self._delay_seq = itertools.count()
+        # message_id -> deliver_at_ms of delayed produces logged but not yet
+        # queued, checkpoints list them with the delayed messages
+        self._pending_delays: dict[str, int] = {}
+        # binlog offsets below _next_offset are all queued, _ahead holds
+        # the ones queued past a produce still in flight
+        self._next_offset = 0
+        self._ahead: dict[int, str] = {}
+        self._last_checkpoint: tuple[int, int, int] | None = None
 
     def get_mode(self) -> Mode:
         """getter of mode"""
         return self._mode
 
+    def get_name(self) -> str:
+        """getter of name, the partition name for partitioned topics"""
+        return self._name
+
     def initialize_queue_from_logs(
-        self, transactions: list[TransactionLog], ack_entries: list[AckLogEntry]
+        self, transactions: Iterable[TransactionLog], ack_entries: list[AckLogEntry]
     ):
-        """Initialize queue/unacked state from binlog + acklog"""
+        """Initialize queue/unacked state from binlog + acklog
+
+        transactions is consumed once, so a streaming iter_bin generator keeps
+        only the live messages in memory.
+        """
         if self._mode != Mode.QUEUE:
             return
         now_ms = int(time.time() * 1000)
@@ -43,8 +144,9 @@ class Topic(threading.Thread):
         for entry in ack_entries:
             latest[entry.message_id] = entry
 
-        queue: deque[TransactionLog] = deque()
+        queue = PriorityDeque(starvation_limit=self._starvation_limit)
         unacked: dict[str, UnackedMessage] = {}
+        delayed: list[tuple[int, TransactionLog]] = []
 
         for tx in transactions:
             entry = latest.get(tx.header.message_id)
@@ -63,115 +165,503 @@ class Topic(threading.Thread):
                     continue
                 queue.append(tx)
                 continue
-            # NACKED or EXPIRED
+            if entry.state == AckState.DELAYED and entry.deadline_ms > now_ms:
+                delayed.append((entry.deadline_ms, tx))
+                continue
+            # NACKED, EXPIRED or due
             queue.append(tx)
 
         self._q = queue
         self._unacked = unacked
+        self._rebuild_deadlines()
+        self._set_delayed(delayed)
+
+    def initialize_queue_from_checkpoint(
+        self,
+        checkpoint: QueueCheckpoint,
+        messages: Iterable[TransactionLog],
+        tail: Iterable[TransactionLog],
+        ack_entries: list[AckLogEntry],
+    ):
+        """Initialize queue/unacked state from a checkpoint and the log tail after it
+
+        messages are the checkpointed pending and unacked messages read back
+        from the binlog, tail the records from checkpoint.binlog_offset on and
+        ack_entries the ack log from checkpoint.acklog_position on. The
+        checkpointed unacked map and delayed messages are replayed as assigned
+        and delayed entries ahead of the tail, so expired ones go back to the
+        front of the queue and due ones to the back.
+        """
+        if self._mode != Mode.QUEUE:
+            return
+        by_id = {tx.header.message_id: tx for tx in messages}
+        covered = checkpoint.message_ids()
+        restored = [
+            AckLogEntry(
+                timestamp_ms=checkpoint.created_ms,
+                message_id=entry.message_id,
+                consumer_id=entry.consumer_id,
+                deadline_ms=entry.deadline_ms,
+                state=AckState.ASSIGNED,
+            )
+            for entry in checkpoint.unacked
+        ] + [
+            AckLogEntry(
+                timestamp_ms=checkpoint.created_ms,
+                message_id=entry.message_id,
+                consumer_id="",
+                deadline_ms=entry.deliver_at_ms,
+                state=AckState.DELAYED,
+            )
+            for entry in checkpoint.delayed
+        ]
+
+        def transactions():
+            unacked = [entry.message_id for entry in checkpoint.unacked]
+            delayed = [entry.message_id for entry in checkpoint.delayed]
+            for message_id in unacked + checkpoint.pending + delayed:
+                tx = by_id.get(message_id)
+                # None when dropped by retention
+                if tx is not None:
+                    yield tx
+            for tx in tail:
+                if tx.header.message_id not in covered:
+                    yield tx
+
+        self.initialize_queue_from_logs(transactions(), restored + ack_entries)
+
+    def get_queue_state(self) -> QueueState:
+        """Copy of the queue, the unacked map and the next binlog offset"""
+        with self._lock:
+            return QueueState(
+                list(self._q),
+                dict(self._unacked),
+                self._next_offset,
+                [(deliver_at_ms, tx) for deliver_at_ms, _, tx in sorted(self._delayed)],
+            )
+
+    def set_queue_state(self, state: QueueState):
+        """Replace the queue state, with one recovered in another process"""
+        with self._lock:
+            self._q = PriorityDeque(state.queue, self._starvation_limit)
+            self._unacked = dict(state.unacked)
+            self._rebuild_deadlines()
+            self._set_delayed(state.delayed)
+            self._next_offset = state.next_offset
+            self._ahead.clear()
+
+    def set_next_offset(self, offset: int):
+        """Binlog offset the next produced message will get, set after recovery"""
+        with self._lock:
+            self._next_offset = offset
+            self._ahead.clear()
+
+    def add_queue(
+        self, message: TransactionLog, offset: int | None = None, deliver_at_ms: int = 0
+    ):
+        """add item in the queue (queue mode)
 
-    def add_queue(self, message: TransactionLog):
-        """add item in the queue (queue mode)"""
+        offset is the binlog offset of the message, it moves the position
+        checkpoints cover. A message with a future deliver_at_ms is held back
+        until then, its delay must be logged with log_delay beforehand.
+        """
         with self._lock:
-            self._q.append(message)
+            self._pending_delays.pop(message.header.message_id, None)
+            if deliver_at_ms > int(time.time() * 1000):
+                self._schedule(message, deliver_at_ms)
+            else:
+                self._q.append(message)
+                self._notify_ready(1)
+            if offset is not None:
+                self._cover(offset, message.header.message_id)
+
+    def skip_offset(self, offset: int, message_id: str):
+        """Account for a record written to the binlog whose produce still failed
+
+        The producer was told it failed, so the message is not queued, but
+        checkpoints move past its offset. It is logged as acked, so neither
+        recovery from the logs nor the replay of a checkpoint taken before
+        delivers it.
+        """
+        with self._lock:
+            position = append_acklog(
+                self._name,
+                AckLogEntry(
+                    timestamp_ms=int(time.time() * 1000),
+                    message_id=message_id,
+                    consumer_id="",
+                    deadline_ms=0,
+                    state=AckState.ACKED,
+                ),
+            )
+            self._cover(offset, message_id)
+        wait_acklog(self._name, position)
+
+    def _cover(self, offset: int, message_id: str):
+        """Move the checkpoint watermark past offset"""
+        if offset < self._next_offset:
+            return
+        self._ahead[offset] = message_id
+        while self._next_offset in self._ahead:
+            del self._ahead[self._next_offset]
+            self._next_offset += 1
 
     def fetch_broadcast(self, transactions: list[TransactionLog]) -> list[TransactionLog]:
         """Return broadcast payloads directly"""
         return transactions
 
-    def _expire_unacked(self, now_ms: int):
-        """Requeue expired unacked messages"""
+    def log_delay(self, message_id: str, deliver_at_ms: int):
+        """Persist the delay of a message about to be produced
+
+        Logged before the binlog append, so a crash in between never delivers
+        the message early. Until add_queue takes the message, checkpoints list
+        it as delayed, so a checkpoint taken meanwhile keeps it back too. An
+        entry whose message never made it to the binlog is ignored by recovery.
+        """
+        # appended under the topic lock like every other entry, ack log
+        # compaction and checkpoints rely on it
+        with self._lock:
+            self._pending_delays[message_id] = deliver_at_ms
+            position = append_acklog(
+                self._name,
+                AckLogEntry(
+                    timestamp_ms=int(time.time() * 1000),
+                    message_id=message_id,
+                    consumer_id="",
+                    deadline_ms=deliver_at_ms,
+                    state=AckState.DELAYED,
+                ),
+            )
+        wait_acklog(self._name, position)
+
+    def cancel_delay(self, message_id: str):
+        """Forget the logged delay of a produce that failed"""
+        with self._lock:
+            self._pending_delays.pop(message_id, None)
+
+    def _set_delayed(self, delayed: Iterable[tuple[int, TransactionLog]]):
+        self._delayed = [
+            (deliver_at_ms, next(self._delay_seq), tx) for deliver_at_ms, tx in delayed
+        ]
+        heapq.heapify(self._delayed)
+
+    def _schedule(self, message: TransactionLog, deliver_at_ms: int):
+        entry = (deliver_at_ms, next(self._delay_seq), message)
+        heapq.heappush(self._delayed, entry)
+        if self._delayed[0] is entry:
+            # earlier than what the topic thread sleeps until
+            self._deadline_changed.notify()
+
+    def _release_delayed(self, now_ms: int):
+        """Queue the delayed messages that are due, at the back of their level"""
+        released = 0
+        while self._delayed and self._delayed[0][0] <= now_ms:
+            self._q.append(heapq.heappop(self._delayed)[2])
+            released += 1
+        if released:
+            self._notify_ready(released)
+
+    def _rebuild_deadlines(self):
+        """Heap of the current unacked deadlines only"""
+        self._deadlines = [
+            (item.deadline_ms, message_id) for message_id, item in self._unacked.items()
+        ]
+        heapq.heapify(self._deadlines)
+
+    def _track_deadline(self, message_id: str, deadline_ms: int):
+        heapq.heappush(self._deadlines, (deadline_ms, message_id))
+        if self._deadlines[0] == (deadline_ms, message_id):
+            # earlier than what the expiry thread sleeps until
+            self._deadline_changed.notify()
+        # stale entries of acked messages linger until their deadline, drop
+        # them in one go once they outnumber the live ones
+        if len(self._deadlines) > 2 * len(self._unacked) + 1024:
+            self._rebuild_deadlines()
+
+    def _expire_unacked(self, now_ms: int) -> tuple[str, int]:
+        """Requeue expired unacked messages
+
+        Only heap entries past their deadline are visited, so the cost is the
+        number of expired (or stale) entries, not the number in flight.
+        Returns the ack log topic and position to wait for, position 0 when
+        nothing expired.
+        """
         expired = []
-        for message_id, item in self._unacked.items():
-            if item.deadline_ms <= now_ms:
+        while self._deadlines and self._deadlines[0][0] <= now_ms:
+            deadline_ms, message_id = heapq.heappop(self._deadlines)
+            item = self._unacked.get(message_id)
+            if item is not None and item.deadline_ms == deadline_ms:
                 expired.append(message_id)
+        if not expired:
+            return self._name, 0
+        entries = []
         for message_id in expired:
             item = self._unacked.pop(message_id)
             # requeue to front for faster retry
             self._q.appendleft(item.message)
-            append_acklog(
-                item.message.header.topic,
+            entries.append(
                 AckLogEntry(
                     timestamp_ms=now_ms,
                     message_id=message_id,
                     consumer_id=item.consumer_id,
                     deadline_ms=item.deadline_ms,
                     state=AckState.EXPIRED,
-                ),
+                )
             )
+        self._notify_ready(len(expired))
+        topic = item.message.header.topic
+        return topic, append_acklog_batch(topic, entries)
+
+    def _next_wakeup_s(self, now_ms: int) -> float | None:
+        """Seconds until the earliest ack deadline or delivery time, None when there is none"""
+        due = [heap[0][0] for heap in (self._deadlines, self._delayed) if heap]
+        if not due:
+            return None
+        return max(min(due) - now_ms, 0) / 1000
 
     def consume_queue(self, consumer_id: str, ack_timeout_ms: int) -> TransactionLog | None:
         """Consume one message in queue mode"""
+        messages = self.consume_queue_batch(consumer_id, ack_timeout_ms, 1)
+        return messages[0] if messages else None
+
+    def consume_queue_batch(
+        self,
+        consumer_id: str,
+        ack_timeout_ms: int,
+        max_messages: int,
+        max_bytes: int = 0,
+        wait_ms: int = 0,
+    ) -> list[TransactionLog]:
+        """Consume up to max_messages in queue mode
+
+        max_bytes caps the payload bytes handed out, 0 for no cap, the first
+        message is always taken. The messages are assigned under one lock
+        acquisition and their ack log entries queued as one batch, waited for
+        once the lock is released. Expiry is left to the topic thread, a topic
+        that was never started expires (and releases delayed messages) here
+        instead.
+
+        On an empty queue, waits up to wait_ms for a message. Every queued,
+        nacked or expired message wakes one waiting consumer.
+        """
         now_ms = int(time.time() * 1000)
+        messages: list[TransactionLog] = []
         with self._lock:
-            self._expire_unacked(now_ms)
-            if not self._q:
-                return None
-            message = self._q.popleft()
-            self._unacked[message.header.message_id] = UnackedMessage(
-                message=message,
-                consumer_id=consumer_id,
-                deadline_ms=now_ms + ack_timeout_ms,
-            )
-            append_acklog(
-                message.header.topic,
-                AckLogEntry(
-                    timestamp_ms=now_ms,
-                    message_id=message.header.message_id,
+            topic, position = self._name, 0
+            if not self.is_alive():
+                self._release_delayed(now_ms)
+                topic, position = self._expire_unacked(now_ms)
+            if not self._q and wait_ms > 0:
+                self._wait_for_message(wait_ms / 1000)
+                now_ms = int(time.time() * 1000)
+            deadline_ms = now_ms + ack_timeout_ms
+            size = 0
+            while self._q and len(messages) < max_messages:
+                size += self._q.peek().header.payload_size
+                if messages and 0 < max_bytes < size:
+                    break
+                message = self._q.popleft()
+                message_id = message.header.message_id
+                self._unacked[message_id] = UnackedMessage(
+                    message=message,
                     consumer_id=consumer_id,
-                    deadline_ms=now_ms + ack_timeout_ms,
-                    state=AckState.ASSIGNED,
-                ),
-            )
-            return message
+                    deadline_ms=deadline_ms,
+                )
+                self._track_deadline(message_id, deadline_ms)
+                messages.append(message)
+            if self._q and messages:
+                # a wake up may have been for messages this batch left behind
+                self._notify_ready(1)
+            if messages:
+                topic = messages[0].header.topic
+                position = append_acklog_batch(
+                    topic,
+                    [
+                        AckLogEntry(
+                            timestamp_ms=now_ms,
+                            message_id=message.header.message_id,
+                            consumer_id=consumer_id,
+                            deadline_ms=deadline_ms,
+                            state=AckState.ASSIGNED,
+                        )
+                        for message in messages
+                    ],
+                )
+        wait_acklog(topic, position)
+        return messages
+
+    def _notify_ready(self, n: int):
+        """Wake n consumers waiting on this topic, and on any partition of it"""
+        self._message_ready.notify(n)
+        if self._arrivals is not None:
+            self._arrivals.notify(n)
+
+    def _wait_for_message(self, timeout_s: float):
+        """Wait on the topic lock until a message is queued, the timeout passes or stop"""
+        until = time.monotonic() + timeout_s
+        while not self._q and not self._stop_event.is_set():
+            remaining = until - time.monotonic()
+            if remaining <= 0:
+                return
+            self._message_ready.wait(remaining)
 
     def ack_queue(self, message_id: str, consumer_id: str) -> bool:
         """Ack message in queue mode"""
-        now_ms = int(time.time() * 1000)
-        with self._lock:
-            item = self._unacked.get(message_id)
-            if not item:
-                return False
-            if item.consumer_id != consumer_id:
-                return False
-            self._unacked.pop(message_id)
-            append_acklog(
-                item.message.header.topic,
-                AckLogEntry(
-                    timestamp_ms=now_ms,
-                    message_id=message_id,
-                    consumer_id=consumer_id,
-                    deadline_ms=item.deadline_ms,
-                    state=AckState.ACKED,
-                ),
-            )
-            return True
+        return self.ack_queue_batch([message_id], consumer_id)[0]
 
-    def nack_queue(self, message_id: str, consumer_id: str) -> bool:
+    def nack_queue(self, message_id: str, consumer_id: str, delay_ms: int = 0) -> bool:
         """Nack message in queue mode (requeue)"""
+        return self.nack_queue_batch([message_id], consumer_id, delay_ms)[0]
+
+    def ack_queue_batch(self, message_ids: list[str], consumer_id: str) -> list[bool]:
+        """Ack messages in queue mode, returns whether each one was acked"""
+        return self._settle_queue(message_ids, consumer_id, AckState.ACKED)
+
+    def nack_queue_batch(
+        self, message_ids: list[str], consumer_id: str, delay_ms: int = 0
+    ) -> list[bool]:
+        """Nack messages in queue mode (requeue), returns whether each one was nacked
+
+        Nacked messages go back to the front of the queue in the given order,
+        or with a delay_ms to the back of it once the delay has passed.
+        """
+        if delay_ms > 0:
+            return self._settle_queue(message_ids, consumer_id, AckState.DELAYED, delay_ms)
+        return self._settle_queue(message_ids, consumer_id, AckState.NACKED)
+
+    def _settle_queue(
+        self, message_ids: list[str], consumer_id: str, state: AckState, delay_ms: int = 0
+    ) -> list[bool]:
+        """Ack, nack or delay messages under one lock acquisition and one ack log batch
+
+        A message fails when it is not unacked or is assigned to another
+        consumer.
+        """
         now_ms = int(time.time() * 1000)
+        results = []
+        entries = []
+        requeued = []
         with self._lock:
-            item = self._unacked.get(message_id)
-            if not item:
-                return False
-            if item.consumer_id != consumer_id:
-                return False
-            self._unacked.pop(message_id)
-            self._q.appendleft(item.message)
-            append_acklog(
-                item.message.header.topic,
-                AckLogEntry(
-                    timestamp_ms=now_ms,
-                    message_id=message_id,
-                    consumer_id=consumer_id,
-                    deadline_ms=item.deadline_ms,
-                    state=AckState.NACKED,
-                ),
+            for message_id in message_ids:
+                item = self._unacked.get(message_id)
+                if not item or item.consumer_id != consumer_id:
+                    results.append(False)
+                    continue
+                self._unacked.pop(message_id)
+                deadline_ms = item.deadline_ms
+                if state == AckState.NACKED:
+                    requeued.append(item.message)
+                elif state == AckState.DELAYED:
+                    deadline_ms = now_ms + delay_ms
+                    self._schedule(item.message, deadline_ms)
+                topic = item.message.header.topic
+                entries.append(
+                    AckLogEntry(
+                        timestamp_ms=now_ms,
+                        message_id=message_id,
+                        consumer_id=consumer_id,
+                        deadline_ms=deadline_ms,
+                        state=state,
+                    )
+                )
+                results.append(True)
+            if not entries:
+                return results
+            self._q.extendleft(reversed(requeued))
+            if requeued:
+                self._notify_ready(len(requeued))
+            position = append_acklog_batch(topic, entries)
+        wait_acklog(topic, position)
+        return results
+
+    def snapshot_queue(self) -> QueueCheckpoint:
+        """Capture the queue state with the log positions it covers
+
+        Ack log entries are queued under the topic lock, so the position read
+        here matches the unacked map exactly. The entries up to it are written
+        out before the ack log bytes are fingerprinted.
+        """
+        with self._lock:
+            position = get_acklog_position(self._name)
+            checkpoint = QueueCheckpoint(
+                created_ms=int(time.time() * 1000),
+                binlog_offset=self._next_offset,
+                acklog_position=position,
+                acklog_crc=0,
+                pending=[tx.header.message_id for tx in self._q],
+                unacked=[
+                    UnackedEntry(message_id, item.consumer_id, item.deadline_ms)
+                    for message_id, item in self._unacked.items()
+                ],
+                covered=list(self._ahead.values()),
+                delayed=[
+                    DelayedEntry(tx.header.message_id, deliver_at_ms)
+                    for deliver_at_ms, _, tx in self._delayed
+                ]
+                + [
+                    DelayedEntry(message_id, deliver_at_ms)
+                    for message_id, deliver_at_ms in self._pending_delays.items()
+                ],
             )
-            return True
+        sync_acklog(self._name)
+        checkpoint.acklog_crc = acklog_fingerprint(self._name, position)
+        return checkpoint
+
+    def checkpoint(self) -> bool:
+        """Write a checkpoint unless nothing changed since the last one"""
+        if self._mode != Mode.QUEUE or not self._name:
+            return False
+        with self._lock:
+            state = (self._next_offset, len(self._ahead), get_acklog_position(self._name))
+        if state == self._last_checkpoint:
+            return False
+        write_checkpoint(self._name, self.snapshot_queue(), self._checkpoint.keep)
+        self._last_checkpoint = state
+        return True
+
+    def compact_acklog(self) -> int:
+        """Compact the ack log while appends continue, returns its new size
+
+        Only the catch-up and the swap hold the topic lock. The rewrite moves
+        every ack log position, so a fresh checkpoint is written right away.
+        """
+        size = compact_acklog(self._name, self._lock)
+        if self._checkpoint.interval_ms > 0:
+            self.checkpoint()
+        return size
 
     def run(self):
+        """Expire unacked messages, queue delayed ones when due, checkpoint every interval
+
+        All messages expired on one wake up share a single ack log batch.
+        """
+        interval_s = self._checkpoint.interval_ms / 1000
+        next_checkpoint = time.monotonic() + interval_s
         while not self._stop_event.is_set():
-            time.sleep(1)
+            try:
+                with self._lock:
+                    timeout = self._next_wakeup_s(int(time.time() * 1000))
+                    if interval_s > 0:
+                        until_checkpoint = max(next_checkpoint - time.monotonic(), 0)
+                        if timeout is None or until_checkpoint < timeout:
+                            timeout = until_checkpoint
+                    if timeout is None or timeout > 0:
+                        self._deadline_changed.wait(timeout)
+                    if self._stop_event.is_set():
+                        return
+                    now_ms = int(time.time() * 1000)
+                    self._release_delayed(now_ms)
+                    topic, position = self._expire_unacked(now_ms)
+                wait_acklog(topic, position)
+                if interval_s > 0 and time.monotonic() >= next_checkpoint:
+                    next_checkpoint = time.monotonic() + interval_s
+                    self.checkpoint()
+            except Exception as e:  # pylint: disable=broad-except
+                SLOG.error(e)
+                self._stop_event.wait(1)
 
     def stop(self):
         self._stop_event.set()
+        with self._lock:
+            self._deadline_changed.notify_all()
+            self._message_ready.notify_all()
@@ -4,13 +4,31 @@ import threading
 import time
 import json
 import base64
+import select
 from uuid import uuid4
+from functools import partial
+from exception import BinLogAppendException
 from server.util.config import ServerConfig
 from server.core.socket import Socket
-from server.core.topic import Topic
-from server.core.binlog import read_bin, append_bin, TransactionLog, TransactionLogHeader
-from server.core.acklog import read_acklog
+from server.core.partition import PartitionedTopic, partition_configs
+from server.core.binlog import (
+    read_tail,
+    wait_bin,
+    get_tail_stats,
+    find_offset,
+    get_message,
+    append_bin,
+    configure_topic,
+    configure_group_commit,
+    MAX_PRIORITY,
+    TransactionLog,
+    TransactionLogHeader,
+)
+from server.core.acklog import configure_acklog
+from server.core.compactor import AckLogCompactor, BinLogCompactor
+from server.core.recovery import QueueRecovery
 from server.util.config import Server
+from server.system_logger import SLOG
 
 
 class SMSServer(threading.Thread):
@@ -22,26 +40,50 @@ class SMSServer(threading.Thread):
         self._lock = threading.Lock()
         self._stop_event = threading.Event()
         self._conn = None
-        self._topics: dict[str:Topic] = {}
+        self._topics: dict[str:PartitionedTopic] = {}
+        self._compactor = None
+        self._ack_compactor = None
+        self._recovery = QueueRecovery(config.recovery_workers)
 
     def run(self):
         """Thread runnable function"""
 
         # init topics based on configs
+        configure_group_commit(self._config.group_commit)
+        configure_acklog(self._config.ack_log)
+        queue_topics = []
         for topic in self._config.topics:
-            self._topics[topic.name] = Topic(topic.mode)
+            partitioned = PartitionedTopic(
+                topic, self._config.checkpoint, self._config.queue_starvation_limit
+            )
+            self._topics[topic.name] = partitioned
+            # every partition has its own logs, recovered and compacted on its own
+            for config, partition in zip(partition_configs(topic), partitioned.get_partitions()):
+                configure_topic(config.name, config.segment, config.compression, config.tail)
+                if topic.mode.name.lower() == "queue":
+                    queue_topics.append((config, partition))
 
-        # read bin files and setup topics
-        for name, topic in self._topics.items():
-            binlog = read_bin(name)
-            if topic.get_mode().name.lower() == "queue":
-                ack_entries = read_acklog(name)
-                topic.initialize_queue_from_logs(binlog.get_transactions(), ack_entries)
+        # restore queue partitions concurrently, each one serves (and starts
+        # checkpointing) as soon as it is ready
+        # drop acked messages from queue binlogs and superseded entries from
+        # ack logs in the background, once recovery is done with them
+        self._compactor = BinLogCompactor(
+            [topic.name for topic, _ in queue_topics], self._config.compaction
+        )
+        self._ack_compactor = AckLogCompactor(
+            {topic.name: queue_topic for topic, queue_topic in queue_topics},
+            self._config.ack_compaction,
+        )
+        self._recovery.start(queue_topics, self._start_compactors)
 
         # init tcp server
         self._conn = Socket(self._config.socket.ip, self._config.socket.port)
         self._conn.serve(self.message_handler, not self._stop_event.is_set())
 
+    def _start_compactors(self):
+        self._compactor.start()
+        self._ack_compactor.start()
+
     def _response(self, status: str, **kwargs):
         payload = {"status": status}
         payload.update(kwargs)
@@ -66,8 +108,24 @@ class SMSServer(threading.Thread):
             Socket.send_framed(socket, self._response("error", error="unknown_topic"))
             return None
 
+        if any(self._recovery.is_recovering(p.get_name()) for p in topic.get_partitions()):
+            Socket.send_framed(socket, self._response("error", error="topic_recovering", topic=topic_name))
+            return None
+
         mode = topic.get_mode()
 
+        # without a partition, produce routes by key hash or round-robin,
+        # queue consume/ack/nack and get look at every partition and
+        # broadcast reads name theirs unless the topic has a single one
+        partition = request.get("partition")
+        if partition is not None:
+            partition = int(partition)
+            if not 0 <= partition < len(topic.get_partitions()):
+                Socket.send_framed(
+                    socket, self._response("error", error="invalid_partition", topic=topic_name)
+                )
+                return None
+
         if req_type == "produce":
             payload_b64 = request.get("payload_b64")
             producer = request.get("producer", {})
@@ -80,11 +138,33 @@ class SMSServer(threading.Thread):
                 Socket.send_framed(socket, self._response("error", error="invalid_payload_b64"))
                 return None
 
+            # queue consumes serve higher priorities first, broadcast ignores it
+            priority = int(request.get("priority", 0))
+            if not 0 <= priority <= MAX_PRIORITY:
+                Socket.send_framed(socket, self._response("error", error="invalid_priority"))
+                return None
+            # deliver_at_ms (unix ms) or delay_ms hold a queue message back,
+            # a time already passed is a plain produce
+            now_ms = int(time.time() * 1000)
+            deliver_at_ms = 0
+            if request.get("deliver_at_ms") is not None:
+                deliver_at_ms = int(request["deliver_at_ms"])
+            elif request.get("delay_ms") is not None:
+                deliver_at_ms = now_ms + max(int(request["delay_ms"]), 0)
+            if deliver_at_ms <= now_ms:
+                deliver_at_ms = 0
+            if deliver_at_ms and mode.name.lower() != "queue":
+                Socket.send_framed(socket, self._response("error", error="delay_only_for_queue"))
+                return None
+            if partition is None:
+                key = request.get("key")
+                partition = topic.route(None if key is None else str(key))
+            partition_topic = topic.get_partition(partition)
             message_id = str(uuid4())
             transaction = TransactionLog(
                 header=TransactionLogHeader(
                     timestamp=int(time.time()),
-                    topic=topic_name,
+                    topic=partition_topic.get_name(),
                     message_id=message_id,
                     producer=Server(
                         host=str(producer.get("host", "unknown")),
@@ -92,30 +172,61 @@ class SMSServer(threading.Thread):
                         port=int(producer.get("port", 0)),
                     ),
                     payload_size=len(payload),
+                    priority=priority,
                 ),
                 data=payload,
             )
-            append_bin(topic_name, transaction)
+            if deliver_at_ms:
+                partition_topic.log_delay(message_id, deliver_at_ms)
+            try:
+                offset = append_bin(partition_topic.get_name(), transaction)
+            except Exception as e:
+                # the producer is told it failed, so nothing of it is delivered
+                if mode.name.lower() == "queue":
+                    partition_topic.cancel_delay(message_id)
+                    if isinstance(e, BinLogAppendException):
+                        partition_topic.skip_offset(e.offset, message_id)
+                raise
             if mode.name.lower() == "queue":
-                topic.add_queue(transaction)
+                partition_topic.add_queue(transaction, offset, deliver_at_ms)
             Socket.send_framed(
                 socket,
-                self._response("ok", type="produce_ack", topic=topic_name, message_id=message_id),
+                self._response(
+                    "ok",
+                    type="produce_ack",
+                    topic=topic_name,
+                    partition=partition,
+                    message_id=message_id,
+                    **({"deliver_at_ms": deliver_at_ms} if deliver_at_ms else {}),
+                ),
             )
             return None
 
         if req_type == "consume":
             if mode.name.lower() == "broadcast":
+                partition = topic.read_partition(partition)
+                if partition is None:
+                    Socket.send_framed(
+                        socket,
+                        self._response("error", error="partition_required", topic=topic_name),
+                    )
+                    return None
+                name = topic.get_partition(partition).get_name()
                 offset = int(request.get("offset", 0))
-                binlog = read_bin(topic_name, offset=offset)
-                transactions = binlog.get_transactions()
+                if request.get("from_timestamp") is not None:
+                    offset = find_offset(name, int(request["from_timestamp"]))
+                max_messages = int(
+                    request.get("max_messages", self._config.broadcast_max_messages)
+                )
+                # caught-up consumers are served from the in-memory tail
+                records, next_offset = read_tail(name, offset, max_messages, zero_copy=True)
                 messages = [
                     {
                         "message_id": t.header.message_id,
                         "timestamp": t.header.timestamp,
                         "payload_b64": base64.b64encode(t.data).decode("utf-8"),
                     }
-                    for t in transactions
+                    for _, t in records
                 ]
                 Socket.send_framed(
                     socket,
@@ -124,8 +235,9 @@ class SMSServer(threading.Thread):
                         type="consume",
                         mode="broadcast",
                         topic=topic_name,
+                        partition=partition,
                         messages=messages,
-                        next_offset=offset + len(messages),
+                        next_offset=next_offset,
                     ),
                 )
                 return None
@@ -144,8 +256,20 @@ class SMSServer(threading.Thread):
                         self._config.queue_ack_timeout_ms,
                     )
                 )
-                message = topic.consume_queue(consumer_id, ack_timeout_ms)
-                if message is None:
+                # max_messages asks for a batch, answered with a messages list
+                batch = request.get("max_messages") is not None
+                max_messages = 1
+                if batch:
+                    max_messages = min(
+                        max(int(request["max_messages"]), 1), self._config.queue_max_messages
+                    )
+                max_bytes = int(request.get("max_bytes", 0))
+                # long poll, the connection thread waits on the topic for a message
+                wait_ms = min(int(request.get("wait_ms", 0)), self._config.queue_max_wait_ms)
+                partition, messages = topic.consume_queue_batch(
+                    consumer_id, ack_timeout_ms, max_messages, max_bytes, wait_ms, partition
+                )
+                if not messages:
                     Socket.send_framed(
                         socket,
                         self._response(
@@ -155,66 +279,230 @@ class SMSServer(threading.Thread):
                     return None
 
                 if ack_mode == "auto":
-                    topic.ack_queue(message.header.message_id, consumer_id)
+                    topic.ack_queue_batch(
+                        [message.header.message_id for message in messages], consumer_id, partition
+                    )
 
-                Socket.send_framed(
-                    socket,
-                    self._response(
+                payloads = [
+                    {
+                        "message_id": message.header.message_id,
+                        "timestamp": message.header.timestamp,
+                        "priority": message.header.priority,
+                        "payload_b64": base64.b64encode(message.data).decode("utf-8"),
+                    }
+                    for message in messages
+                ]
+                if batch:
+                    response = self._response(
                         "ok",
                         type="consume",
                         mode="queue",
                         topic=topic_name,
-                        message={
-                            "message_id": message.header.message_id,
-                            "timestamp": message.header.timestamp,
-                            "payload_b64": base64.b64encode(message.data).decode("utf-8"),
-                        },
-                    ),
-                )
+                        partition=partition,
+                        messages=payloads,
+                    )
+                else:
+                    response = self._response(
+                        "ok",
+                        type="consume",
+                        mode="queue",
+                        topic=topic_name,
+                        partition=partition,
+                        message=payloads[0],
+                    )
+                Socket.send_framed(socket, response)
                 return None
 
             Socket.send_framed(socket, self._response("error", error="unsupported_mode"))
             return None
 
-        if req_type == "ack":
-            if mode.name.lower() != "queue":
-                Socket.send_framed(socket, self._response("error", error="ack_only_for_queue"))
+        if req_type == "subscribe":
+            if mode.name.lower() != "broadcast":
+                Socket.send_framed(
+                    socket, self._response("error", error="subscribe_only_for_broadcast")
+                )
                 return None
-            consumer_id = str(request.get("consumer_id", "unknown"))
+            partition = topic.read_partition(partition)
+            if partition is None:
+                Socket.send_framed(
+                    socket, self._response("error", error="partition_required", topic=topic_name)
+                )
+                return None
+            name = topic.get_partition(partition).get_name()
+            offset = int(request.get("offset", 0))
+            if request.get("from_timestamp") is not None:
+                offset = find_offset(name, int(request["from_timestamp"]))
+            credits = int(request.get("credits", self._config.broadcast_subscribe_credits))
+            # messages per pushed batch, capped by the server
+            max_messages = self._config.broadcast_subscribe_max_messages
+            max_messages = min(max(int(request.get("max_messages", max_messages)), 1), max_messages)
+            Socket.send_framed(
+                socket,
+                self._response(
+                    "ok",
+                    type="subscribe",
+                    topic=topic_name,
+                    partition=partition,
+                    next_offset=offset,
+                ),
+            )
+            try:
+                self._stream(socket, topic_name, partition, name, offset, credits, max_messages)
+            except (OSError, ValueError) as e:
+                SLOG.info(f"subscription to {topic_name} closed: {e}")
+            return None
+
+        if req_type == "get":
             message_id = str(request.get("message_id", ""))
             if not message_id:
                 Socket.send_framed(socket, self._response("error", error="missing_message_id"))
                 return None
-            ok = topic.ack_queue(message_id, consumer_id)
-            if ok:
+            found = None
+            indexes = range(len(topic.get_partitions())) if partition is None else [partition]
+            for index in indexes:
+                found = get_message(topic.get_partition(index).get_name(), message_id)
+                if found is not None:
+                    partition = index
+                    break
+            if found is None:
                 Socket.send_framed(
-                    socket, self._response("ok", type="ack", topic=topic_name, message_id=message_id)
-                )
-            else:
-                Socket.send_framed(
-                    socket, self._response("error", error="ack_failed", message_id=message_id)
+                    socket, self._response("error", error="message_not_found", message_id=message_id)
                 )
+                return None
+            record_offset, t = found
+            Socket.send_framed(
+                socket,
+                self._response(
+                    "ok",
+                    type="get",
+                    topic=topic_name,
+                    partition=partition,
+                    offset=record_offset,
+                    message={
+                        "message_id": t.header.message_id,
+                        "timestamp": t.header.timestamp,
+                        "payload_b64": base64.b64encode(t.data).decode("utf-8"),
+                    },
+                ),
+            )
             return None
 
-        if req_type == "nack":
+        if req_type == "stats":
+            Socket.send_framed(
+                socket,
+                self._response(
+                    "ok",
+                    type="stats",
+                    topic=topic_name,
+                    partition=partition or 0,
+                    partitions=len(topic.get_partitions()),
+                    tail=get_tail_stats(topic.get_partition(partition or 0).get_name()),
+                ),
+            )
+            return None
+
+        if req_type in ("ack", "nack"):
             if mode.name.lower() != "queue":
-                Socket.send_framed(socket, self._response("error", error="nack_only_for_queue"))
+                Socket.send_framed(
+                    socket, self._response("error", error=f"{req_type}_only_for_queue")
+                )
                 return None
             consumer_id = str(request.get("consumer_id", "unknown"))
+            if req_type == "ack":
+                settle = topic.ack_queue_batch
+            else:
+                # with delay_ms nacked messages are redelivered once it has passed
+                delay_ms = max(int(request.get("delay_ms", 0)), 0)
+                settle = partial(topic.nack_queue_batch, delay_ms=delay_ms)
+            # message_ids settles a batch and answers with a result per id
+            message_ids = request.get("message_ids")
+            if message_ids is not None:
+                if not isinstance(message_ids, list) or not message_ids:
+                    Socket.send_framed(socket, self._response("error", error="missing_message_id"))
+                    return None
+                message_ids = [str(message_id) for message_id in message_ids]
+                results = settle(message_ids, consumer_id, partition)
+                Socket.send_framed(
+                    socket,
+                    self._response(
+                        "ok",
+                        type=req_type,
+                        topic=topic_name,
+                        results=[
+                            {"message_id": message_id, "ok": ok}
+                            for message_id, ok in zip(message_ids, results)
+                        ],
+                    ),
+                )
+                return None
             message_id = str(request.get("message_id", ""))
             if not message_id:
                 Socket.send_framed(socket, self._response("error", error="missing_message_id"))
                 return None
-            ok = topic.nack_queue(message_id, consumer_id)
-            if ok:
+            if settle([message_id], consumer_id, partition)[0]:
                 Socket.send_framed(
-                    socket, self._response("ok", type="nack", topic=topic_name, message_id=message_id)
+                    socket,
+                    self._response("ok", type=req_type, topic=topic_name, message_id=message_id),
                 )
             else:
                 Socket.send_framed(
-                    socket, self._response("error", error="nack_failed", message_id=message_id)
+                    socket,
+                    self._response("error", error=f"{req_type}_failed", message_id=message_id),
                 )
             return None
 
         Socket.send_framed(socket, self._response("error", error="unsupported_type"))
         return None
+
+    def _stream(
+        self,
+        sock,
+        topic_name: str,
+        partition: int,
+        name: str,
+        offset: int,
+        credits: int,
+        max_messages: int,
+    ):
+        """Push committed records of a broadcast topic until the subscriber goes away
+
+        Every pushed batch spends one credit. Once they are spent nothing is
+        read or buffered until the subscriber sends a credit frame, so a slow
+        subscriber only ever has that many batches in flight.
+        """
+        while not self._stop_event.is_set():
+            # take credit frames, block for one once the credits are spent
+            while credits <= 0 or select.select([sock], [], [], 0)[0]:
+                frame = Socket.recv_framed(sock)
+                if frame is None:
+                    return
+                credits += int(json.loads(frame.decode("utf-8")).get("credits", 0))
+            records, next_offset = read_tail(name, offset, max_messages, zero_copy=True)
+            if not records:
+                # step over unreadable records, otherwise wake up now and then
+                # to notice credit frames and closed sockets
+                if next_offset == offset:
+                    wait_bin(name, offset, 0.5)
+                offset = next_offset
+                continue
+            offset = next_offset
+            Socket.send_framed(
+                sock,
+                self._response(
+                    "ok",
+                    type="records",
+                    topic=topic_name,
+                    partition=partition,
+                    messages=[
+                        {
+                            "offset": record_offset,
+                            "message_id": t.header.message_id,
+                            "timestamp": t.header.timestamp,
+                            "payload_b64": base64.b64encode(t.data).decode("utf-8"),
+                        }
+                        for record_offset, t in records
+                    ],
+                    next_offset=offset,
+                ),
+            )
+            credits -= 1
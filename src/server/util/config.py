@@ -2,9 +2,89 @@
 
 import os
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 import yaml
 from server.core.mode import Mode
+from exception import (
+    UnexpectedCodecStringValue,
+    UnexpectedCompressionLevelValue,
+    UnexpectedDurabilityStringValue,
+)
+
+
+@dataclass
+class SegmentConfig:
+    """Binlog segment rolling and retention, 0 disables a limit"""
+
+    max_bytes: int = 64 * 1024 * 1024
+    max_records: int = 0
+    retention_ms: int = 0
+    retention_bytes: int = 0
+
+
+@dataclass
+class GroupCommitConfig:
+    """Binlog group commit, batches of produce requests share one write and fsync"""
+
+    window_ms: int = 2
+    max_batch: int = 256
+    fsync: bool = True
+
+
+@dataclass
+class CompactionConfig:
+    """Background binlog compaction of queue topics, interval_ms 0 disables it"""
+
+    interval_ms: int = 60000
+    min_dead_ratio: float = 0.5
+
+
+@dataclass
+class AckLogConfig:
+    """Ack log writer buffering, durability is async, write or fsync"""
+
+    durability: str = "write"
+    batch_size: int = 256
+    flush_interval_ms: int = 5
+
+
+@dataclass
+class AckCompactionConfig:
+    """Ack log compaction triggers, checked every check_interval_ms, 0 disables a trigger
+
+    A log is compacted once min_dead_ratio of its entries are superseded,
+    once it is past max_bytes and twice its size after the last compaction,
+    or interval_ms after the last compaction, provided anything is dead.
+    """
+
+    check_interval_ms: int = 5000
+    min_dead_ratio: float = 0.5
+    max_bytes: int = 64 * 1024 * 1024
+    interval_ms: int = 0
+
+
+@dataclass
+class CheckpointConfig:
+    """Queue-state checkpoints, interval_ms 0 disables them"""
+
+    interval_ms: int = 30000
+    keep: int = 2
+
+
+@dataclass
+class CompressionConfig:
+    """Binlog batch compression, codec is none, zlib or lzma"""
+
+    codec: str = "none"
+    level: int = 6
+
+
+@dataclass
+class TailConfig:
+    """In-memory buffer of the newest records, 0 disables a limit and both 0 the buffer"""
+
+    max_records: int = 1024
+    max_bytes: int = 4 * 1024 * 1024
 
 
 @dataclass
@@ -13,6 +93,10 @@ class TopicConfig:
 
     name: str
     mode: Mode
+    segment: SegmentConfig = field(default_factory=SegmentConfig)
+    compression: CompressionConfig = field(default_factory=CompressionConfig)
+    tail: TailConfig = field(default_factory=TailConfig)
+    partitions: int = 1
 
 
 @dataclass
@@ -34,6 +118,18 @@ class ServerConfig:
     queue_ack_mode_default: str
     queue_ack_timeout_ms: int
     queue_auto_ack_delay_ms: int
+    broadcast_max_messages: int = 0
+    broadcast_subscribe_credits: int = 8
+    broadcast_subscribe_max_messages: int = 100
+    queue_max_messages: int = 1000
+    queue_max_wait_ms: int = 30000
+    queue_starvation_limit: int = 0
+    group_commit: GroupCommitConfig = field(default_factory=GroupCommitConfig)
+    compaction: CompactionConfig = field(default_factory=CompactionConfig)
+    checkpoint: CheckpointConfig = field(default_factory=CheckpointConfig)
+    recovery_workers: int = 0
+    ack_compaction: AckCompactionConfig = field(default_factory=AckCompactionConfig)
+    ack_log: AckLogConfig = field(default_factory=AckLogConfig)
 
 
 def read_config():
@@ -54,10 +150,136 @@ def read_config():
             "Web", str(config["web_server"]["ip"]), int(config["web_server"]["port"])
         ),
         topics=[
-            TopicConfig(name=t["name"], mode=Mode.get_from_str(t["mode"]))
+            TopicConfig(
+                name=t["name"],
+                mode=Mode.get_from_str(t["mode"]),
+                segment=read_segment_config(t.get("segment", {})),
+                compression=read_compression_config(t.get("compression", {})),
+                tail=read_tail_config(t.get("tail", {})),
+                partitions=int(t.get("partitions", 1)),
+            )
             for t in config["topics"]
         ],
         queue_ack_mode_default=str(config.get("queue_settings", {}).get("ack_mode_default", "manual")),
         queue_ack_timeout_ms=int(config.get("queue_settings", {}).get("ack_timeout_ms", 60000)),
         queue_auto_ack_delay_ms=int(config.get("queue_settings", {}).get("auto_ack_delay_ms", 30000)),
+        queue_max_messages=int(config.get("queue_settings", {}).get("max_messages", 1000)),
+        queue_max_wait_ms=int(config.get("queue_settings", {}).get("max_wait_ms", 30000)),
+        queue_starvation_limit=int(
+            config.get("queue_settings", {}).get("priority_starvation_limit", 0)
+        ),
+        broadcast_max_messages=int(config.get("broadcast_settings", {}).get("max_messages", 0)),
+        broadcast_subscribe_credits=int(
+            config.get("broadcast_settings", {}).get("subscribe_credits", 8)
+        ),
+        broadcast_subscribe_max_messages=int(
+            config.get("broadcast_settings", {}).get("subscribe_max_messages", 100)
+        ),
+        group_commit=read_group_commit_config(config.get("binlog_settings", {})),
+        compaction=read_compaction_config(config.get("binlog_settings", {})),
+        checkpoint=read_checkpoint_config(config.get("queue_settings", {})),
+        recovery_workers=int(config.get("queue_settings", {}).get("recovery_workers", 0)),
+        ack_compaction=read_ack_compaction_config(config.get("queue_settings", {})),
+        ack_log=read_ack_log_config(config.get("queue_settings", {})),
+    )
+
+
+def read_segment_config(segment: dict) -> SegmentConfig:
+    """Per-topic segment settings, missing keys fall back to the defaults"""
+    default = SegmentConfig()
+    return SegmentConfig(
+        max_bytes=int(segment.get("max_bytes", default.max_bytes)),
+        max_records=int(segment.get("max_records", default.max_records)),
+        retention_ms=int(segment.get("retention_ms", default.retention_ms)),
+        retention_bytes=int(segment.get("retention_bytes", default.retention_bytes)),
+    )
+
+
+def read_tail_config(tail: dict) -> TailConfig:
+    """Per-topic tail buffer settings, missing keys fall back to the defaults"""
+    default = TailConfig()
+    return TailConfig(
+        max_records=int(tail.get("max_records", default.max_records)),
+        max_bytes=int(tail.get("max_bytes", default.max_bytes)),
+    )
+
+
+def read_group_commit_config(binlog_settings: dict) -> GroupCommitConfig:
+    """Group commit settings from binlog_settings, missing keys fall back to the defaults"""
+    default = GroupCommitConfig()
+    return GroupCommitConfig(
+        window_ms=int(binlog_settings.get("group_commit_window_ms", default.window_ms)),
+        max_batch=int(binlog_settings.get("group_commit_max_batch", default.max_batch)),
+        fsync=bool(binlog_settings.get("fsync", default.fsync)),
+    )
+
+
+# levels each codec accepts, zlib -1 is its own default
+COMPRESSION_LEVELS = {"none": None, "zlib": range(-1, 10), "lzma": range(0, 10)}
+
+
+def read_compression_config(compression: dict) -> CompressionConfig:
+    """Per-topic compression settings, missing keys fall back to the defaults
+
+    The level is checked against the codec here, so a bad one stops the
+    server at startup instead of failing the first produce.
+    """
+    default = CompressionConfig()
+    codec = str(compression.get("codec", default.codec)).lower()
+    if codec not in COMPRESSION_LEVELS:
+        raise UnexpectedCodecStringValue()
+    level = int(compression.get("level", default.level))
+    levels = COMPRESSION_LEVELS[codec]
+    if levels is not None and level not in levels:
+        raise UnexpectedCompressionLevelValue()
+    return CompressionConfig(codec=codec, level=level)
+
+
+def read_compaction_config(binlog_settings: dict) -> CompactionConfig:
+    """Compaction settings from binlog_settings, missing keys fall back to the defaults"""
+    default = CompactionConfig()
+    return CompactionConfig(
+        interval_ms=int(binlog_settings.get("compaction_interval_ms", default.interval_ms)),
+        min_dead_ratio=float(
+            binlog_settings.get("compaction_min_dead_ratio", default.min_dead_ratio)
+        ),
+    )
+
+
+def read_checkpoint_config(queue_settings: dict) -> CheckpointConfig:
+    """Checkpoint settings from queue_settings, missing keys fall back to the defaults"""
+    default = CheckpointConfig()
+    return CheckpointConfig(
+        interval_ms=int(queue_settings.get("checkpoint_interval_ms", default.interval_ms)),
+        keep=int(queue_settings.get("checkpoint_keep", default.keep)),
+    )
+
+
+def read_ack_compaction_config(queue_settings: dict) -> AckCompactionConfig:
+    """Ack log compaction settings from queue_settings, missing keys fall back to the defaults"""
+    default = AckCompactionConfig()
+    return AckCompactionConfig(
+        check_interval_ms=int(
+            queue_settings.get("ack_compaction_check_interval_ms", default.check_interval_ms)
+        ),
+        min_dead_ratio=float(
+            queue_settings.get("ack_compaction_min_dead_ratio", default.min_dead_ratio)
+        ),
+        max_bytes=int(queue_settings.get("ack_compaction_max_bytes", default.max_bytes)),
+        interval_ms=int(queue_settings.get("ack_compaction_interval_ms", default.interval_ms)),
+    )
+
+
+def read_ack_log_config(queue_settings: dict) -> AckLogConfig:
+    """Ack log writer settings from queue_settings, missing keys fall back to the defaults"""
+    default = AckLogConfig()
+    durability = str(queue_settings.get("ack_log_durability", default.durability)).lower()
+    if durability not in ("async", "write", "fsync"):
+        raise UnexpectedDurabilityStringValue()
+    return AckLogConfig(
+        durability=durability,
+        batch_size=int(queue_settings.get("ack_log_batch_size", default.batch_size)),
+        flush_interval_ms=int(
+            queue_settings.get("ack_log_flush_interval_ms", default.flush_interval_ms)
+        ),
     )
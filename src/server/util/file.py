@@ -4,6 +4,11 @@ from pathlib import Path
 from server.system_logger import SLOG
 
 
+def ensure_parent(path: str) -> None:
+    """Create parent directories of the path"""
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+
 def read_bytes_or_create(path: str) -> bytes:
     """Read"""
     p = Path(path)
@@ -26,5 +31,6 @@ def write_bytes(path: str, data: bytes) -> bool:
 
 def append_bytes(path: str, data: bytes) -> None:
     """This won't be used since the header should be also updated when the payload has changed"""
+    ensure_parent(path)
     with open(path, "ab") as f:
         f.write(data)